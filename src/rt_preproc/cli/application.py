@@ -3,6 +3,8 @@
 from rt_preproc.cli.graphviz_cmd import GraphvizCmd
 from rt_preproc.cli.patch_cmd import PatchCmd
 from rt_preproc.cli.print_cmd import PrintCmd
+from rt_preproc.cli.stats_cmd import StatsCmd
+from rt_preproc.cli.watch_cmd import WatchCmd
 
 from cleo.application import Application
 
@@ -12,6 +14,8 @@ def main() -> int:
     application.add(PatchCmd())
     application.add(PrintCmd())
     application.add(GraphvizCmd())
+    application.add(StatsCmd())
+    application.add(WatchCmd())
     exit_code: int = application.run()
     return exit_code
 
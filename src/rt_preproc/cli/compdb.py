@@ -0,0 +1,172 @@
+"""
+Reading a compilation database (`compile_commands.json`) for patching a whole project.
+
+Each entry's `-D`/`-U` flags fix macros at patch time, like they do for the compiler,
+entries with the same source and the same fixed macros are patched once,
+and a state file next to the outputs remembers what each output was patched from,
+so entries that haven't changed since the last run are skipped.
+"""
+
+from typing import Iterable, List, Optional, Tuple
+import hashlib
+import json
+import os
+import shlex
+
+STATE_FILE = ".rt_preproc_compdb.json"
+"""Name of the state file in the output directory."""
+
+
+class CompdbEntry:
+    """
+    A translation unit of the compilation database and the macros its flags fix.
+    """
+
+    def __init__(
+        self,
+        file: str,
+        defined: dict[str, str],
+        undefined: Iterable[str],
+    ) -> None:
+        self.file = file
+        """Normalized absolute path of the source."""
+        self.defined = defined
+        """Macro name -> value, for the macros defined by `-D`."""
+        self.undefined = set(undefined)
+        """Macros undefined by `-U`."""
+
+    def key(self) -> Tuple:
+        """
+        Identifies what the entry is patched from, entries with the same key have the same output.
+        """
+        return (self.file, tuple(sorted(self.defined.items())), tuple(sorted(self.undefined)))
+
+
+def parse_flags(args: List[str]) -> Tuple[dict[str, str], set[str]]:
+    """
+    The macros defined and undefined by the `-D`/`-U` flags in `args`, in order,
+    so a later flag overrides an earlier one for the same macro.
+    """
+    defined: dict[str, str] = {}
+    undefined: set[str] = set()
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        i += 1
+        if arg[:2] not in ("-D", "-U"):
+            continue
+        value = arg[2:]
+        if value == "" and i < len(args):
+            value = args[i]
+            i += 1
+        name, eq, macro_value = value.partition("=")
+        if arg[:2] == "-D":
+            defined[name] = macro_value if eq else "1"
+            undefined.discard(name)
+        else:
+            defined.pop(name, None)
+            undefined.add(name)
+    return defined, undefined
+
+
+def load_compdb(path: str) -> List[CompdbEntry]:
+    """
+    The entries of the compilation database at `path`, in order.
+    """
+    with open(path) as f:
+        commands = json.load(f)
+    entries = []
+    for command in commands:
+        directory = command.get("directory", os.path.dirname(os.path.abspath(path)))
+        args = command.get("arguments")
+        if args is None:
+            args = shlex.split(command["command"])
+        file = os.path.normpath(os.path.join(directory, command["file"]))
+        defined, undefined = parse_flags(args[1:])
+        entries.append(CompdbEntry(file, defined, undefined))
+    return entries
+
+
+def dedupe(entries: List[CompdbEntry]) -> List[CompdbEntry]:
+    """
+    The entries with distinct keys, the first of each.
+    """
+    unique: dict[Tuple, CompdbEntry] = {}
+    for entry in entries:
+        unique.setdefault(entry.key(), entry)
+    return list(unique.values())
+
+
+def output_paths(entries: List[CompdbEntry], root: str, output_dir: str) -> List[str]:
+    """
+    Where to write the patched file of each entry: its path relative to `root` under `output_dir`.
+    A source patched with several sets of flags gets one output per set,
+    told apart by a hash of the flags before the extension.
+    """
+    flag_sets: dict[str, int] = {}
+    for entry in entries:
+        flag_sets[entry.file] = flag_sets.get(entry.file, 0) + 1
+    paths = []
+    for entry in entries:
+        rel_path = os.path.relpath(entry.file, root)
+        if rel_path.startswith(os.pardir):
+            # outside of the project, keep the whole path
+            rel_path = entry.file.lstrip(os.sep)
+        if flag_sets[entry.file] > 1:
+            stem, ext = os.path.splitext(rel_path)
+            digest = hashlib.sha256(repr(entry.key()[1:]).encode()).hexdigest()
+            rel_path = f"{stem}.{digest[:8]}{ext}"
+        paths.append(os.path.join(output_dir, rel_path))
+    return paths
+
+
+def fingerprint(entry: CompdbEntry, source: bytes, options: str) -> str:
+    """
+    Hash of everything the output of an entry depends on:
+    its source, its flags and the patch `options` (serialized).
+    """
+    digest = hashlib.sha256()
+    digest.update(source)
+    digest.update(repr(entry.key()[1:]).encode())
+    digest.update(options.encode())
+    return digest.hexdigest()
+
+
+class CompdbState:
+    """
+    The fingerprint each output was last patched from, kept in the output directory.
+    """
+
+    def __init__(self, output_dir: str) -> None:
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, STATE_FILE)
+        self.fingerprints: dict[str, str] = {}
+        """Output path relative to the output directory -> fingerprint."""
+        try:
+            with open(self.path) as f:
+                self.fingerprints = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def is_unchanged(self, output_path: str, fingerprint: str) -> bool:
+        rel_path = os.path.relpath(output_path, self.output_dir)
+        return self.fingerprints.get(rel_path) == fingerprint and os.path.exists(
+            output_path
+        )
+
+    def update(self, output_path: str, fingerprint: Optional[str]) -> None:
+        """
+        Record the fingerprint of an output, None to forget it (ie: if patching failed).
+        """
+        rel_path = os.path.relpath(output_path, self.output_dir)
+        if fingerprint is None:
+            self.fingerprints.pop(rel_path, None)
+        else:
+            self.fingerprints[rel_path] = fingerprint
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.fingerprints, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
@@ -1,22 +1,70 @@
+import sys
 from cleo.commands.command import Command
-from cleo.helpers import argument
-from rt_preproc.parser.ast import AstNode
-from rt_preproc.parser.parser import Parser
-from rt_preproc.visitors.graphviz import GraphVizCtx, GraphVizVisitor
+from cleo.helpers import argument, option
+from rt_preproc.parser.ast import FunctionDefinition
+from rt_preproc.parser.serialize import reify_source
+from rt_preproc.visitors.graphviz import GraphVizCtx, GraphVizVisitor, function_name
 
 
 class GraphvizCmd(Command):
     name = "graphviz"
     description = "Graph the AST of a file using graphviz"
     arguments = [argument("file", description="C file to graph", optional=False)]
-    options = []
+    options = [
+        option("output", "o", description="Dot file to write to", flag=False),
+        option(
+            "only-preproc",
+            description="Only graph preprocessor conditionals/definitions and their ancestors",
+        ),
+        option("max-depth", description="Maximum depth to graph", flag=False),
+        option("max-nodes", description="Maximum number of nodes to graph", flag=False),
+        option(
+            "function",
+            description="Only graph the definition(s) of the function with this name",
+            flag=False,
+        ),
+        option(
+            "cache-dir",
+            description="Directory to cache reified ASTs in between runs",
+            flag=False,
+        ),
+    ]
 
     def handle(self):
         file = self.argument("file")
+        max_depth = self.option("max-depth")
+        max_nodes = self.option("max-nodes")
+        fn_name = self.option("function")
+        output = self.option("output")
         with open(file, mode="rb") as f:
             bytes = f.read()
-            ds = Parser()
-            tree = ds.parse(bytes)
-            root_node = AstNode.reify(tree.root_node)
-            visitor = GraphVizVisitor()
-            root_node.accept(visitor, GraphVizCtx())
+        root_node, _ = reify_source(bytes, self.option("cache-dir"))
+
+        out = open(output, "w") if output else sys.stdout
+        try:
+            visitor = GraphVizVisitor(
+                out,
+                only_preproc=self.option("only-preproc"),
+                max_depth=int(max_depth) if max_depth is not None else None,
+                max_nodes=int(max_nodes) if max_nodes is not None else None,
+            )
+            if fn_name is None:
+                root_node.accept(visitor, GraphVizCtx())
+                return 0
+            fn_nodes = [
+                child
+                for child in root_node.children
+                if isinstance(child, FunctionDefinition)
+                and function_name(child) == fn_name
+            ]
+            if len(fn_nodes) == 0:
+                self.line_error(f"No definition found for function {fn_name}")
+                return 1
+            visitor.begin()
+            for fn_node in fn_nodes:
+                fn_node.accept(visitor, GraphVizCtx())
+            visitor.end()
+            return 0
+        finally:
+            if out is not sys.stdout:
+                out.close()
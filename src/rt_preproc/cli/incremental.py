@@ -0,0 +1,489 @@
+"""
+Incremental patching of a file as it is edited, for `rt_preproc watch`.
+
+The file is patched one top-level node at a time, in order, and what each one added to
+the state of the visitor (its declarations, macros, condition flags, blocks moved to main, ...)
+is kept along with the text it was patched into. After an edit, tree-sitter reparses only
+what changed, and the top-level nodes are patched again only if their text changed,
+or if they reference something the nodes before them now declare differently.
+The others replay what they added to the state, so the output is the same as patching
+the whole file again.
+"""
+
+from typing import List, Optional, Tuple
+from collections import defaultdict
+import copy
+import itertools
+import tree_sitter
+import rt_preproc.parser.ast as ast
+from rt_preproc.cli.patch_cmd import PatchOptions
+from rt_preproc.parser.parser import Parser
+from rt_preproc.visitors.patch.ast_ext import DispatchBlock
+from rt_preproc.visitors.patch.coalesce import coalesce
+from rt_preproc.visitors.patch.data import DegradedSite
+from rt_preproc.visitors.patch.patch import PatchCtx, PatchVisitor
+from rt_preproc.visitors.patch.unswitch import unswitch
+from rt_preproc.visitors.splice import render
+
+decl_tables = ("fn_decls", "defines", "var_decls")
+"""The tables of declarations by name a top-level node can add to, see `Delta`."""
+
+shared_tables = ("macros", "cond_flags", "fn_table_types")
+"""The dicts of the visitor top-level nodes share entries of, see `Delta`."""
+
+
+class TouchedDict(dict):
+    """
+    A dict recording the keys it was set or looked up with, in order.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.touched: dict = {}
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.touched[key] = None
+        return value
+
+    def __setitem__(self, key, value) -> None:
+        super().__setitem__(key, value)
+        self.touched[key] = None
+
+    def setdefault(self, key, default=None):
+        value = super().setdefault(key, default)
+        self.touched[key] = None
+        return value
+
+    def touched_items(self) -> dict:
+        return {key: self.get(key) for key in self.touched}
+
+
+class Delta:
+    """
+    What patching a top-level node added to the state of the visitor, in order.
+    """
+
+    def __init__(self) -> None:
+        self.fn_decls: dict[str, list] = {}
+        self.defines: dict[str, list] = {}
+        self.var_decls: dict[str, list] = {}
+        """Name -> the declarations appended for it, for each table of `decl_tables`."""
+        self.macros: dict[str, str] = {}
+        self.cond_flags: dict[str, str] = {}
+        self.fn_table_types: dict[str, str] = {}
+        """
+        The entries of the dicts of the same name the node used, for each of `shared_tables`,
+        in the order they were first used (which is the order they were added in,
+        for the ones the node added).
+        """
+        self.move_to_mains: List[ast.AstNode] = []
+        self.degraded_sites: List[DegradedSite] = []
+        self.combinations_emitted = 0
+
+    def names(self) -> set[str]:
+        """
+        The names this adds declarations for.
+        """
+        return {name for table in decl_tables for name in getattr(self, table)}
+
+
+class Item:
+    """
+    A top-level node of the file, and what patching it produced.
+    """
+
+    def __init__(self, type: str, trivia_start: int, end: int, row: int) -> None:
+        self.type = type
+        """tree-sitter type of the node."""
+        self.trivia_start = trivia_start
+        """Start of the whitespace before the node, the end of the previous one."""
+        self.end = end
+        self.row = row
+        """0-based line the node starts on."""
+        self.idents: frozenset[str] = frozenset()
+        self.has_preproc = False
+        self.text = ""
+        """The patched node, with its leading whitespace."""
+        self.delta = Delta()
+
+
+def common_prefix(a: bytes, b: bytes) -> int:
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def common_suffix(a: bytes, b: bytes, limit: int) -> int:
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid :] == b[len(b) - mid :]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def point(source: bytes, byte: int) -> Tuple[int, int]:
+    """
+    tree-sitter (row, column) of a byte offset.
+    """
+    return source.count(b"\n", 0, byte), byte - (source.rfind(b"\n", 0, byte) + 1)
+
+
+def decl_key(decl: object) -> tuple:
+    """
+    The contents of a declaration, comparable between two patches of the same node.
+    """
+    return tuple(
+        (
+            name,
+            str(value)
+            if isinstance(value, ast.AstNode)
+            else frozenset(value)
+            if isinstance(value, set)
+            else value,
+        )
+        for name, value in vars(decl).items()
+    )
+
+
+def defined_macros(root: tree_sitter.Node) -> frozenset[str]:
+    """
+    Names of the macros `#define`d in the parsed file, like `specialize.defined_macros`.
+    """
+    names = set()
+    cursor = root.walk()
+    visited = False
+    while True:
+        if not visited:
+            node = cursor.node
+            if node.type in ("preproc_def", "preproc_function_def"):
+                names.add(node.child_by_field_name("name").text.decode())
+            elif cursor.goto_first_child():
+                continue
+        if cursor.goto_next_sibling():
+            visited = False
+        elif cursor.goto_parent():
+            visited = True
+        else:
+            return frozenset(names)
+
+
+def copy_nodes(nodes: List[ast.AstNode]) -> List[ast.AstNode]:
+    """
+    Deep copies of the subtrees under `nodes` (including the cases of dispatch blocks),
+    sharing their tree-sitter nodes and the nodes they link to outside of the subtrees.
+    """
+    memo: dict[int, object] = {}
+    seen: dict[int, ast.AstNode] = {}
+    stack = list(nodes)
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen[id(node)] = node
+        stack.extend(node.children)
+        if isinstance(node, DispatchBlock):
+            stack.extend(child for _, body in node.cases for child in body)
+        if node.base_node is not None:
+            memo[id(node.base_node)] = node.base_node
+    for node in seen.values():
+        if node.parent is not None and id(node.parent) not in seen:
+            memo[id(node.parent)] = node.parent
+    return copy.deepcopy(nodes, memo)
+
+
+class IncrementalPatcher:
+    """
+    Patches successive versions of a file, reusing what it can from the previous one.
+    Formatting (`options.fmt`) isn't supported, the output is what `patch_tree` outputs without it.
+    """
+
+    def __init__(self, options: PatchOptions) -> None:
+        self.options = options
+        self.parser = Parser()
+        self.source = b""
+        self.tree: Optional[tree_sitter.Tree] = None
+        self.items: List[Item] = []
+        self.output = ""
+        self.degraded_sites: List[DegradedSite] = []
+        self.repatched = 0
+        """Number of top-level nodes patched again by the last update."""
+        self.specialization = options.specialization
+
+    def update(self, source: bytes) -> str:
+        """
+        Patch the new version `source` of the file, returns the patched file.
+        """
+        if self.tree is None:
+            start, new_end = 0, len(source)
+            tree = self.parser.parse(source)
+        elif source == self.source:
+            self.repatched = 0
+            return self.output
+        else:
+            start = common_prefix(self.source, source)
+            suffix = common_suffix(
+                self.source, source, min(len(self.source), len(source)) - start
+            )
+            old_end, new_end = len(self.source) - suffix, len(source) - suffix
+            self.tree.edit(
+                start,
+                old_end,
+                new_end,
+                point(self.source, start),
+                point(self.source, old_end),
+                point(source, new_end),
+            )
+            tree = self.parser.parse(source, self.tree)
+
+        # the nodes entirely before or after the edit are still the same
+        shift = len(source) - len(self.source)
+        old_items = {(item.trivia_start, item.end, item.type): item for item in self.items}
+        root = tree.root_node
+        items: List[Tuple[Item, tree_sitter.Node, bool]] = []
+        prev_end = root.start_byte
+        for child in root.children:
+            item = None
+            if child.end_byte <= start:
+                item = old_items.pop((prev_end, child.end_byte, child.type), None)
+            elif prev_end >= new_end:
+                item = old_items.pop(
+                    (prev_end - shift, child.end_byte - shift, child.type), None
+                )
+            if item is None:
+                item = Item(child.type, prev_end, child.end_byte, child.start_point[0])
+                items.append((item, child, False))
+            else:
+                self.move_item(item, prev_end, child)
+                items.append((item, child, True))
+            prev_end = child.end_byte
+        # the new nodes are compared with the ones they replace, so that only what the edit
+        # changed in what they declare affects the nodes after them, and what the other
+        # removed nodes declared is gone
+        removed = list(old_items.values())
+        new_items = [item for item, _, reused in items if not reused]
+        for item, old in zip(new_items, removed):
+            item.delta = old.delta
+        removed = removed[len(new_items) :]
+
+        self.source = source
+        self.tree = tree
+        spec = self.options.specialization
+        if spec.runtime is not None:
+            local = defined_macros(root)
+            if local != self.specialization.local:
+                # the macros the file defines aren't fixed, so the nodes resolved without them
+                # are patched again
+                self.specialization = spec.for_file(local)
+                for i, (item, child, _) in enumerate(items):
+                    items[i] = (item, child, False)
+        self.patch_items(items, removed, start)
+        self.degraded_sites = self.visitor.degraded_sites
+        self.items = [item for item, _, _ in items]
+
+        head = source[: root.start_byte].decode()
+        tail = source[prev_end:].decode()
+        parts = [head, self.visitor.build_setup_prelude()]
+        parts.append(self.options.specialization.defines_to_c())
+        parts.extend(item.text for item in self.items)
+        if len(self.visitor.fn_table_types) > 0:
+            parts.append(self.visitor.build_fn_table_setup())
+        parts.append(tail)
+        self.output = "".join(parts)
+        return self.output
+
+    def move_item(self, item: Item, trivia_start: int, child: tree_sitter.Node) -> None:
+        """
+        Update the position of an unchanged node, and the lines of its degraded sites.
+        """
+        item.trivia_start = trivia_start
+        item.end = child.end_byte
+        row_shift = child.start_point[0] - item.row
+        item.row = child.start_point[0]
+        if row_shift != 0:
+            sites = []
+            for site in item.delta.degraded_sites:
+                site = copy.copy(site)
+                if site.line is not None:
+                    site.line += row_shift
+                sites.append(site)
+            item.delta.degraded_sites = sites
+
+    def patch_items(
+        self,
+        items: List[Tuple[Item, tree_sitter.Node, bool]],
+        removed: List[Item],
+        start: int,
+    ) -> None:
+        """
+        Patch the new nodes, in order, and the unchanged ones (`reused`) affected by
+        the changes before them. The nodes `removed` by the edit were at `start`.
+        """
+        self.visitor = PatchVisitor(
+            max_site_combinations=self.options.max_site_combinations,
+            max_file_combinations=self.options.max_file_combinations,
+            fn_tables=self.options.fn_tables,
+            macro_types=self.options.macro_types,
+        )
+        for name in shared_tables:
+            setattr(self.visitor, name, TouchedDict())
+        ctx = PatchCtx()
+        self.repatched = 0
+        changed_names: set[str] = set()
+        conds_changed = False
+        moves_changed = False
+        combinations_changed = False
+        removed_pending = len(removed) > 0
+
+        for item, child, reused in items:
+            if removed_pending and not (reused and item.end <= start):
+                for old in removed:
+                    changed_names |= old.delta.names()
+                    conds_changed |= len(old.delta.cond_flags) > 0
+                    moves_changed |= len(old.delta.move_to_mains) > 0
+                    combinations_changed |= old.delta.combinations_emitted > 0
+                removed_pending = False
+            budget = self.options.max_file_combinations is not None
+            if (
+                reused
+                and changed_names.isdisjoint(item.idents)
+                and not (conds_changed and item.has_preproc)
+                and not (moves_changed and "main" in item.idents)
+                and not (combinations_changed and budget)
+            ):
+                self.replay(item.delta, ctx)
+                continue
+
+            old = item.delta
+            self.patch_item(item, child, ctx)
+            self.repatched += 1
+            new = item.delta
+            for name in old.names() | new.names():
+                if any(
+                    list(map(decl_key, getattr(old, table).get(name, ())))
+                    != list(map(decl_key, getattr(new, table).get(name, ())))
+                    for table in decl_tables
+                ):
+                    changed_names.add(name)
+            conds_changed |= old.cond_flags != new.cond_flags
+            moves_changed |= list(map(str, old.move_to_mains)) != list(
+                map(str, new.move_to_mains)
+            )
+            combinations_changed |= old.combinations_emitted != new.combinations_emitted
+
+    def patch_item(self, item: Item, child: tree_sitter.Node, ctx: PatchCtx) -> None:
+        """
+        Patch a top-level node on its own, as the visit of the whole file would at its position.
+        """
+        node = ast.AstNode.reify(child, source=self.source)
+        node.source = self.source
+        node.trivia_start = item.trivia_start
+        node.trivia_end = child.start_byte
+        # a translation unit of its own, so it's visited as a top-level node
+        unit = ast.TranslationUnit()
+        unit.children = [node]
+        unit.children_named_idxs = [0 if child.is_named else None]
+        node.parent = unit
+        if not self.specialization.is_empty():
+            unit = self.specialization.specialize_node(unit)
+        item.idents = frozenset().union(*(c.variability().idents for c in unit.children))
+        item.has_preproc = any(c.variability().has_preproc for c in unit.children)
+
+        # the node only looks up the variables it references, so its context only holds those,
+        # rather than all the globals the visit would copy for each of its children
+        item_ctx = PatchCtx(
+            var_decls=defaultdict(
+                list,
+                {
+                    ident: list(ctx.var_decls[ident])
+                    for ident in item.idents
+                    if ident in ctx.var_decls
+                },
+            )
+        )
+        visitor = self.visitor
+        for name in shared_tables:
+            getattr(visitor, name).touched = {}
+        mark = self.mark(item, item_ctx)
+        moves = visitor.move_to_mains
+        if len(moves) > 0 and "main" in item.idents:
+            # main's body takes the blocks, and coalescing them changes them in place
+            visitor.move_to_mains = copy_nodes(moves)
+        up_msg = visitor.visit_children(unit, item_ctx)
+        assert len(up_msg.move_ups) == 0
+        visitor.move_to_mains = moves + visitor.move_to_mains[len(moves) :]
+        if not self.options.no_coalesce:
+            coalesce(unit)
+        if self.options.unswitch_loops is not None:
+            unswitch(unit, self.options.unswitch_loops)
+        item.text = "".join(c.leading_trivia() + render(c, self.source) for c in unit.children)
+        item.delta = self.delta_since(mark, item_ctx)
+        for ident, decls in item.delta.var_decls.items():
+            ctx.var_decls[ident].extend(decls)
+
+    def decl_tables(self, ctx: PatchCtx) -> List[dict[str, list]]:
+        return [self.visitor.symbols.fn_decls, self.visitor.symbols.defines, ctx.var_decls]
+
+    def mark(self, item: Item, ctx: PatchCtx) -> tuple:
+        """
+        The sizes of the state of the visitor, to tell what patching `item` adds to it.
+        The names declared before are only looked at among the identifiers of the node,
+        the new ones are the last in their table.
+        """
+        tables = self.decl_tables(ctx)
+        visitor = self.visitor
+        return (
+            [len(table) for table in tables],
+            [
+                {name: len(table[name]) for name in item.idents if name in table}
+                for table in tables
+            ],
+            len(visitor.move_to_mains),
+            len(visitor.degraded_sites),
+            visitor.combinations_emitted,
+        )
+
+    def delta_since(self, mark: tuple, ctx: PatchCtx) -> Delta:
+        table_sizes, counts, moves, sites, emitted = mark
+        visitor = self.visitor
+        delta = Delta()
+        for name, table, size, table_counts in zip(
+            decl_tables, self.decl_tables(ctx), table_sizes, counts
+        ):
+            added = getattr(delta, name)
+            for ident, count in table_counts.items():
+                if len(table[ident]) > count:
+                    added[ident] = table[ident][count:]
+            for ident in itertools.islice(table, size, None):
+                if len(table[ident]) > 0:
+                    added[ident] = list(table[ident])
+        for name in shared_tables:
+            setattr(delta, name, getattr(visitor, name).touched_items())
+        delta.move_to_mains = visitor.move_to_mains[moves:]
+        delta.degraded_sites = visitor.degraded_sites[sites:]
+        delta.combinations_emitted = visitor.combinations_emitted - emitted
+        return delta
+
+    def replay(self, delta: Delta, ctx: PatchCtx) -> None:
+        """
+        Add what patching a node added to the state again, without patching it.
+        """
+        visitor = self.visitor
+        for name, table in zip(decl_tables, self.decl_tables(ctx)):
+            for ident, decls in getattr(delta, name).items():
+                table.setdefault(ident, []).extend(decls)
+        for name in shared_tables:
+            shared = getattr(visitor, name)
+            for key, value in getattr(delta, name).items():
+                dict.setdefault(shared, key, value)
+        visitor.move_to_mains.extend(delta.move_to_mains)
+        visitor.degraded_sites.extend(delta.degraded_sites)
+        visitor.combinations_emitted += delta.combinations_emitted
@@ -0,0 +1,154 @@
+"""
+Memory profile of patch runs, to find what the memory of a file goes to and in which phase.
+
+At each phase boundary `tracemalloc` is snapshotted, and a JSON-lines record gives the
+size still allocated (retained) and the peak since the previous boundary, the allocation
+sites that grew or shrank the most, and the live objects of the types the patcher is
+made of. Objects only alive during a phase (like the `MoveUpMsg`s of a visit) don't
+show in the counts, but in the peak and its allocation sites.
+"""
+
+from typing import Any, Dict, List, Optional, Set, TextIO, Tuple
+from collections import Counter
+import gc
+import json
+import sys
+import tracemalloc
+import rt_preproc.parser.ast as ast
+from rt_preproc.visitors.patch.data import MoveUpMsg, VarDecl
+from rt_preproc.visitors.patch.patch import PatchCtx
+
+counted_types = (MoveUpMsg, PatchCtx, VarDecl)
+"""The types counted by name, besides `AstNode` (and each of its subclasses) and `str`."""
+
+containers = (dict, list, tuple, set, frozenset)
+
+
+def subclasses(cls: type) -> Set[type]:
+    """
+    `cls` and all its subclasses.
+    """
+    found = {cls}
+    for sub in cls.__subclasses__():
+        found |= subclasses(sub)
+    return found
+
+
+def count_objects(top: int) -> Dict[str, Any]:
+    """
+    The live objects of the counted types, and the `top` most common `AstNode` subclasses.
+    The strings counted are the ones those objects hold, directly or in containers.
+    """
+    # by exact type, `isinstance` on the `AstNode` ABC would fill its caches with every type
+    # trees are cycles through their parent links, don't count the ones that are garbage already
+    gc.collect()
+    node_classes = subclasses(ast.AstNode)
+    counted = {sub: cls.__name__ for cls in counted_types for sub in subclasses(cls)}
+    counts: Counter = Counter()
+    node_types: Counter = Counter()
+    objects = []
+    for obj in gc.get_objects():
+        cls = type(obj)
+        if cls in node_classes:
+            counts["AstNode"] += 1
+            node_types[cls.__name__] += 1
+            objects.append(obj)
+        elif cls in counted:
+            counts[counted[cls]] += 1
+            objects.append(obj)
+    strings: Dict[int, str] = {}
+    seen: Set[int] = set()
+    while objects:
+        referents = gc.get_referents(*objects)
+        objects = []
+        for referent in referents:
+            if type(referent) is str:
+                strings[id(referent)] = referent
+            elif type(referent) in containers and id(referent) not in seen:
+                seen.add(id(referent))
+                objects.append(referent)
+    return {
+        "objects": {
+            "AstNode": counts["AstNode"],
+            **{t.__name__: counts[t.__name__] for t in counted_types},
+            "str": len(strings),
+        },
+        "str_bytes": sum(map(sys.getsizeof, strings.values())),
+        "node_types": dict(node_types.most_common(top)),
+    }
+
+
+class MemProfile:
+    """
+    Writes a record per phase of each file to a JSON-lines file, see the module docstring.
+    Tracing slows the patcher down several times, so it is only started by the first file.
+    """
+
+    def __init__(self, out: TextIO, top: int = 10) -> None:
+        self.out = out
+        self.top = top
+        """How many allocation sites and `AstNode` subclasses each record lists."""
+        self.file: Optional[str] = None
+        self.previous: Optional[tracemalloc.Snapshot] = None
+        self.retained = 0
+        self.filters = [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ]
+
+    def start(self, file: str) -> None:
+        """
+        Start the profile of `file`, its first phase starts now.
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.file = file
+        self.previous, self.retained = self.snapshot()
+        tracemalloc.reset_peak()
+
+    def phase(self, name: str) -> None:
+        """
+        End the phase `name` of the current file.
+        """
+        if self.previous is None:
+            return
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot, retained = self.snapshot()
+        sites: List[Dict[str, Any]] = []
+        for stat in snapshot.compare_to(self.previous, "lineno")[: self.top]:
+            if stat.size_diff == 0:
+                break
+            sites.append(
+                {
+                    "site": str(stat.traceback[0]),
+                    "size_diff": stat.size_diff,
+                    "count_diff": stat.count_diff,
+                    "size": stat.size,
+                }
+            )
+        record = {
+            "type": "phase",
+            "file": self.file,
+            "phase": name,
+            "retained_bytes": retained,
+            "growth_bytes": retained - self.retained,
+            "peak_bytes": peak,
+            "top_sites": sites,
+            **count_objects(self.top),
+        }
+        self.out.write(json.dumps(record) + "\n")
+        self.out.flush()
+        self.previous, self.retained = snapshot, retained
+        # the counting allocated too, but it's all gone by now
+        tracemalloc.reset_peak()
+
+    def snapshot(self) -> Tuple[tracemalloc.Snapshot, int]:
+        """
+        The current snapshot without the profiler's own allocations, and its size.
+        """
+        snapshot = tracemalloc.take_snapshot().filter_traces(self.filters)
+        return snapshot, sum(stat.size for stat in snapshot.statistics("filename"))
+
+    def stop(self) -> None:
+        tracemalloc.stop()
+        self.previous = None
@@ -1,9 +1,258 @@
+from typing import List, Optional, Tuple
+import copy
+import json
+import multiprocessing
+import os
+import time
 from cleo.commands.command import Command
+from cleo.exceptions import CleoRuntimeError
 from cleo.helpers import argument, option
-from rt_preproc.parser.ast import AstNode
-from rt_preproc.parser.parser import Parser
+import rt_preproc.parser.ast as ast
+from rt_preproc.cli.compdb import (
+    CompdbEntry,
+    CompdbState,
+    dedupe,
+    fingerprint,
+    load_compdb,
+    output_paths,
+)
+from rt_preproc.cli.memprofile import MemProfile
+from rt_preproc.cli.telemetry import Telemetry, count_nodes, finish_record, new_record
+from rt_preproc.parser.serialize import reify_source
+from rt_preproc.visitors.patch.coalesce import coalesce
+from rt_preproc.visitors.patch.data import DegradedSite
+from rt_preproc.visitors.patch.loader import value_parsers
 from rt_preproc.visitors.patch.patch import PatchCtx, PatchVisitor
-from rt_preproc.visitors.print import PrintCtx, PrintVisitor
+from rt_preproc.visitors.patch.specialize import Specialization
+from rt_preproc.visitors.patch.unswitch import unswitch
+from rt_preproc.visitors.print import PrintCtx, PrintVisitor, astyle_formatter
+from rt_preproc.visitors.splice import (
+    apply_edits,
+    collect_edits,
+    format_edits,
+    unified_diff,
+)
+
+
+class PatchOptions:
+    """
+    How to patch, the same for every file of a run.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Optional[str] = None,
+        max_site_combinations: Optional[int] = None,
+        max_file_combinations: Optional[int] = None,
+        fn_tables: bool = False,
+        macro_types: Optional[dict[str, str]] = None,
+        specialization: Optional[Specialization] = None,
+        no_coalesce: bool = False,
+        unswitch_loops: Optional[int] = None,
+        fmt: bool = False,
+        jobs: int = 1,
+        telemetry: bool = False,
+    ) -> None:
+        self.cache_dir = cache_dir
+        self.max_site_combinations = max_site_combinations
+        self.max_file_combinations = max_file_combinations
+        self.fn_tables = fn_tables
+        self.macro_types = macro_types if macro_types is not None else {}
+        self.specialization = (
+            specialization if specialization is not None else Specialization()
+        )
+        self.no_coalesce = no_coalesce
+        self.unswitch_loops = unswitch_loops
+        self.fmt = fmt
+        self.jobs = jobs
+        """Worker processes to patch the function bodies of a file in."""
+        self.telemetry = telemetry
+        """Whether to record the telemetry of each file, see `telemetry.py`."""
+
+    def for_entry(self, entry: CompdbEntry) -> "PatchOptions":
+        """
+        The options for a compilation database entry: the macros its flags fix are fixed too,
+        unless the command line fixes them the other way. Its function bodies are patched serially,
+        since the entries are already patched in parallel.
+        """
+        spec = self.specialization
+        defined = {
+            name: value
+            for name, value in entry.defined.items()
+            if name not in spec.undefined
+        }
+        defined.update(spec.defined)
+        undefined = (entry.undefined - spec.defined.keys()) | spec.undefined
+        options = copy.copy(self)
+        options.specialization = Specialization(defined, undefined, spec.runtime)
+        options.jobs = 1
+        return options
+
+    def to_json(self) -> str:
+        """
+        The options that change the output, serialized.
+        """
+        spec = self.specialization
+        return json.dumps(
+            {
+                "max_site_combinations": self.max_site_combinations,
+                "max_file_combinations": self.max_file_combinations,
+                "fn_tables": self.fn_tables,
+                "macro_types": self.macro_types,
+                "defined": spec.defined,
+                "undefined": sorted(spec.undefined),
+                "runtime": sorted(spec.runtime) if spec.runtime is not None else None,
+                "no_coalesce": self.no_coalesce,
+                "unswitch_loops": self.unswitch_loops,
+                "fmt": self.fmt,
+            },
+            sort_keys=True,
+        )
+
+
+def patch_tree(
+    root_node: ast.AstNode,
+    source: bytes,
+    options: PatchOptions,
+    record: Optional[dict] = None,
+    memprofile: Optional[MemProfile] = None,
+) -> Tuple[bytes, List[DegradedSite]]:
+    """
+    Patch the tree reified from `source` in place.
+    Returns the patched file and the sites that went over the combination budget.
+    If given, `record` gets the seconds spent patching (`patch_s`) and printing
+    the output (`print_s`), and the number of combinations emitted,
+    and `memprofile` ends its patch and print phases.
+    """
+    start = time.perf_counter()
+    if not options.specialization.is_empty():
+        options.specialization.apply(root_node)
+    visitor = PatchVisitor(
+        max_site_combinations=options.max_site_combinations,
+        max_file_combinations=options.max_file_combinations,
+        fn_tables=options.fn_tables,
+        macro_types=options.macro_types,
+        jobs=options.jobs,
+    )
+    root_node.accept(visitor, PatchCtx())
+    if not options.no_coalesce:
+        coalesce(root_node)
+    if options.unswitch_loops is not None:
+        unswitch(root_node, options.unswitch_loops)
+    patched = time.perf_counter()
+    if memprofile is not None:
+        memprofile.phase("patch")
+    # the untouched parts of the file are kept as they are
+    edits = collect_edits(root_node, source)
+    if options.fmt:
+        format_edits(edits, source, astyle_formatter())
+    out = apply_edits(source, edits)
+    if memprofile is not None:
+        memprofile.phase("print")
+    if record is not None:
+        record["patch_s"] = patched - start
+        record["print_s"] = time.perf_counter() - patched
+        record["combinations_emitted"] = visitor.combinations_emitted
+    return out, visitor.degraded_sites
+
+
+def _patch_entry(
+    work: Tuple[str, str, bytes, PatchOptions, float],
+    memprofile: Optional[MemProfile] = None,
+) -> Tuple[str, str, Optional[str], List[DegradedSite], Optional[dict]]:
+    """
+    Patch a compilation database entry into its output file, in a worker process
+    (in this one with `memprofile`).
+    Returns the file, the output path, the error if it failed, the degraded sites
+    and the telemetry record if `options.telemetry` is set.
+    """
+    file, output_path, source, options, read_s = work
+    record = new_record(file, source) if options.telemetry else None
+    if memprofile is not None:
+        memprofile.start(file)
+    start = time.perf_counter()
+    error = None
+    degraded_sites: List[DegradedSite] = []
+    try:
+        root_node, cache_hit = reify_source(source, options.cache_dir, record)
+        if record is not None:
+            record["nodes"] = count_nodes(root_node)
+            record["cache_hit"] = cache_hit
+        if memprofile is not None:
+            memprofile.phase("reify")
+        patched, degraded_sites = patch_tree(
+            root_node, source, options, record, memprofile
+        )
+        written = time.perf_counter()
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with open(output_path, "wb") as f:
+            f.write(patched)
+        if record is not None:
+            record["write_s"] = time.perf_counter() - written
+        if memprofile is not None:
+            # the tree is still alive here, the next file starts without it
+            memprofile.phase("write")
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    if record is not None:
+        record["output"] = output_path
+        record["read_s"] = read_s
+        finish_record(record, start - read_s, error)
+    return file, output_path, error, degraded_sites, record
+
+
+patch_options = [
+    option(
+        "max-site-combinations",
+        description="Use variant selection instead of duplication at sites with more combinations than this",
+        flag=False,
+    ),
+    option(
+        "max-file-combinations",
+        description="Use variant selection instead of duplication once the file has emitted this many combinations",
+        flag=False,
+    ),
+    option(
+        "fn-tables",
+        description="Call conditionally defined functions through function pointers set up once at startup",
+    ),
+    option(
+        "macro-type",
+        description=f"Runtime type of a macro's value as NAME=TYPE, TYPE is one of: {', '.join(value_parsers)} (default int)",
+        flag=False,
+        multiple=True,
+    ),
+    option(
+        "define",
+        "D",
+        description="Fix a macro as defined to a value (NAME or NAME=VAL) instead of making it runtime",
+        flag=False,
+        multiple=True,
+    ),
+    option(
+        "undefine",
+        "U",
+        description="Fix a macro as undefined instead of making it runtime",
+        flag=False,
+        multiple=True,
+    ),
+    option(
+        "runtime",
+        description="Only make these macros runtime, any other macro not given with -D is undefined",
+        flag=False,
+        multiple=True,
+    ),
+    option(
+        "no-coalesce",
+        description="Don't merge adjacent runtime dispatch blocks on the same conditions",
+    ),
+    option(
+        "unswitch-loops",
+        description="Hoist runtime dispatch out of loops, emitting at most this many specialized copies of each loop",
+        flag=False,
+    ),
+]
+"""The options of how to patch, shared by the commands that patch."""
 
 
 class PatchCmd(Command):
@@ -11,48 +260,298 @@ class PatchCmd(Command):
     description = (
         "Patch a file to convert compile-time C preprocessor macros to runtime logic"
     )
-    arguments = [argument("file", description="C file to patch", optional=False)]
+    arguments = [argument("file", description="C file to patch", optional=True)]
     options = [
-        option("output", "o", description="Output file to write to", flag=False),
+        option(
+            "output",
+            "o",
+            description="Output file to write to (the output directory with --compdb)",
+            flag=False,
+        ),
         option(
             "fmt",
             "f",
-            description="Run astyle on the output",
+            description="Run astyle on the code generated by the patch",
         ),
         option(
             "just_output",
             "j",
             description="Just output the patched file",
         ),
+        option(
+            "diff",
+            description="Output a unified diff against the original file instead of the patched file",
+        ),
+        *patch_options,
+        option(
+            "jobs",
+            description="Patch the bodies of functions without preprocessor directives in this many worker processes"
+            " (the translation units with --compdb, default: one per CPU)",
+            flag=False,
+        ),
+        option(
+            "compdb",
+            description="Patch every translation unit of this compile_commands.json into --output, fixing the macros of their -D/-U flags",
+            flag=False,
+        ),
+        option(
+            "cache-dir",
+            description="Directory to cache reified ASTs in between runs",
+            flag=False,
+        ),
+        option(
+            "telemetry",
+            description="Write a JSON line per patched file to this file, with its size, phase times and peak RSS,"
+            " and one with the throughput and latency percentiles of the run",
+            flag=False,
+        ),
+        option(
+            "memprofile",
+            description="Write a JSON line per phase of each file to this file, with the memory retained and peaked,"
+            " the top allocation sites and the live objects by type (traces with tracemalloc, serially)",
+            flag=False,
+        ),
     ]
 
-    def runPatch(self, file: str, just_output: bool = False, output_file: str = None):
+    def runPatch(
+        self,
+        file: str,
+        options: PatchOptions,
+        just_output: bool = False,
+        output_file: str = None,
+        diff: bool = False,
+        telemetry: Optional[Telemetry] = None,
+        memprofile: Optional[MemProfile] = None,
+    ):
         if not just_output:
             self.line(f"File: {file}")
+        if memprofile is not None:
+            memprofile.start(file)
+        start = time.perf_counter()
         with open(file, mode="rb") as f:
             bytes = f.read()
-            ds = Parser()
-            tree = ds.parse(bytes)
-
-            root_node = AstNode.reify(tree.root_node)
+            record = new_record(file, bytes) if telemetry is not None else None
+            if record is not None:
+                record["read_s"] = time.perf_counter() - start
+            if memprofile is not None:
+                memprofile.phase("read")
+            root_node, cache_hit = reify_source(bytes, options.cache_dir, record)
+            if record is not None:
+                record["nodes"] = count_nodes(root_node)
+                record["cache_hit"] = cache_hit
+            if memprofile is not None:
+                memprofile.phase("reify")
 
             if not just_output:
                 self.line("\n---- ORIGINAL C SOURCE ----")
                 printer = PrintVisitor()
                 root_node.accept(printer, PrintCtx())
 
-            visitor = PatchVisitor()
-            root_node.accept(visitor, PatchCtx())
+            patched, degraded_sites = patch_tree(
+                root_node, bytes, options, record, memprofile
+            )
+            self.report_degraded_sites(file, degraded_sites)
 
             if not just_output:
                 self.line("\n---- PATCHED C SOURCE ----")
-            printer = PrintVisitor(output_file=output_file, use_astyle=self.option("fmt"))
-            root_node.accept(printer, PrintCtx())
+            written = time.perf_counter()
+            out = unified_diff(file, bytes, patched) if diff else patched.decode()
+            if output_file is not None:
+                with open(output_file, "w") as f:
+                    f.write(out)
+            else:
+                self.io.write(out)
+            if memprofile is not None:
+                memprofile.phase("write")
+            if record is not None:
+                record["output"] = output_file
+                record["write_s"] = time.perf_counter() - written
+                finish_record(record, start, None)
+                telemetry.add(record)
+                telemetry.finish()
+
+    def runCompdb(
+        self,
+        compdb_path: str,
+        output_dir: str,
+        options: PatchOptions,
+        jobs: int,
+        telemetry: Optional[Telemetry] = None,
+        memprofile: Optional[MemProfile] = None,
+    ) -> int:
+        """
+        Patch every translation unit of a compilation database into `output_dir`,
+        in `jobs` worker processes (serially with `memprofile`). Returns the exit code.
+        """
+        entries = dedupe(load_compdb(compdb_path))
+        root = os.path.dirname(os.path.abspath(compdb_path))
+        state = CompdbState(output_dir)
+        options_key = options.to_json()
+        work: List[Tuple[str, str, bytes, PatchOptions, float]] = []
+        fingerprints: dict[str, str] = {}
+        patched = 0
+        unchanged = 0
+        failed = 0
+        for entry, output_path in zip(entries, output_paths(entries, root, output_dir)):
+            start = time.perf_counter()
+            try:
+                with open(entry.file, mode="rb") as f:
+                    source = f.read()
+            except OSError as e:
+                self.line_error(f"{entry.file}: {e}")
+                failed += 1
+                if telemetry is not None:
+                    record = new_record(entry.file, b"")
+                    record["output"] = output_path
+                    finish_record(record, start, f"{type(e).__name__}: {e}")
+                    telemetry.add(record)
+                continue
+            read_s = time.perf_counter() - start
+            fingerprints[output_path] = fingerprint(entry, source, options_key)
+            if state.is_unchanged(output_path, fingerprints[output_path]):
+                unchanged += 1
+                continue
+            work.append(
+                (entry.file, output_path, source, options.for_entry(entry), read_s)
+            )
+        # the biggest files first, so the pool isn't left waiting on one at the end
+        work.sort(key=lambda item: len(item[2]), reverse=True)
+
+        if jobs > 1 and len(work) > 1 and memprofile is None:
+            pool = multiprocessing.get_context("fork").Pool(jobs)
+            results = pool.imap_unordered(_patch_entry, work)
+        else:
+            pool = None
+            results = (_patch_entry(item, memprofile) for item in work)
+        try:
+            for file, output_path, error, degraded_sites, record in results:
+                if record is not None:
+                    telemetry.add(record)
+                if error is not None:
+                    self.line_error(f"{file}: {error}")
+                    state.update(output_path, None)
+                    failed += 1
+                    continue
+                self.report_degraded_sites(file, degraded_sites)
+                state.update(output_path, fingerprints[output_path])
+                patched += 1
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            state.save()
+            if telemetry is not None:
+                telemetry.finish(unchanged)
+
+        self.line(
+            f"{patched} patched, {unchanged} unchanged, {failed} failed"
+            f" ({len(entries)} translation units)"
+        )
+        return 1 if failed > 0 else 0
+
+    def report_degraded_sites(self, file: str, degraded_sites: List[DegradedSite]) -> None:
+        if len(degraded_sites) > 0:
+            self.line_error(
+                f"{file}: {len(degraded_sites)} site(s) over the combination budget:"
+            )
+            for site in degraded_sites:
+                self.line_error(f"  {site}")
+
+    def build_options(self, **kwargs) -> Optional[PatchOptions]:
+        """
+        The `PatchOptions` from the options of `patch_options`, and `kwargs` for the others.
+        None if they are invalid.
+        """
+        macro_types = {}
+        for macro_type in self.option("macro-type"):
+            name, _, type = macro_type.partition("=")
+            if type not in value_parsers:
+                self.line_error(f"Invalid --macro-type {macro_type}")
+                return None
+            macro_types[name] = type
+        defined = {}
+        for define in self.option("define"):
+            name, _, value = define.partition("=")
+            defined[name] = value if value != "" else "1"
+        return PatchOptions(
+            max_site_combinations=self.int_option("max-site-combinations"),
+            max_file_combinations=self.int_option("max-file-combinations"),
+            fn_tables=self.option("fn-tables"),
+            macro_types=macro_types,
+            specialization=Specialization(
+                defined,
+                self.option("undefine"),
+                self.option("runtime") or None,
+            ),
+            no_coalesce=self.option("no-coalesce"),
+            unswitch_loops=self.int_option("unswitch-loops"),
+            **kwargs,
+        )
 
     def handle(self):
         opt = self.option("output")
-        self.runPatch(
-            self.argument("file"),
-            just_output=self.option("just_output"),
-            output_file=opt,
+        jobs = self.int_option("jobs")
+        telemetry_path = self.option("telemetry")
+        memprofile_path = self.option("memprofile")
+        if memprofile_path is not None:
+            # tracemalloc only sees this process
+            jobs = 1
+        options = self.build_options(
+            cache_dir=self.option("cache-dir"),
+            fmt=self.option("fmt"),
+            jobs=jobs or 1,
+            telemetry=telemetry_path is not None,
         )
+        if options is None:
+            return 1
+        compdb = self.option("compdb")
+        if compdb is not None and opt is None:
+            self.line_error(
+                "--compdb needs --output, the directory to write the patched files to"
+            )
+            return 1
+        if compdb is None and self.argument("file") is None:
+            self.line_error("Missing the file to patch (or --compdb)")
+            return 1
+
+        telemetry_file = open(telemetry_path, "w") if telemetry_path is not None else None
+        telemetry = Telemetry(telemetry_file) if telemetry_file is not None else None
+        memprofile_file = open(memprofile_path, "w") if memprofile_path is not None else None
+        memprofile = MemProfile(memprofile_file) if memprofile_file is not None else None
+        try:
+            if compdb is not None:
+                return self.runCompdb(
+                    compdb,
+                    opt,
+                    options,
+                    jobs or os.cpu_count() or 1,
+                    telemetry,
+                    memprofile,
+                )
+            self.runPatch(
+                self.argument("file"),
+                options,
+                just_output=self.option("just_output"),
+                output_file=opt,
+                diff=self.option("diff"),
+                telemetry=telemetry,
+                memprofile=memprofile,
+            )
+        finally:
+            if telemetry_file is not None:
+                telemetry_file.close()
+            if memprofile is not None:
+                memprofile.stop()
+                memprofile_file.close()
+
+    def int_option(self, name: str) -> Optional[int]:
+        value = self.option(name)
+        if value is None:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            # like the errors cleo raises for the options it parses
+            raise CleoRuntimeError(
+                f'The "--{name}" option requires an integer, got "{value}"'
+            )
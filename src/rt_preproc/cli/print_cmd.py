@@ -1,7 +1,6 @@
 from cleo.commands.command import Command
 from cleo.helpers import argument, option
-from rt_preproc.parser.ast import AstNode
-from rt_preproc.parser.parser import Parser
+from rt_preproc.parser.serialize import reify_source
 from rt_preproc.visitors.print import PrintCtx, PrintVisitor
 
 
@@ -20,7 +19,12 @@ class PrintCmd(Command):
         option(
             "fmt",
             description="Run astyle on the output",
-        )
+        ),
+        option(
+            "cache-dir",
+            description="Directory to cache reified ASTs in between runs",
+            flag=False,
+        ),
     ]
 
     def handle(self):
@@ -28,9 +32,7 @@ class PrintCmd(Command):
         self.line(f"File: {file}")
         with open(file, mode="rb") as f:
             bytes = f.read()
-            ds = Parser()
-            tree = ds.parse(bytes)
-            root_node = AstNode.reify(tree.root_node)
+            root_node, _ = reify_source(bytes, self.option("cache-dir"))
             visitor = PrintVisitor(
                 output_file=self.argument("output"), use_astyle=self.option("fmt")
             )
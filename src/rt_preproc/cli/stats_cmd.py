@@ -0,0 +1,120 @@
+import json
+import os
+from cleo.commands.command import Command
+from cleo.helpers import argument, option
+from rt_preproc.parser.parser import Parser
+from rt_preproc.parser.stats import collect_stats
+
+c_extensions = (".c", ".h")
+
+
+def find_c_files(paths: list[str]) -> list[str]:
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for dir_path, dir_names, file_names in os.walk(path):
+            dir_names.sort()
+            files.extend(
+                os.path.join(dir_path, name)
+                for name in sorted(file_names)
+                if name.endswith(c_extensions)
+            )
+    return files
+
+
+class StatsCmd(Command):
+    name = "stats"
+    description = (
+        "Report variability metrics and predicted duplication blowup without patching"
+    )
+    arguments = [
+        argument(
+            "paths",
+            description="C files or directories to scan",
+            optional=False,
+            multiple=True,
+        )
+    ]
+    options = [
+        option("json", description="Output JSON instead of a table"),
+        option("functions", description="Include per-function rows in the table"),
+    ]
+
+    def handle(self):
+        ds = Parser()
+        results = []
+        for file in find_c_files(self.argument("paths")):
+            with open(file, mode="rb") as f:
+                bytes = f.read()
+            tree = ds.parse(bytes)
+            results.append(collect_stats(file, bytes, tree).to_dict())
+
+        if self.option("json"):
+            self.line(json.dumps(results, indent=2))
+            return 0
+
+        table = self.table()
+        table.set_headers(
+            [
+                "file / function",
+                "#ifdef",
+                "#if",
+                "#elif",
+                "#else",
+                "depth",
+                "macros",
+                "cond vars",
+                "cond fns",
+                "cond defines",
+                "dup sites",
+                "max branches",
+                "total branches",
+            ]
+        )
+        for result in results:
+            cond = result["conditional"]
+            table.add_row(
+                [
+                    result["file"],
+                    *self.count_cells(result),
+                    str(len(cond["vars"])),
+                    str(len(cond["functions"])),
+                    str(len(cond["defines"])),
+                    *self.site_cells(result),
+                ]
+            )
+            if self.option("functions"):
+                for fn in result["functions"]:
+                    table.add_row(
+                        [
+                            f"  {fn['name']}()",
+                            *self.count_cells(fn),
+                            "",
+                            "",
+                            "",
+                            *self.site_cells(fn),
+                        ]
+                    )
+        table.render()
+        return 0
+
+    @staticmethod
+    def count_cells(result: dict) -> list[str]:
+        return [
+            str(result["ifdefs"]),
+            str(result["ifs"]),
+            str(result["elifs"]),
+            str(result["elses"]),
+            str(result["max_depth"]),
+            str(len(result["macros"])),
+        ]
+
+    @staticmethod
+    def site_cells(result: dict) -> list[str]:
+        return [
+            str(result["duplicated_sites"]),
+            str(result["max_branches"]),
+            str(result["total_branches"]),
+        ]
@@ -0,0 +1,117 @@
+"""
+Telemetry of patch runs, to tell whether a batch is bound by I/O, CPU or memory.
+
+Each patched file gets a JSON-lines record with its size, the time spent in each phase
+and the resources used, and the run ends with an aggregate record of its throughput
+and latency percentiles.
+"""
+
+from typing import Any, List, Optional, TextIO
+import json
+import math
+import resource
+import time
+import rt_preproc.parser.ast as ast
+
+phases = ("parse", "reify", "patch", "print")
+"""
+The phases of patching a file, each record has their time as `<phase>_s`,
+along with the time to read the source and write the output (`read_s`, `write_s`).
+"""
+
+
+def new_record(file: str, source: bytes) -> dict[str, Any]:
+    """
+    The record of patching `file`, the phases fill it in as they go.
+    """
+    record: dict[str, Any] = {"type": "file", "file": file, "bytes": len(source)}
+    for phase in ("read", *phases, "write"):
+        record[f"{phase}_s"] = 0.0
+    return record
+
+
+def finish_record(record: dict[str, Any], start: float, error: Optional[str]) -> None:
+    """
+    Complete the record of a file that started being read at `start` (a `time.perf_counter()`).
+    """
+    record["total_s"] = time.perf_counter() - start
+    record["peak_rss_kb"] = peak_rss_kb()
+    record["error"] = error
+
+
+def peak_rss_kb() -> int:
+    """
+    Peak resident set size of this process so far, in kilobytes.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def count_nodes(root: ast.AstNode) -> int:
+    count = 0
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        count += 1
+        stack.extend(node.children)
+    return count
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    """
+    Nearest-rank percentile of `values`, None if there are none.
+    """
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+class Telemetry:
+    """
+    Writes the records of a run to a JSON-lines file as they come, then their aggregate.
+    """
+
+    def __init__(self, out: TextIO) -> None:
+        self.out = out
+        self.records: List[dict[str, Any]] = []
+        self.start = time.perf_counter()
+
+    def add(self, record: dict[str, Any]) -> None:
+        self.records.append(record)
+        self.out.write(json.dumps(record) + "\n")
+        self.out.flush()
+
+    def finish(self, unchanged: int = 0) -> dict[str, Any]:
+        """
+        Write the aggregate of the records, `unchanged` counts the files skipped as up to date.
+        """
+        wall = time.perf_counter() - self.start
+        patched = [record for record in self.records if record.get("error") is None]
+        latencies = [record["total_s"] for record in patched]
+        total_bytes = sum(record["bytes"] for record in patched)
+        aggregate = {
+            "type": "aggregate",
+            "files": len(patched),
+            "failed": len(self.records) - len(patched),
+            "unchanged": unchanged,
+            "bytes": total_bytes,
+            "wall_s": wall,
+            "files_per_s": len(patched) / wall if wall > 0 else None,
+            "mb_per_s": total_bytes / 1e6 / wall if wall > 0 else None,
+            "latency_s": {
+                "p50": percentile(latencies, 0.5),
+                "p95": percentile(latencies, 0.95),
+                "p99": percentile(latencies, 0.99),
+            },
+            "phase_s": {
+                phase: sum(record[f"{phase}_s"] for record in self.records)
+                for phase in ("read", *phases, "write")
+            },
+            "cache_hits": sum(1 for record in patched if record.get("cache_hit")),
+            "peak_rss_kb": max(
+                [record["peak_rss_kb"] for record in self.records] + [peak_rss_kb()]
+            ),
+        }
+        self.out.write(json.dumps(aggregate) + "\n")
+        self.out.flush()
+        return aggregate
@@ -0,0 +1,122 @@
+from typing import Dict, Tuple
+import os
+import time
+from cleo.helpers import argument, option
+from rt_preproc.cli.incremental import IncrementalPatcher
+from rt_preproc.cli.patch_cmd import PatchCmd, patch_options
+from rt_preproc.cli.stats_cmd import find_c_files
+
+
+class WatchCmd(PatchCmd):
+    name = "watch"
+    description = (
+        "Patch files again as they change, only re-patching the declarations affected by an edit"
+    )
+    arguments = [
+        argument(
+            "paths",
+            description="C files or directories (searched recursively) to watch",
+            multiple=True,
+        )
+    ]
+    options = [
+        option(
+            "output",
+            "o",
+            description="Directory to write the patched files to, under their path relative to the watched paths",
+            flag=False,
+        ),
+        *patch_options,
+        option(
+            "interval",
+            description="Seconds between checks for changed files (default 0.2)",
+            flag=False,
+        ),
+    ]
+
+    def watched_root(self) -> str:
+        """
+        The directory containing all the watched paths, outputs go under their path relative to it.
+        """
+        return os.path.commonpath(
+            [
+                os.path.abspath(path if os.path.isdir(path) else os.path.dirname(path) or ".")
+                for path in self.argument("paths")
+            ]
+        )
+
+    def scan(self, output_dir: str) -> Dict[str, Tuple[int, int]]:
+        """
+        The watched files (except the outputs) and their modification time and size.
+        """
+        output_dir = os.path.abspath(output_dir)
+        files = {}
+        for file in find_c_files(self.argument("paths")):
+            if os.path.abspath(file).startswith(output_dir + os.sep):
+                continue
+            try:
+                stat = os.stat(file)
+            except OSError:
+                continue
+            files[file] = (stat.st_mtime_ns, stat.st_size)
+        return files
+
+    def update(self, file: str, patcher: IncrementalPatcher, output_path: str) -> bool:
+        """
+        Patch the current version of `file` into `output_path`. Returns whether it succeeded.
+        """
+        start = time.perf_counter()
+        try:
+            with open(file, mode="rb") as f:
+                source = f.read()
+            patched = patcher.update(source)
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            with open(output_path, "w") as f:
+                f.write(patched)
+        except Exception as e:
+            self.line_error(f"{file}: {type(e).__name__}: {e}")
+            return False
+        elapsed = (time.perf_counter() - start) * 1000
+        self.line(
+            f"{file}: re-patched {patcher.repatched} of {len(patcher.items)}"
+            f" top-level declarations in {elapsed:.1f} ms"
+        )
+        self.report_degraded_sites(file, patcher.degraded_sites)
+        return True
+
+    def handle(self):
+        output_dir = self.option("output")
+        if output_dir is None:
+            self.line_error("Missing --output, the directory to write the patched files to")
+            return 1
+        options = self.build_options()
+        if options is None:
+            return 1
+        interval = self.option("interval")
+        interval = float(interval) if interval is not None else 0.2
+        root = self.watched_root()
+
+        patchers: Dict[str, IncrementalPatcher] = {}
+        stats: Dict[str, Tuple[int, int]] = {}
+        self.line(f"Watching {', '.join(self.argument('paths'))}, Ctrl-C to stop")
+        try:
+            while True:
+                current = self.scan(output_dir)
+                for file, stat in current.items():
+                    if stats.get(file) == stat:
+                        continue
+                    if file not in patchers:
+                        patchers[file] = IncrementalPatcher(options)
+                    patcher = patchers[file]
+                    output_path = os.path.join(
+                        output_dir, os.path.relpath(os.path.abspath(file), root)
+                    )
+                    if not self.update(file, patcher, output_path):
+                        # start over from the next version
+                        del patchers[file]
+                for file in stats.keys() - current.keys():
+                    patchers.pop(file, None)
+                stats = current
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            return 0
@@ -1,4 +1,4 @@
-from typing import Union, Optional, List, Self
+from typing import Union, Optional, List, Self, Tuple
 from tree_sitter import Node as BaseTsNode
 from rt_preproc.parser.base import INode
 from rt_preproc.visitors.base import IVisitor, IVisitorCtx
@@ -9,6 +9,10 @@ class AstNode(INode):
     This will be None in those cases.
     """
     parent: Optional[Self]
+    """
+    The node this was reified under, or last attached to with `replace_child`/`insert_children`.
+    Copies start detached, and subtrees shared between copies keep pointing to the original parent.
+    """
     field_names: List[str]
     children: List[Self]
     children_named_idxs: List[Optional[int]]
@@ -21,6 +25,58 @@ class AstNode(INode):
     """
     This is only defined on leaf nodes.
     """
+    start_byte: Optional[int]
+    end_byte: Optional[int]
+    """
+    Byte range in the source this node was reified from, None for generated nodes.
+    """
+    start_row: Optional[int]
+    """
+    0-based source line of `start_byte`, kept so trees without a `base_node`
+    (loaded from the cache or sent back by a worker) can still report it.
+    """
+    source: Optional[bytes]
+    """
+    The source the trivia ranges below are into, shared by the whole reified tree.
+    """
+    trivia_start: Optional[int]
+    trivia_end: Optional[int]
+    """
+    Range of the whitespace in the source that comes before this node in its parent.
+    """
+    trailing_start: Optional[int]
+    """
+    Start of the whitespace in the source between the last child and the end of this node.
+    """
+    _modified: bool
+    """
+    Set on a node and its ancestors by the rewrite methods. A node with a byte range
+    that isn't modified is still exactly its original source, see `is_original`.
+    """
+    _shared: bool
+    """
+    Set by `shallow_copy` on the children it shares, which are then in two trees (though
+    `parent` only links to the first). The edit methods copy such a node on write before
+    changing its children, giving it a new parent or moving its trivia, so the other tree
+    keeps all three, see `writable`.
+    """
+    _fields: dict[str, Self]
+    """
+    Field name -> child, for the children the grammar gives a field name, ie: `body`.
+    """
+    _named_positions: Optional[List[int]]
+    """
+    Named child index -> index in children, lazily built from `children_named_idxs`
+    and rebuilt when a lookup finds it stale, so rewrites of the children stay safe.
+    """
+    _ident_index: Optional[dict[str, List[Tuple[int, ...]]]]
+    """
+    Lazily built by `ident_index`, None until first use or until `mark_modified`.
+    """
+    _variability: Optional["Variability"]
+    """
+    Lazily built by `variability`, None until first use or until `mark_modified`.
+    """
 
     def __init__(self, text: Optional[str] = None) -> None:
         self.base_node = None
@@ -28,24 +84,191 @@ class AstNode(INode):
         self.children = []
         self.children_named_idxs = []
         self.text = text
+        self.start_byte = None
+        self.end_byte = None
+        self.start_row = None
+        self.source = None
+        self.trivia_start = None
+        self.trivia_end = None
+        self.trailing_start = None
+        self._modified = False
+        self._shared = False
+        self._fields = {}
+        self._named_positions = None
+        self._ident_index = None
+        self._variability = None
 
     def get_child_by_name(self, name: str) -> Optional[Self]:
         """
-        Get a child by name.
+        Get a child by field name, or None if this node has no such field.
+        """
+        return self._fields.get(name)
+
+    def named_position(self, named_index: int) -> int:
+        """
+        Index in children of a named child.
         """
-        return self.base_node.child_by_field_name(name) if self.base_node is not None else None
+        positions = self._named_positions
+        if positions is not None and named_index < len(positions):
+            pos = positions[named_index]
+            if (
+                pos < len(self.children_named_idxs)
+                and self.children_named_idxs[pos] == named_index
+            ):
+                return pos
+        positions = []
+        for pos, idx in enumerate(self.children_named_idxs):
+            # keep the first one, like list.index
+            if idx is not None and idx == len(positions):
+                positions.append(pos)
+        self._named_positions = positions
+        if named_index >= len(positions):
+            raise ValueError(f"{type(self).__name__} has no named child {named_index}")
+        return positions[named_index]
 
     def get_named_child(self, named_index: int) -> Optional[Self]:
         """
         Get a named child by index.
         """
-        return self.children[self.children_named_idxs.index(named_index)]
+        return self.children[self.named_position(named_index)]
 
     def set_named_child(self, named_index: int, child: Self) -> None:
         """
         Set a named child by index.
         """
-        self.children[self.children_named_idxs.index(named_index)] = child
+        pos = self.named_position(named_index)
+        self.replace_child(pos, child)
+
+    def replace_child(self, pos: int, child: Self) -> None:
+        """
+        Replace the child at `pos` in children, keeping its field name and named index.
+        """
+        old = self.children[pos]
+        if child is old:
+            return
+        node = self.writable()
+        child = node.own(child, moves_trivia=True)
+        node.children[pos] = child
+        child.parent = node
+        child.inherit_trivia(old)
+        node.mark_modified()
+        for name, field_child in node._fields.items():
+            if field_child is old:
+                node._fields[name] = child
+                break
+
+    def insert_children(self, pos: int, children: List[Self]) -> None:
+        """
+        Insert unnamed children at `pos` in children, before the trivia of the child there.
+        """
+        if len(children) == 0:
+            return
+        node = self.writable()
+        children = [node.own(child) for child in children]
+        node.children[pos:pos] = children
+        node.children_named_idxs[pos:pos] = [None] * len(children)
+        for child in children:
+            child.parent = node
+        node.mark_modified()
+
+    def own(self, child: Self, moves_trivia: bool = False) -> Self:
+        """
+        `child` to place in the children of this node, or a copy of it if it's shared
+        with another tree and placing it would change its parent there,
+        or its trivia when they're about to move (`moves_trivia`).
+        """
+        if child._shared and (moves_trivia or child.parent is not self):
+            return child.owning_copy()
+        return child
+
+    def writable(self) -> Self:
+        """
+        This node, or if it's shared with another tree, a copy of it (see `owning_copy`)
+        put in its place under `parent`, so that an edit of the copy leaves the other trees
+        as they were. The edit methods go through this, and so should any code that
+        changes the children directly; keep using the node it returns.
+        """
+        if not self._shared or self.parent is None:
+            return self
+        parent = self.parent
+        for pos, child in enumerate(parent.children):
+            if child is self:
+                copy = self.owning_copy()
+                parent.replace_child(pos, copy)
+                return copy
+        # nothing links to it through `parent` any more, only the trees sharing it
+        return self
+
+    def owning_copy(self) -> Self:
+        """
+        A `shallow_copy` that its children have as parent, so edits of them
+        mark the copy and its ancestors as modified rather than this node.
+        """
+        new_node = self.shallow_copy()
+        for child in new_node.children:
+            child.parent = new_node
+        return new_node
+
+    def leading_trivia(self) -> str:
+        """
+        The whitespace that comes before this node in its parent.
+        """
+        if self.trivia_start is None or self.trivia_start == self.trivia_end:
+            return ""
+        return self.source[self.trivia_start : self.trivia_end].decode()
+
+    def trailing_trivia(self) -> str:
+        """
+        The whitespace between the last child and the end of this node.
+        """
+        if self.trailing_start is None or self.trailing_start == self.end_byte:
+            return ""
+        return self.source[self.trailing_start : self.end_byte].decode()
+
+    def inherit_trivia(self, old: Self) -> None:
+        """
+        Take the leading trivia of `old` when replacing it, unless this node has its own.
+        """
+        if self.trivia_start is None and old.trivia_start is not None:
+            self.source = old.source
+            self.trivia_start = old.trivia_start
+            self.trivia_end = old.trivia_end
+
+    def give_trivia(self, inserted: Self) -> None:
+        """
+        Move the leading trivia of this node to `inserted`, which is inserted right before it,
+        so the inserted nodes go after the whitespace, ie: after the end of a line comment.
+        """
+        if self.trivia_start is None or inserted.trivia_start is not None:
+            return
+        inserted.inherit_trivia(self)
+        # an empty range that still marks where this node is in the source
+        self.trivia_start = self.trivia_end
+
+    def mark_modified(self) -> None:
+        """
+        Mark this node and its ancestors as no longer matching their original source,
+        and drop the `ident_index` and `variability` they cached, since they cover this node.
+        Call this after editing the children directly rather than through the rewrite methods.
+        """
+        node = self
+        while node is not None:
+            node._modified = True
+            node._ident_index = None
+            node._variability = None
+            node = node.parent
+
+    def is_original(self) -> bool:
+        """
+        Whether this node prints exactly as its original source bytes.
+        """
+        return self.start_byte is not None and not self._modified
+
+    def edit_children(self) -> "ChildEdits":
+        """
+        Start a batch of edits to the children, see `ChildEdits`.
+        """
+        return ChildEdits(self)
 
     def accept(self, visitor: IVisitor, ctx: IVisitorCtx):
         return visitor.visit(self, ctx)
@@ -53,7 +276,9 @@ class AstNode(INode):
     def print(self):
         if len(self.children) > 0:
             for child in self.children:
+                print(child.leading_trivia(), end="")
                 child.print()
+            print(self.trailing_trivia(), end="")
         else:  # leaf node
             print(self.text, end="")
 
@@ -61,98 +286,343 @@ class AstNode(INode):
         buf = ""
         if len(self.children) > 0:
             for child in self.children:
+                buf += child.leading_trivia()
                 buf += str(child)
+            buf += self.trailing_trivia()
         else:  # leaf node
             buf += self.text
         return buf
 
     @staticmethod
-    def reify(base_node: BaseTsNode, include_whitespace: bool = True) -> "AstNode":
+    def reify(
+        base_node: BaseTsNode,
+        include_whitespace: bool = True,
+        source: Optional[bytes] = None,
+    ) -> "AstNode":
         """
         Reify a tree_sitter Node into an AstNode, and recurse for all children.
-        This will also include whitespace nodes if include_whitespace is True.
+        If include_whitespace is True, the whitespace between the nodes is recorded as
+        trivia ranges into `source` (the parsed bytes, by default the text of `base_node`).
         """
+        if include_whitespace and source is None:
+            # offsets are into the whole source, so pad up to where the node starts
+            source = bytes(base_node.start_byte) + base_node.text
+        return AstNode._reify(base_node, source if include_whitespace else None)
+
+    @staticmethod
+    def _reify(base_node: BaseTsNode, source: Optional[bytes]) -> "AstNode":
         ast_node = (
             type_name_to_class[base_node.type]()
             if base_node.type in type_name_to_class
             else Unnamed()
         )
         ast_node.base_node = base_node
-        # TODO: don't duplicate the work, use the children_named_idxs list
-
-        for i, child in enumerate(base_node.children):
-            if include_whitespace and i > 0:
-                cur_start_line, cur_start_col = child.start_point
-                prev_end_line, prev_end_col = base_node.children[i - 1].end_point
-                # if the previous child ends before the current child starts
-                if prev_end_line < cur_start_line:
-                    ast_node.children.append(
-                        Whitespace("\n" * (cur_start_line - prev_end_line))
-                    )
-                    if cur_start_col > 0:
-                        ast_node.children.append(Whitespace(" " * cur_start_col))
-                elif prev_end_col < cur_start_col:
-                    ast_node.children.append(
-                        Whitespace(" " * (cur_start_col - prev_end_col))
-                    )
-            ast_node.children.append(AstNode.reify(child, include_whitespace))
-        # if the last child ends before the parent base node ends
-        if include_whitespace and len(base_node.children) > 0:
-            par_end_line, par_end_col = base_node.end_point
-            last_end_line, last_end_col = base_node.children[-1].end_point
-            if last_end_line < par_end_line:
-                ast_node.children.append(
-                    Whitespace("\n" * (par_end_line - last_end_line))
-                )
-                if par_end_col > 0:
-                    ast_node.children.append(Whitespace(" " * par_end_col))
-            elif last_end_col < par_end_col:
-                ast_node.children.append(Whitespace(" " * (par_end_col - last_end_col)))
-
-        for child in ast_node.children:
-            ast_node.children_named_idxs.append(
-                next(
-                    (
-                        idx
-                        for idx, node in enumerate(base_node.named_children)
-                        if hasattr(child, "base_node")
-                        and child.base_node is not None
-                        and node.id == child.base_node.id
-                    ),
-                    None,
-                )
-            )
-        assert (
-            sum(1 for val in ast_node.children_named_idxs if val is not None)
-            == base_node.named_child_count
-        )
+        ast_node.start_byte = base_node.start_byte
+        ast_node.end_byte = base_node.end_byte
+        ast_node.start_row = base_node.start_point[0]
+
+        named_idx = 0
+        prev_end_byte = base_node.start_byte
+        # `field_name_for_child` is off by the children without a field before the first
+        # with one (ie: `static` before the type of a function), the cursor isn't
+        cursor = base_node.walk()
+        has_child = cursor.goto_first_child()
+        while has_child:
+            child = cursor.node
+            field_name = cursor.current_field_name()
+            has_child = cursor.goto_next_sibling()
+            child_node = AstNode._reify(child, source)
+            child_node.parent = ast_node
+            if source is not None:
+                child_node.source = source
+                child_node.trivia_start = prev_end_byte
+                child_node.trivia_end = child.start_byte
+            prev_end_byte = child.end_byte
+            ast_node.children.append(child_node)
+            if child.is_named:
+                ast_node.children_named_idxs.append(named_idx)
+                named_idx += 1
+            else:
+                ast_node.children_named_idxs.append(None)
+            if field_name is not None:
+                # the first one, like `child_by_field_name`
+                ast_node._fields.setdefault(field_name, child_node)
+        if source is not None and len(ast_node.children) > 0:
+            ast_node.source = source
+            ast_node.trailing_start = prev_end_byte
+
         if len(ast_node.children) == 0:
             ast_node.text = base_node.text.decode()
         else:
             ast_node.text = None
         return ast_node
-    
+
     def deepcopy(self) -> Self:
         """
         Deepcopy this node and all children.
         """
         new_node = type(self)()
         new_node.base_node = self.base_node
-        new_node.parent = self.parent
         new_node.field_names = self.field_names
         new_node.children = [child.deepcopy() for child in self.children]
-        new_node.children_named_idxs = self.children_named_idxs
+        new_node.children_named_idxs = list(self.children_named_idxs)
         new_node.text = self.text
+        new_node.start_byte = self.start_byte
+        new_node.end_byte = self.end_byte
+        new_node.start_row = self.start_row
+        new_node.source = self.source
+        new_node.trivia_start = self.trivia_start
+        new_node.trivia_end = self.trivia_end
+        new_node.trailing_start = self.trailing_start
+        new_node._modified = self._modified
+        copies = {id(old): new for old, new in zip(self.children, new_node.children)}
+        for child in new_node.children:
+            child.parent = new_node
+        new_node._fields = {
+            name: copies.get(id(child), child) for name, child in self._fields.items()
+        }
         return new_node
-    
-    def replace_ident(self, ident: str, replacement: str) -> None:
+
+    def shallow_copy(self) -> Self:
         """
-        Replace all Identifier instances of `ident` with `replacement` in this node and all children.
+        Copy this node, sharing its children with the original.
+        The children list itself is a new list, so it can be modified independently,
+        and the edit methods copy a shared node before changing it, see `writable`.
+        The children keep the original as parent.
         """
-        if isinstance(self, Identifier) and self.text == ident:
-            self.text = self.text.replace(ident, replacement)
+        new_node = type(self)()
+        new_node.base_node = self.base_node
+        new_node.field_names = self.field_names
+        new_node.children = list(self.children)
+        new_node.children_named_idxs = list(self.children_named_idxs)
+        new_node.text = self.text
+        new_node.start_byte = self.start_byte
+        new_node.end_byte = self.end_byte
+        new_node.start_row = self.start_row
+        new_node.source = self.source
+        new_node.trivia_start = self.trivia_start
+        new_node.trivia_end = self.trivia_end
+        new_node.trailing_start = self.trailing_start
+        new_node._modified = self._modified
+        new_node._fields = dict(self._fields)
         for child in self.children:
-            child.replace_ident(ident, replacement)
+            child._shared = True
+        return new_node
+
+    def ident_index(self) -> dict[str, List[Tuple[int, ...]]]:
+        """
+        Index from identifier text to the paths (child indices from this node)
+        of every Identifier instance in this node's subtree.
+        This is built on first use and cached on the node,
+        until an edit of the subtree calls `mark_modified`.
+        """
+        if self._ident_index is None:
+            index: dict[str, List[Tuple[int, ...]]] = {}
+            stack: List[Tuple[AstNode, Tuple[int, ...]]] = [(self, ())]
+            while stack:
+                node, path = stack.pop()
+                if isinstance(node, Identifier):
+                    index.setdefault(node.text, []).append(path)
+                    continue
+                for i in range(len(node.children) - 1, -1, -1):
+                    stack.append((node.children[i], path + (i,)))
+            self._ident_index = index
+        return self._ident_index
+
+    def variability(self) -> "Variability":
+        """
+        Summary of what this subtree contains that the patcher may need to rewrite.
+        This is computed bottom-up and cached on every node of the subtree,
+        until an edit below a node calls `mark_modified`, so only the edited path is recomputed.
+        """
+        if self._variability is None:
+            has_preproc = isinstance(self, variability_preproc_types)
+            has_declaration = isinstance(self, Declaration)
+            has_function = isinstance(self, FunctionDefinition)
+            idents = (
+                frozenset((self.text,)) if isinstance(self, Identifier) else frozenset()
+            )
+            for child in self.children:
+                child_var = child.variability()
+                has_preproc = has_preproc or child_var.has_preproc
+                has_declaration = has_declaration or child_var.has_declaration
+                has_function = has_function or child_var.has_function
+                # share the child's set when it's a superset, which is the common case
+                if not child_var.idents <= idents:
+                    idents = (
+                        child_var.idents
+                        if idents <= child_var.idents
+                        else idents | child_var.idents
+                    )
+            if has_preproc or has_declaration or has_function or len(idents) > 0:
+                self._variability = Variability(
+                    has_preproc, has_declaration, has_function, idents
+                )
+            else:
+                self._variability = Variability.PLAIN
+        return self._variability
+
+    def rename_idents(self, renames: dict[str, str]) -> Self:
+        """
+        Copy-on-write rename of all Identifier instances in `renames` (original name -> new name).
+        Subtrees without a renamed Identifier are shared with the original tree,
+        and only the nodes on the path from this node down to each renamed Identifier are cloned.
+        Returns this node itself if nothing was renamed.
+        """
+        index = self.ident_index()
+        paths = [path for name in renames for path in index.get(name, ())]
+        if len(paths) == 0:
+            return self
+        return self._copy_along_paths(sorted(paths), 0, renames)
+
+    def _copy_along_paths(
+        self, paths: List[Tuple[int, ...]], depth: int, renames: dict[str, str]
+    ) -> Self:
+        new_node = self.shallow_copy()
+        if isinstance(self, Identifier):
+            new_node.text = renames[self.text]
+            new_node.mark_modified()
+            return new_node
+        # paths are sorted, so the ones going through the same child are adjacent
+        start = 0
+        while start < len(paths):
+            child_idx = paths[start][depth]
+            end = start + 1
+            while end < len(paths) and paths[end][depth] == child_idx:
+                end += 1
+            new_node.replace_child(
+                child_idx,
+                self.children[child_idx]._copy_along_paths(
+                    paths[start:end], depth + 1, renames
+                ),
+            )
+            start = end
+        return new_node
+
+
+class ChildEdits:
+    """
+    Inserts, replacements and deletes of the children of a node, recorded against
+    the positions the children had when the batch started, and applied in a single
+    splice by `apply`. Replacements take the trivia of the child they replace,
+    and inserted children go after the trivia of the child they precede.
+    Until then the children list is left untouched, so the positions stay valid
+    while iterating over it.
+    """
+
+    def __init__(self, node: AstNode) -> None:
+        self.node = node
+        self.inserts: dict[int, List[AstNode]] = {}
+        """Position -> unnamed children inserted before the child at that position."""
+        self.replacements: dict[int, AstNode] = {}
+        self.deletes: set[int] = set()
+
+    def insert(self, pos: int, children: List[AstNode]) -> None:
+        """
+        Insert unnamed children before the child at `pos` (or at the end if it's the length).
+        """
+        self.inserts.setdefault(pos, []).extend(children)
+
+    def replace(self, pos: int, child: AstNode) -> None:
+        """
+        Replace the child at `pos`, keeping its field name and named index.
+        """
+        if child is not self.node.children[pos]:
+            self.replacements[pos] = child
+
+    def delete(self, pos: int) -> None:
+        self.deletes.add(pos)
+
+    def is_empty(self) -> bool:
+        return not (self.inserts or self.replacements or self.deletes)
+
+    def apply(self) -> None:
+        """
+        Rebuild the children with every recorded edit, in one pass over them.
+        Named children after a deleted one are renumbered.
+        """
+        if self.is_empty():
+            return
+        node = self.node = self.node.writable()
+        children: List[AstNode] = []
+        named_idxs: List[Optional[int]] = []
+        replaced: dict[int, AstNode] = {}
+        named_idx = 0
+        for pos in range(len(node.children) + 1):
+            old = node.children[pos] if pos < len(node.children) else None
+            child = self.replacements.get(pos, old)
+            inserted = self.inserts.get(pos)
+            if child is not None:
+                # its trivia move if it replaces `old`, or to the first inserted child
+                child = node.own(child, moves_trivia=child is not old or bool(inserted))
+            if child is not old:
+                child.inherit_trivia(old)
+            if inserted is not None and len(inserted) > 0:
+                inserted = [
+                    node.own(new, moves_trivia=k == 0) for k, new in enumerate(inserted)
+                ]
+                if child is not None:
+                    child.give_trivia(inserted[0])
+                children.extend(inserted)
+                named_idxs.extend([None] * len(inserted))
+            if old is None:
+                break
+            if pos in self.deletes:
+                replaced[id(old)] = None
+                continue
+            if child is not old:
+                replaced[id(old)] = child
+            children.append(child)
+            # nodes built by the patcher may not have named indexes for all their children
+            if pos >= len(node.children_named_idxs) or node.children_named_idxs[pos] is None:
+                named_idxs.append(None)
+            else:
+                named_idxs.append(named_idx)
+                named_idx += 1
+        for child in children:
+            child.parent = node
+        if len(replaced) > 0 and len(node._fields) > 0:
+            fields = {}
+            for name, child in node._fields.items():
+                child = replaced.get(id(child), child)
+                if child is not None:
+                    fields[name] = child
+            node._fields = fields
+        node.children = children
+        node.children_named_idxs = named_idxs
+        node.mark_modified()
+        self.inserts = {}
+        self.replacements = {}
+        self.deletes = set()
+
+
+class Variability:
+    """
+    Bottom-up summary of a subtree, see `AstNode.variability`.
+    """
+
+    __slots__ = ("has_preproc", "has_declaration", "has_function", "idents")
+    PLAIN: "Variability"
+    """
+    Shared summary for subtrees with nothing in them at all.
+    """
+
+    def __init__(
+        self,
+        has_preproc: bool,
+        has_declaration: bool,
+        has_function: bool,
+        idents: frozenset[str],
+    ) -> None:
+        self.has_preproc = has_preproc
+        """Contains a preprocessor conditional or macro definition."""
+        self.has_declaration = has_declaration
+        self.has_function = has_function
+        self.idents = idents
+        """Text of every Identifier in the subtree."""
+
+
+Variability.PLAIN = Variability(False, False, False, frozenset())
 
 
 # Generated code below:
@@ -1352,3 +1822,13 @@ type_name_to_class = {
     "true": True,
     "type_identifier": TypeIdentifier,
 }
+
+variability_preproc_types = (
+    PreprocIf,
+    PreprocIfdef,
+    PreprocElif,
+    PreprocElifdef,
+    PreprocElse,
+    PreprocDef,
+    PreprocFunctionDef,
+)
@@ -1,3 +1,4 @@
+from typing import Optional
 from tree_sitter import Parser as TSParser, Tree
 from rt_preproc.parser import C_LANGUAGE
 
@@ -8,9 +9,14 @@ class Parser:
         parser.set_language(C_LANGUAGE)
         self.parser = parser
 
-    def parse(self, bytes) -> Tree:
-        tree = self.parser.parse(bytes)
-        return tree
+    def parse(self, bytes, old_tree: Optional[Tree] = None) -> Tree:
+        """
+        Parse `bytes`, reusing the unchanged parts of `old_tree` if given,
+        which must have been edited (`Tree.edit`) to match them.
+        """
+        if old_tree is None:
+            return self.parser.parse(bytes)
+        return self.parser.parse(bytes, old_tree)
 
     def query(self, tree: Tree) -> list[str]:
         query = """
@@ -0,0 +1,301 @@
+"""
+Binary encoding of reified AstNode trees.
+
+Reification is pure with respect to the input bytes and the grammar,
+so the reified tree can be cached on disk or shipped to another process
+without pickling every node object.
+The encoding isn't small: it's 38 bytes per node plus each distinct leaf text once,
+several times the size of the source. It only saves reparsing and reifying.
+
+Layout (all integers little endian):
+    header:   magic, format version, grammar id, node count, string count
+    strings:  u32 byte length per string, then the utf-8 bytes of all strings
+    kinds:    u16 per node, index into `KIND_CLASSES`
+    texts:    u32 per node, index into the string table (NO_TEXT for non-leaves)
+    named:    i32 per node, the node's named child index in its parent (-1 if not named)
+    fields:   u32 per node, index into the string table of the node's field name
+              in its parent (NO_TEXT if it has none)
+    ranges:   u32 per node for the start byte, then u32 per node for the end byte
+              of the node in the source (NO_BYTE for generated nodes)
+    rows:     u32 per node, the 0-based source line of the start byte (NO_BYTE if none)
+    trivia:   u32 per node for the start of its leading trivia, then u32 per node for the
+              start of its trailing trivia (NO_BYTE if it has none), the trivia end
+              where the node and its parent start and end
+    offsets:  u32 per node + 1, nodes are stored in breadth-first order,
+              so the children of node k are the nodes offsets[k] .. offsets[k + 1]
+
+Loaded trees have no tree-sitter `base_node`, their parent links, field tables
+and `start_row`s are restored, and their trivia are into the source passed to `loads`.
+"""
+
+from array import array
+from typing import List, Optional, Tuple
+import hashlib
+import inspect
+import os
+import struct
+import sys
+import time
+
+import rt_preproc.parser.ast as ast
+from rt_preproc.parser.parser import Parser
+
+MAGIC = b"RTPA"
+FORMAT_VERSION = 6
+NO_TEXT = 0xFFFFFFFF
+NO_BYTE = 0xFFFFFFFF
+
+_header = struct.Struct("<4sH16sII")
+
+KIND_CLASSES: List[type] = sorted(
+    (
+        cls
+        for cls in vars(ast).values()
+        if inspect.isclass(cls) and issubclass(cls, ast.AstNode)
+    ),
+    key=lambda cls: cls.__name__,
+)
+"""Every node class in the ast module, sorted by name so the ids are stable."""
+_kind_ids = {cls: i for i, cls in enumerate(KIND_CLASSES)}
+
+_grammar_id: Optional[bytes] = None
+
+
+class FormatError(Exception):
+    pass
+
+
+def grammar_id() -> bytes:
+    """
+    Fingerprint of the node classes and the compiled grammar library.
+    Encoded trees are only loaded back with the same fingerprint.
+    """
+    global _grammar_id
+    if _grammar_id is None:
+        digest = hashlib.sha256()
+        digest.update(" ".join(cls.__name__ for cls in KIND_CLASSES).encode())
+        # this is the library built in rt_preproc.parser
+        with open("build/my-languages.so", "rb") as f:
+            digest.update(f.read())
+        _grammar_id = digest.digest()[:16]
+    return _grammar_id
+
+
+def _to_le(arr: array) -> bytes:
+    if sys.byteorder != "little":
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def _from_le(typecode: str, buf: memoryview, count: int, pos: int) -> Tuple[array, int]:
+    arr = array(typecode)
+    end = pos + count * arr.itemsize
+    if end > len(buf):
+        raise FormatError("truncated AST encoding")
+    arr.frombytes(buf[pos:end])
+    if sys.byteorder != "little":
+        arr.byteswap()
+    return arr, end
+
+
+def dumps(root: ast.AstNode) -> bytes:
+    """
+    Encode the tree under `root`.
+    """
+    strings: List[bytes] = []
+    string_ids: dict[str, int] = {}
+    kinds = array("H")
+    texts = array("I")
+    named = array("i")
+    fields = array("I")
+    starts = array("I")
+    ends = array("I")
+    rows = array("I")
+    trivia_starts = array("I")
+    trailing_starts = array("I")
+    offsets = array("I")
+
+    def string_id(text: str) -> int:
+        text_id = string_ids.get(text)
+        if text_id is None:
+            text_id = len(strings)
+            string_ids[text] = text_id
+            strings.append(text.encode())
+        return text_id
+
+    # breadth-first, so each node's children are contiguous
+    order: List[ast.AstNode] = [root]
+    named.append(-1)
+    fields.append(NO_TEXT)
+    k = 0
+    while k < len(order):
+        node = order[k]
+        kinds.append(_kind_ids[type(node)])
+        texts.append(NO_TEXT if node.text is None else string_id(node.text))
+        starts.append(NO_BYTE if node.start_byte is None else node.start_byte)
+        ends.append(NO_BYTE if node.end_byte is None else node.end_byte)
+        rows.append(NO_BYTE if node.start_row is None else node.start_row)
+        trivia_starts.append(NO_BYTE if node.trivia_start is None else node.trivia_start)
+        trailing_starts.append(
+            NO_BYTE if node.trailing_start is None else node.trailing_start
+        )
+        offsets.append(len(order))
+        order.extend(node.children)
+        named.extend(-1 if idx is None else idx for idx in node.children_named_idxs)
+        field_ids = {id(child): string_id(name) for name, child in node._fields.items()}
+        fields.extend(field_ids.get(id(child), NO_TEXT) for child in node.children)
+        k += 1
+    offsets.append(len(order))
+
+    lengths = array("I", (len(s) for s in strings))
+    return b"".join(
+        [
+            _header.pack(MAGIC, FORMAT_VERSION, grammar_id(), len(order), len(strings)),
+            _to_le(lengths),
+            *strings,
+            _to_le(kinds),
+            _to_le(texts),
+            _to_le(named),
+            _to_le(fields),
+            _to_le(starts),
+            _to_le(ends),
+            _to_le(rows),
+            _to_le(trivia_starts),
+            _to_le(trailing_starts),
+            _to_le(offsets),
+        ]
+    )
+
+
+def loads(data: bytes, source: Optional[bytes] = None) -> ast.AstNode:
+    """
+    Decode a tree encoded by `dumps`, from a tree reified from `source`.
+    Raises FormatError if it was encoded by a different format version or grammar.
+    """
+    buf = memoryview(data)
+    if len(buf) < _header.size:
+        raise FormatError("truncated AST encoding")
+    magic, version, grammar, node_count, string_count = _header.unpack_from(buf)
+    if magic != MAGIC:
+        raise FormatError("not an AST encoding")
+    if version != FORMAT_VERSION or grammar != grammar_id():
+        raise FormatError("AST encoding is from a different version or grammar")
+
+    pos = _header.size
+    lengths, pos = _from_le("I", buf, string_count, pos)
+    strings: List[str] = []
+    for length in lengths:
+        strings.append(str(buf[pos : pos + length], "utf-8"))
+        pos += length
+    kinds, pos = _from_le("H", buf, node_count, pos)
+    texts, pos = _from_le("I", buf, node_count, pos)
+    named, pos = _from_le("i", buf, node_count, pos)
+    fields, pos = _from_le("I", buf, node_count, pos)
+    starts, pos = _from_le("I", buf, node_count, pos)
+    ends, pos = _from_le("I", buf, node_count, pos)
+    rows, pos = _from_le("I", buf, node_count, pos)
+    trivia_starts, pos = _from_le("I", buf, node_count, pos)
+    trailing_starts, pos = _from_le("I", buf, node_count, pos)
+    offsets, pos = _from_le("I", buf, node_count + 1, pos)
+
+    nodes: List[ast.AstNode] = []
+    for kind, text_id, start, end, row, trivia_start, trailing_start in zip(
+        kinds, texts, starts, ends, rows, trivia_starts, trailing_starts
+    ):
+        cls = KIND_CLASSES[kind]
+        # skip __init__, every attribute is set here
+        node = cls.__new__(cls)
+        node.base_node = None
+        node.parent = None
+        node.text = None if text_id == NO_TEXT else strings[text_id]
+        node.start_byte = None if start == NO_BYTE else start
+        node.end_byte = None if end == NO_BYTE else end
+        node.start_row = None if row == NO_BYTE else row
+        node.source = None
+        node.trivia_start = node.trivia_end = None
+        node.trailing_start = None
+        if source is not None:
+            if trivia_start != NO_BYTE:
+                node.source = source
+                node.trivia_start, node.trivia_end = trivia_start, start
+            if trailing_start != NO_BYTE:
+                node.source = source
+                node.trailing_start = trailing_start
+        node._modified = False
+        node._shared = False
+        node._fields = {}
+        node._named_positions = None
+        node._ident_index = None
+        node._variability = None
+        nodes.append(node)
+    for k, node in enumerate(nodes):
+        start, end = offsets[k], offsets[k + 1]
+        node.children = nodes[start:end]
+        node.children_named_idxs = [
+            None if idx < 0 else idx for idx in named[start:end]
+        ]
+        for child_k in range(start, end):
+            nodes[child_k].parent = node
+            if fields[child_k] != NO_TEXT:
+                node._fields[strings[fields[child_k]]] = nodes[child_k]
+    return nodes[0]
+
+
+class ReifyCache:
+    """
+    On-disk cache of reified trees, keyed by the source bytes.
+    The grammar fingerprint is checked when loading, so stale entries are just misses.
+    """
+
+    def __init__(self, cache_dir: str) -> None:
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, source: bytes) -> str:
+        return os.path.join(
+            self.cache_dir, hashlib.sha256(source).hexdigest() + ".ast"
+        )
+
+    def load(self, source: bytes) -> Optional[ast.AstNode]:
+        try:
+            with open(self.path(source), "rb") as f:
+                return loads(f.read(), source)
+        except (OSError, FormatError):
+            return None
+
+    def store(self, source: bytes, root: ast.AstNode) -> None:
+        path = self.path(source)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(dumps(root))
+        # atomic, so concurrent runs never see a partial entry
+        os.replace(tmp_path, path)
+
+
+def reify_source(
+    source: bytes, cache_dir: Optional[str] = None, record: Optional[dict] = None
+) -> Tuple[ast.AstNode, bool]:
+    """
+    Parse and reify `source`, going through the on-disk cache if `cache_dir` is set.
+    Returns the root node and whether it was served from the cache.
+    If given, `record` gets the seconds spent parsing (`parse_s`) and reifying
+    or loading from the cache (`reify_s`).
+    """
+    start = time.perf_counter()
+    cache = ReifyCache(cache_dir) if cache_dir is not None else None
+    if cache is not None:
+        root = cache.load(source)
+        if root is not None:
+            if record is not None:
+                record["reify_s"] = time.perf_counter() - start
+            return root, True
+    tree = Parser().parse(source)
+    parsed = time.perf_counter()
+    root = ast.AstNode.reify(tree.root_node, source=source)
+    if cache is not None:
+        cache.store(source, root)
+    if record is not None:
+        record["parse_s"] = parsed - start
+        record["reify_s"] = time.perf_counter() - parsed
+    return root, False
@@ -0,0 +1,341 @@
+"""
+Variability metrics computed straight from the tree-sitter tree with a single query pass,
+without reifying or patching. This is meant for scanning many files to find the ones
+where multiversal duplication will blow up before actually patching them.
+"""
+
+from typing import Any, FrozenSet, List, Optional, Tuple
+from tree_sitter import Node as BaseTsNode, Tree
+from rt_preproc.parser import C_LANGUAGE
+
+stats_query = C_LANGUAGE.query(
+    """
+    (preproc_ifdef) @conditional
+    (preproc_if) @conditional
+    (preproc_elif) @alternative
+    (preproc_elifdef) @alternative
+    (preproc_else) @alternative
+    (preproc_def) @define
+    (preproc_function_def) @define
+    (function_definition) @function
+    (declaration) @declaration
+    (expression_statement) @statement
+    (identifier) @identifier
+    """
+)
+
+Literal = Tuple[str, bool]
+"""
+A condition and whether it holds, ie: ("FOO", True) for the body of `#ifdef FOO`.
+For `#if`/`#elif`, the condition is the text of the expression.
+"""
+
+
+def _negate(literal: Literal) -> Literal:
+    return (literal[0], not literal[1])
+
+
+def declarator_name(node: Optional[BaseTsNode]) -> Optional[str]:
+    """
+    Find the declared name by following `declarator` fields down to an identifier.
+    """
+    while node is not None and node.type != "identifier":
+        inner = node.child_by_field_name("declarator")
+        if inner is None:
+            # parenthesized declarators don't have a declarator field
+            inner = next(
+                (child for child in node.named_children if child.type != "attribute_specifier"),
+                None,
+            )
+        node = inner
+    return node.text.decode() if node is not None else None
+
+
+class Branch:
+    """
+    One open branch of a conditional, ie: the body of an `#ifdef` or of its `#else`.
+    """
+
+    def __init__(
+        self,
+        node: BaseTsNode,
+        literal: Literal,
+        prior: Tuple[Literal, ...],
+        chain_depth: int,
+    ) -> None:
+        self.node = node
+        self.literal = literal
+        self.prior = prior
+        """Negations of the conditions of the earlier branches in the same chain."""
+        self.chain_depth = chain_depth
+        """Nesting depth of the conditional chain this branch belongs to."""
+
+    def literals(self) -> Tuple[Literal, ...]:
+        return self.prior + (self.literal,)
+
+
+class Site:
+    """
+    A statement that multiversal duplication may duplicate.
+    """
+
+    def __init__(
+        self,
+        node: BaseTsNode,
+        macro_set: FrozenSet[Literal],
+        declared_name: Optional[str] = None,
+    ) -> None:
+        self.node = node
+        self.macro_set = macro_set
+        self.declared_name = declared_name
+        self.idents: dict[str, None] = {}
+        self.branches = 1
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "line": self.node.start_point[0] + 1,
+            "kind": self.node.type,
+            "branches": self.branches,
+            "idents": [ident for ident in self.idents],
+        }
+
+
+class Counts:
+    """
+    Counters shared by the per-file and per-function statistics.
+    """
+
+    def __init__(self) -> None:
+        self.ifdefs = 0
+        """`#ifdef` and `#ifndef` directives."""
+        self.ifs = 0
+        """`#if` directives, counted apart since their conditions are expressions."""
+        self.elifs = 0
+        self.elses = 0
+        self.max_depth = 0
+        self.macros: dict[str, None] = {}
+        self.sites: List[Site] = []
+
+    def to_dict(self) -> dict[str, Any]:
+        dup_sites = [site for site in self.sites if site.branches > 1]
+        return {
+            "ifdefs": self.ifdefs,
+            "ifs": self.ifs,
+            "elifs": self.elifs,
+            "elses": self.elses,
+            "max_depth": self.max_depth,
+            "macros": sorted(self.macros),
+            "duplicated_sites": len(dup_sites),
+            "max_branches": max((site.branches for site in self.sites), default=1),
+            "total_branches": sum(site.branches for site in dup_sites),
+            "sites": [site.to_dict() for site in dup_sites],
+        }
+
+
+class FunctionStats(Counts):
+    def __init__(self, name: Optional[str], node: BaseTsNode) -> None:
+        super().__init__()
+        self.name = name
+        self.node = node
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "name": self.name,
+            "line": self.node.start_point[0] + 1,
+            **super().to_dict(),
+        }
+
+
+class FileStats(Counts):
+    def __init__(self, file: str, size: int) -> None:
+        super().__init__()
+        self.file = file
+        self.size = size
+        self.conditional_vars: dict[str, None] = {}
+        self.conditional_functions: dict[str, None] = {}
+        self.conditional_defines: dict[str, None] = {}
+        self.functions: List[FunctionStats] = []
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "file": self.file,
+            "bytes": self.size,
+            **super().to_dict(),
+            "conditional": {
+                "vars": list(self.conditional_vars),
+                "functions": list(self.conditional_functions),
+                "defines": list(self.conditional_defines),
+            },
+            "functions": [fn.to_dict() for fn in self.functions],
+        }
+
+
+class StatsCollector:
+    """
+    Walks the query captures of one file in document order, keeping stacks of the
+    open conditional branches, function and duplication site, and mirrors the
+    patcher's symbol tables to predict how many branches each site will get.
+
+    The prediction follows `PatchVisitor.build_rename_dict`, except that variable
+    declarations are treated as visible until the end of the file instead of being
+    scoped, so it can over-count in files that reuse local names.
+    """
+
+    def __init__(self, file: str, source: bytes) -> None:
+        self.stats = FileStats(file, len(source))
+        self.branches: List[Branch] = []
+        self.function: Optional[FunctionStats] = None
+        self.site: Optional[Site] = None
+        self.variants: dict[str, List[FrozenSet[Literal]]] = {}
+        """Macro sets of every declaration seen so far, keyed by name."""
+
+    def macro_set(self) -> FrozenSet[Literal]:
+        return frozenset(
+            literal for branch in self.branches for literal in branch.literals()
+        )
+
+    def add_variant(self, name: Optional[str], macro_set: FrozenSet[Literal]) -> None:
+        if name is not None:
+            self.variants.setdefault(name, []).append(macro_set)
+
+    def counters(self) -> List[Counts]:
+        if self.function is None:
+            return [self.stats]
+        return [self.stats, self.function]
+
+    def close_until(self, start_byte: int) -> None:
+        """
+        Close everything that ends before `start_byte`, innermost first.
+        """
+        if self.site is not None and self.site.node.end_byte <= start_byte:
+            self.close_site()
+        while len(self.branches) > 0 and self.branches[-1].node.end_byte <= start_byte:
+            self.branches.pop()
+        if self.function is not None and self.function.node.end_byte <= start_byte:
+            self.function = None
+
+    def close_site(self) -> None:
+        site = self.site
+        self.site = None
+        has_variability = False
+        branches = 1
+        for ident in site.idents:
+            variants = self.variants.get(ident, ())
+            if any(not macro_set <= site.macro_set for macro_set in variants):
+                has_variability = True
+            branches *= max(len(variants), 1)
+        site.branches = branches if has_variability else 1
+        for counts in self.counters():
+            counts.sites.append(site)
+        if len(site.macro_set) > 0 and site.declared_name is not None:
+            self.add_variant(site.declared_name, site.macro_set)
+
+    def open_branch(self, node: BaseTsNode, literal: Literal, parent: Optional[Branch]):
+        if parent is None:
+            depth = 1 + max((b.chain_depth for b in self.branches), default=0)
+            branch = Branch(node, literal, (), depth)
+        else:
+            branch = Branch(
+                node, literal, parent.prior + (_negate(parent.literal),), parent.chain_depth
+            )
+        self.branches.append(branch)
+        for counts in self.counters():
+            counts.max_depth = max(counts.max_depth, branch.chain_depth)
+
+    def condition_literal(self, node: BaseTsNode) -> Literal:
+        first = node.children[0].type
+        if node.type in ("preproc_ifdef", "preproc_elifdef"):
+            name = node.child_by_field_name("name").text.decode()
+            for counts in self.counters():
+                counts.macros[name] = None
+            return (name, first in ("#ifdef", "#elifdef"))
+        condition = node.child_by_field_name("condition")
+        return (condition.text.decode(), True)
+
+    def add(self, node: BaseTsNode, capture: str) -> None:
+        self.close_until(node.start_byte)
+        if capture == "conditional":
+            for counts in self.counters():
+                if node.type == "preproc_if":
+                    counts.ifs += 1
+                else:
+                    counts.ifdefs += 1
+            self.open_branch(node, self.condition_literal(node), None)
+        elif capture == "alternative":
+            for counts in self.counters():
+                if node.type == "preproc_else":
+                    counts.elses += 1
+                else:
+                    counts.elifs += 1
+            # the alternative replaces the branch it is the alternative of
+            parent = self.branches.pop()
+            if node.type == "preproc_else":
+                literal = _negate(parent.literal)
+                self.branches.append(
+                    Branch(node, literal, parent.prior, parent.chain_depth)
+                )
+            else:
+                self.open_branch(node, self.condition_literal(node), parent)
+        elif capture == "define":
+            name = node.child_by_field_name("name").text.decode()
+            macro_set = self.macro_set()
+            if len(macro_set) > 0:
+                self.stats.conditional_defines[name] = None
+                self.add_variant(name, macro_set)
+        elif capture == "function":
+            name = declarator_name(node.child_by_field_name("declarator"))
+            macro_set = self.macro_set()
+            if len(macro_set) > 0:
+                self.stats.conditional_functions[name] = None
+            self.add_variant(name, macro_set)
+            if self.function is None:
+                self.function = FunctionStats(name, node)
+                self.stats.functions.append(self.function)
+        elif capture in ("declaration", "statement"):
+            if self.site is not None:
+                return
+            declared_name = None
+            macro_set = self.macro_set()
+            if capture == "declaration":
+                declared_name = declarator_name(node.child_by_field_name("declarator"))
+                if len(macro_set) > 0:
+                    self.stats.conditional_vars[declared_name] = None
+            self.site = Site(node, macro_set, declared_name)
+        elif capture == "identifier":
+            parent = node.parent
+            if parent is not None and parent.type.startswith("preproc_"):
+                # macro names in #ifdef, defined(), or #if conditions
+                if parent.type in ("preproc_defined",) or (
+                    parent.type in ("preproc_if", "preproc_elif")
+                    and parent.child_by_field_name("condition") == node
+                ):
+                    for counts in self.counters():
+                        counts.macros[node.text.decode()] = None
+                return
+            if len(self.branches) > 0 and self._in_condition(node):
+                for counts in self.counters():
+                    counts.macros[node.text.decode()] = None
+                return
+            if self.site is not None:
+                self.site.idents[node.text.decode()] = None
+
+    def _in_condition(self, node: BaseTsNode) -> bool:
+        branch_node = self.branches[-1].node
+        if branch_node.type not in ("preproc_if", "preproc_elif"):
+            return False
+        condition = branch_node.child_by_field_name("condition")
+        return condition.start_byte <= node.start_byte < condition.end_byte
+
+    def finish(self) -> FileStats:
+        self.close_until(self.stats.size + 1)
+        return self.stats
+
+
+def collect_stats(file: str, source: bytes, tree: Tree) -> FileStats:
+    collector = StatsCollector(file, source)
+    captures = stats_query.captures(tree.root_node)
+    # outer nodes first when several captures start at the same byte
+    captures.sort(key=lambda capture: (capture[0].start_byte, -capture[0].end_byte))
+    for node, capture in captures:
+        collector.add(node, capture)
+    return collector.finish()
@@ -1,4 +1,5 @@
-from typing import Any, Union
+from typing import Any, TextIO, Union
+import sys
 import rt_preproc.parser.ast as ast
 from typing import Optional
 from multimethod import multimethod
@@ -10,14 +11,10 @@ logger = logging.getLogger(__name__)
 
 
 class GraphVizCtx(IVisitorCtx):
-    def __init__(self, parent: Optional[ast.AstNode] = None) -> None:
+    def __init__(self, parent: Optional[str] = None, depth: int = 0) -> None:
         self.parent = parent
-
-
-def stringize_node(node: ast.AstNode):
-    if node.base_node is None:
-        return f"{node.__class__.__name__}"
-    return f"{node.base_node.id}-{node.base_node.start_point}"
+        """Graphviz id of the parent node, if any."""
+        self.depth = depth
 
 
 def table_label(node: ast.AstNode):
@@ -30,32 +27,101 @@ def table_label(node: ast.AstNode):
     )
 
 
+def function_name(node: ast.FunctionDefinition) -> Optional[str]:
+    """
+    Name of a function definition, looking through pointer/parenthesized declarators.
+    """
+    declarator = next(
+        (
+            child
+            for child, idx in zip(node.children, node.children_named_idxs)
+            if idx is not None
+            and isinstance(
+                child,
+                (
+                    ast.FunctionDeclarator,
+                    ast.PointerDeclarator,
+                    ast.ParenthesizedDeclarator,
+                ),
+            )
+        ),
+        None,
+    )
+    while declarator is not None and not isinstance(declarator, ast.Identifier):
+        declarator = next(
+            (
+                child
+                for child, idx in zip(declarator.children, declarator.children_named_idxs)
+                if idx is not None
+            ),
+            None,
+        )
+    return declarator.text if declarator is not None else None
+
+
 class GraphVizVisitor(IVisitor):
-    """Visitor for printing an AST to a GraphViz dot file."""
+    """
+    Visitor for writing an AST as a GraphViz dot graph.
+    The graph is streamed to `out` as nodes are visited, rather than built up in memory.
+    """
 
-    def __init__(self) -> None:
-        self.buf = ""
+    def __init__(
+        self,
+        out: TextIO = sys.stdout,
+        only_preproc: bool = False,
+        max_depth: Optional[int] = None,
+        max_nodes: Optional[int] = None,
+    ) -> None:
+        self.out = out
+        self.only_preproc = only_preproc
+        """
+        Only graph preprocessor conditionals/definitions, their ancestors,
+        and the named leaves directly under them (ie: the macro name).
+        """
+        self.max_depth = max_depth
+        self.max_nodes = max_nodes
+        self.node_count = 0
+        self.truncated = False
+
+    def begin(self) -> None:
+        self.out.write("digraph Program {\n")
+        self.out.write("node [shape=box, colorscheme=pastel19];\n")
+
+    def end(self) -> None:
+        if self.truncated:
+            self.out.write(f"// truncated at {self.node_count} nodes\n")
+        self.out.write("}\n")
+
+    def include_child(self, node: ast.AstNode, child: ast.AstNode) -> bool:
+        if not self.only_preproc:
+            return True
+        if child.variability().has_preproc:
+            return True
+        return isinstance(node, ast.variability_preproc_types) and len(child.children) == 0
 
     def visit_named_children(
         self, node: ast.AstNode, ctx: GraphVizCtx, label: str = None
-    ) -> list[Any]:
+    ) -> None:
+        if self.max_nodes is not None and self.node_count >= self.max_nodes:
+            self.truncated = True
+            return
+        node_id = f"n{self.node_count}"
+        self.node_count += 1
+
         label = f'"{node.__class__.__name__}"' if label is None else label
         styler = ""
-        if node.base_node is not None and node.base_node.type in type_name_to_color:
-            styler = f"style=filled color={type_name_to_color[node.base_node.type]}"
-        self.buf += f'"{stringize_node(node)}" [{styler} label={label}];\n'
+        if type(node) in class_to_color:
+            styler = f"style=filled color={class_to_color[type(node)]}"
+        self.out.write(f'"{node_id}" [{styler} label={label}];\n')
         if ctx.parent is not None:
-            self.buf += (
-                f'\t"{stringize_node(ctx.parent)}" -> "{stringize_node(node)}";\n'
-            )
-        self.buf += 'subgraph "cluster_' + stringize_node(node) + '" {\n'
-        out = [
-            child.accept(self, GraphVizCtx(parent=node))
-            for child, idx in zip(node.children, node.children_named_idxs)
-            if idx is not None
-        ]
-        self.buf += "}\n"
-        return out
+            self.out.write(f'\t"{ctx.parent}" -> "{node_id}";\n')
+
+        if self.max_depth is not None and ctx.depth >= self.max_depth:
+            return
+        child_ctx = GraphVizCtx(parent=node_id, depth=ctx.depth + 1)
+        for child, idx in zip(node.children, node.children_named_idxs):
+            if idx is not None and self.include_child(node, child):
+                child.accept(self, child_ctx)
 
     @multimethod
     def visit(self, node: ast.AstNode, ctx: GraphVizCtx) -> Any:
@@ -63,11 +129,9 @@ class GraphVizVisitor(IVisitor):
 
     @visit.register
     def visit(self, node: ast.TranslationUnit, ctx: GraphVizCtx) -> Any:
-        self.buf += "digraph Program {\n"
-        self.buf += "node [shape=box, colorscheme=pastel19];\n"
+        self.begin()
         self.visit_named_children(node, ctx)
-        self.buf += "}\n"
-        print(self.buf)
+        self.end()
 
     @visit.register
     def visit(
@@ -107,3 +171,8 @@ type_name_to_color = {
     "true": 8,
     "type_identifier": 9,
 }
+
+class_to_color = {
+    ast.type_name_to_class[name]: color for name, color in type_name_to_color.items()
+}
+"""By node class rather than tree-sitter type, so trees loaded from the cache keep their colors."""
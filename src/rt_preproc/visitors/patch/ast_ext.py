@@ -1,3 +1,4 @@
+from typing import List, Optional, Tuple
 import rt_preproc.parser.ast as ast
 import rt_preproc.visitors.patch.data as data
 
@@ -33,4 +34,120 @@ class PreprocDefinitionMarker(Marker):
 
     def __init__(self, def_decl: data.DefDecl) -> None:
         super().__init__()
-        self.def_decl = def_decl
\ No newline at end of file
+        self.def_decl = def_decl
+
+class DispatchBlock(ast.CompoundStatement):
+    """
+    Runtime dispatch between versions of some code: an if/else-if chain with one case per
+    condition set (the conditions of a case all have to hold).
+    The cases are kept so that adjacent blocks can be merged after patching (see `coalesce`),
+    the children are the rendered chain and are rebuilt by `render`.
+    """
+
+    def __init__(
+        self,
+        cases: Optional[List[Tuple[List[data.Macro], List[ast.AstNode]]]] = None,
+        exhaustive: bool = False,
+        assert_unmatched: bool = False,
+    ) -> None:
+        super().__init__()
+        self.cases = cases if cases is not None else []
+        self.exhaustive = exhaustive
+        """Whether one of the cases always holds, even if that can't be told from the conditions."""
+        self.assert_unmatched = assert_unmatched
+        """Whether to assert that some case holds."""
+        self.render()
+
+    def same_dispatch(self, other: "DispatchBlock") -> bool:
+        """
+        Whether `other` dispatches on the same condition sets, so the two can be merged.
+        """
+        return (
+            len(self.cases) > 0
+            and [set(conds) for conds, _ in self.cases]
+            == [set(conds) for conds, _ in other.cases]
+            and self.exhaustive == other.exhaustive
+            and self.assert_unmatched == other.assert_unmatched
+        )
+
+    def merge(self, other: "DispatchBlock") -> None:
+        """
+        Append the bodies of `other` to the bodies of the same cases of this block.
+        """
+        for (_, body), (_, other_body) in zip(self.cases, other.cases):
+            if (
+                len(body) == 1
+                and len(other_body) == 1
+                and type(body[0]) is ast.CompoundStatement
+                and type(other_body[0]) is ast.CompoundStatement
+            ):
+                # bodies of conditionals, merge them so that their contents can be coalesced too
+                block, other_block = body[0], other_body[0]
+                if block._shared:
+                    # copy on write, the other trees sharing it keep the original
+                    block = body[0] = block.owning_copy()
+                named_count = sum(idx is not None for idx in block.children_named_idxs)
+                block.children.append(ast.Whitespace("\n"))
+                for child in other_block.children:
+                    child = block.own(child)
+                    child.parent = block
+                    block.children.append(child)
+                block.children_named_idxs.append(None)
+                block.children_named_idxs.extend(
+                    None if idx is None else idx + named_count
+                    for idx in other_block.children_named_idxs
+                )
+                block.mark_modified()
+            else:
+                body.append(ast.Whitespace("\n"))
+                body.extend(other_body)
+        self.render()
+
+    def render(self) -> None:
+        cases = []
+        for conds, body in self.cases:
+            # the same condition can come from several identifiers
+            conds = list(dict.fromkeys(conds))
+            if data.contradicts(conds):
+                continue
+            cases.append((conds, body))
+            if len(conds) == 0:
+                # this one always holds, so the later cases are unreachable
+                break
+        exhaustive = (
+            self.exhaustive
+            or (len(cases) > 0 and len(cases[-1][0]) == 0)
+            or data.covers([conds for conds, _ in cases])
+        )
+
+        self.children = []
+        for i, (conds, body) in enumerate(cases):
+            if i > 0:
+                self.children.extend([ast.Unnamed("else"), ast.Whitespace(" ")])
+            if not (exhaustive and i == len(cases) - 1 and i > 0) and len(conds) > 0:
+                self.children.extend(
+                    [
+                        ast.Unnamed("if"),
+                        ast.Whitespace(" "),
+                        ast.Unnamed("("),
+                        ast.Custom(" && ".join(cond.to_c() for cond in conds)),
+                        ast.Unnamed(")"),
+                        ast.Whitespace(" "),
+                    ]
+                )
+            self.children.extend(
+                [ast.Unnamed("{"), *body, ast.Unnamed("}"), ast.Whitespace("\n")]
+            )
+        if self.assert_unmatched and not exhaustive:
+            self.children.extend(
+                [
+                    ast.Unnamed("else"),
+                    ast.Whitespace(" "),
+                    ast.Unnamed("{"),
+                    ast.Whitespace("\n"),
+                    ast.Custom("assert(0);\n"),
+                    ast.Unnamed("}"),
+                    ast.Whitespace("\n"),
+                ]
+            )
+        self.children_named_idxs = [None] * len(self.children)
@@ -0,0 +1,34 @@
+"""
+Post-patch pass merging adjacent dispatch blocks that dispatch on the same conditions,
+so consecutive statements guarded by the same macros share one if/else-if chain.
+"""
+
+import rt_preproc.parser.ast as ast
+from rt_preproc.visitors.patch.ast_ext import DispatchBlock
+
+
+def coalesce(node: ast.AstNode) -> None:
+    """
+    Merge the adjacent dispatch blocks under `node` in place.
+    Blocks are adjacent if only whitespace separates them.
+    """
+    children = node.children
+    edits = node.edit_children()
+    block = None
+    for i, child in enumerate(children):
+        if isinstance(child, DispatchBlock):
+            if block is not None and block.same_dispatch(child):
+                block.merge(child)
+                # drop the merged block and the whitespace before it
+                for j in range(block_idx + 1, i + 1):
+                    edits.delete(j)
+                block_idx = i
+                continue
+            block, block_idx = child, i
+        elif not isinstance(child, ast.Whitespace):
+            block = None
+    edits.apply()
+
+    # the edits were applied to a copy if `node` is shared
+    for child in edits.node.children:
+        coalesce(child)
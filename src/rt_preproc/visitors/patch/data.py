@@ -1,6 +1,7 @@
-from typing import Optional, List, Any, Self, Set
+from typing import Optional, List, Any, Iterable, Self, Sequence, Set, Tuple, Union
 import rt_preproc.parser.ast as ast
 from collections import defaultdict
+import itertools
 
 class Macro:
     def __init__(self, name: str, type: str, def_cond: bool = False):
@@ -16,16 +17,125 @@ class Macro:
     def __hash__(self) -> int:
         return hash((self.name, self.type, self.def_cond))
 
+    def to_c(self) -> str:
+        """
+        The runtime C check for this condition.
+        """
+        return f"{self.name} {'==' if self.def_cond else '!='} UNDEFINED_{self.type.capitalize()}"
+
+    def sort_key(self) -> tuple:
+        return (self.name, self.def_cond)
+
+
+class CondFlag(Macro):
+    """
+    A `#if`/`#elif` branch condition, precomputed once at startup into the flag `name`.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        def_cond: bool = False,
+        chain: Tuple[str, ...] = (),
+        exhaustive: bool = False,
+    ):
+        super().__init__(name, "int", def_cond)
+        self.chain = chain
+        """
+        The flags of the branches of the chain this flag is a branch of, at most one of them holds.
+        """
+        self.exhaustive = exhaustive
+        """Whether one of the flags of `chain` always holds, ie: the chain has an `#else`."""
+
+    def to_c(self) -> str:
+        return f"!{self.name}" if self.def_cond else self.name
+
+
+def macro_set_to_c(macro_set: Set[Macro]) -> str:
+    """
+    The runtime C check for all the conditions in a macro set, in a stable order.
+    """
+    if len(macro_set) == 0:
+        return "1"
+    return " && ".join(m.to_c() for m in sorted(macro_set, key=Macro.sort_key))
+
+def contradicts(conds: Iterable[Macro]) -> bool:
+    """
+    Whether a set of conditions can never all hold, ie: it has a condition and its negation.
+    """
+    seen: dict[tuple, bool] = {}
+    for cond in conds:
+        key = (type(cond), cond.name, cond.type)
+        if seen.setdefault(key, cond.def_cond) != cond.def_cond:
+            return True
+    return False
+
+
+max_covers_conds = 12
+"""Above this many distinct conditions, `covers` doesn't try and returns False."""
+
+
+def covers(cond_sets: List[List[Macro]]) -> bool:
+    """
+    Whether at least one of the condition sets always holds.
+    Conditions are treated as independent, so this can miss coverage but never claims it wrongly.
+    """
+    keys = list(
+        dict.fromkeys(
+            (type(cond), cond.name, cond.type) for conds in cond_sets for cond in conds
+        )
+    )
+    if len(cond_sets) == 0 or len(keys) > max_covers_conds:
+        return False
+    for assignment in itertools.product((False, True), repeat=len(keys)):
+        values = dict(zip(keys, assignment))
+        if not any(
+            all(values[(type(cond), cond.name, cond.type)] == cond.def_cond for cond in conds)
+            for conds in cond_sets
+        ):
+            return False
+    return True
+
+
 class FuncDecl:
-    def __init__(self, fn_decl: ast.FunctionDeclarator, macro_set: set[Macro]):
+    def __init__(
+        self,
+        fn_decl: ast.FunctionDeclarator,
+        macro_set: set[Macro],
+        ret_type: Optional[str] = None,
+    ):
         self.fn_decl = fn_decl
         self.macro_set = macro_set
+        self.ret_type = ret_type
+
+    def signature(self) -> str:
+        """
+        Return type and parameter list, with whitespace normalized,
+        so that variants can be compared for compatibility.
+        """
+        params = str(self.fn_decl.get_named_child(1))
+        return " ".join(f"{self.ret_type} {params}".split())
+
+    def pointer_type(self) -> str:
+        """
+        C type name of a pointer to this function, for casts.
+        """
+        params = str(self.fn_decl.get_named_child(1))
+        return " ".join(f"{self.ret_type} (*){params}".split())
 
 class VarIdent:
-    def __init__(self, name: str, macro_set: set[Macro], orig_name: Optional[str] = None):
+    def __init__(
+        self,
+        name: str,
+        macro_set: set[Macro],
+        orig_name: Optional[str] = None,
+        decl: Optional[Union["VarDecl", FuncDecl, "DefDecl", "DefFnDecl"]] = None,
+    ):
         self.name = name
         self.macro_set = macro_set
         self.orig_name = orig_name
+        self.decl = decl
+        """The declaration this rename refers to."""
 
 class VarDecl:
     def __init__(
@@ -84,18 +194,214 @@ class DefFnDecl:
         new_node = ast.Custom(f"#define {self.name}{str(self.params)} {self.val}\n")
         return new_node
 
+class SymbolIndex:
+    """
+    Index of the declarations that may need renaming, keyed by identifier.
+    Functions and macro definitions are file-global, so they live here.
+    Variable declarations are scoped, so they stay in the context's `var_decls`
+    and are passed in at lookup time.
+    Lookups never insert into the index (or into `var_decls`).
+    """
+
+    def __init__(self) -> None:
+        self.fn_decls: dict[str, List[FuncDecl]] = {}
+        self.defines: dict[str, List[Union[DefDecl, DefFnDecl]]] = {}
+
+    def add_fn_decl(self, name: str, fn_decl: FuncDecl) -> int:
+        """
+        Adds a function declaration, returning the number of declarations for `name` so far.
+        """
+        decls = self.fn_decls.setdefault(name, [])
+        decls.append(fn_decl)
+        return len(decls)
+
+    def add_define(self, name: str, def_decl: Union[DefDecl, DefFnDecl]) -> None:
+        self.defines.setdefault(name, []).append(def_decl)
+
+    def define_count(self, name: str) -> int:
+        return len(self.defines.get(name, ()))
+
+    def has_variability(
+        self,
+        ident: str,
+        var_decls: dict[str, List[VarDecl]],
+        ctx_macro_set: Set[Macro],
+    ) -> bool:
+        """
+        Whether any rename of `ident` (see `renames`) would have a non-empty macro set.
+        """
+        for decls in (
+            var_decls.get(ident, ()),
+            self.fn_decls.get(ident, ()),
+            self.defines.get(ident, ()),
+        ):
+            for decl in decls:
+                if not decl.macro_set <= ctx_macro_set:
+                    return True
+        return False
+
+    def renames(
+        self,
+        ident: str,
+        var_decls: dict[str, List[VarDecl]],
+        ctx_macro_set: Set[Macro],
+    ) -> List[VarIdent]:
+        """
+        Returns the possible renames of `ident`: one entry per declaration
+        (variables first, then functions, then macro definitions),
+        each with the remainder of its macro set not already implied by `ctx_macro_set`.
+        """
+        renamed: List[VarIdent] = []
+        for decls in (
+            var_decls.get(ident, ()),
+            self.fn_decls.get(ident, ()),
+            self.defines.get(ident, ()),
+        ):
+            for i, decl in enumerate(decls):
+                renamed.append(
+                    VarIdent(
+                        ident + "_" + str(i + 1) if i > 0 else ident,
+                        decl.macro_set - ctx_macro_set,
+                        orig_name=ident,
+                        decl=decl,
+                    )
+                )
+        return renamed
+
+class DegradedSite:
+    """
+    A duplication site that went over the combination budget
+    and was emitted with variant selection instead.
+    """
+
+    def __init__(
+        self,
+        line: Optional[int],
+        snippet: str,
+        combinations: int,
+        emitted: int,
+        reason: str,
+    ) -> None:
+        self.line = line
+        self.snippet = snippet
+        self.combinations = combinations
+        """Number of duplicates full duplication would have emitted."""
+        self.emitted = emitted
+        """Number of duplicates actually emitted."""
+        self.reason = reason
+
+    def __str__(self) -> str:
+        where = f"line {self.line}" if self.line is not None else "generated code"
+        return (
+            f"{where}: `{self.snippet}` {self.combinations} -> {self.emitted}"
+            f" combinations ({self.reason})"
+        )
+
+
+class DeferredBody:
+    """
+    The body of a top-level function left for a worker process to patch (see `parallel`),
+    with the declarations of its identifiers that came before the function.
+    """
+
+    def __init__(
+        self,
+        function: ast.FunctionDefinition,
+        body_pos: int,
+        var_decls: dict[str, List[VarDecl]],
+        decl_counts: dict[str, tuple[int, int]],
+        fn_table_mark: int,
+        degraded_mark: int,
+    ) -> None:
+        self.function = function
+        self.body_pos = body_pos
+        """Position of the body in the function's children."""
+        self.var_decls = var_decls
+        """The global variable declarations of the body's identifiers."""
+        self.decl_counts = decl_counts
+        """
+        Identifier -> number of function and macro definitions of it before the function,
+        the lists in the `SymbolIndex` are only ever appended to.
+        """
+        self.fn_table_mark = fn_table_mark
+        """Number of functions called through a table before the function."""
+        self.degraded_mark = degraded_mark
+        """Number of degraded sites before the function."""
+
+
+class DeferredResult:
+    """
+    A deferred body once patched, and what patching it added to the visitor's state.
+    """
+
+    def __init__(
+        self,
+        body: ast.AstNode,
+        fn_table_types: dict[str, str],
+        degraded_sites: List[DegradedSite],
+        combinations_emitted: int,
+    ) -> None:
+        self.body = body
+        self.fn_table_types = fn_table_types
+        self.degraded_sites = degraded_sites
+        self.combinations_emitted = combinations_emitted
+
+
 class MoveUpMsg:
+    """
+    What visiting a node returns: the node to replace it with (None to keep it),
+    and the nodes to move up to the parent, out of the conditional block they're in.
+    Most visits return `EMPTY`, and `move_ups` stays an empty tuple until something is moved up.
+    A list of move ups is owned by its message and handed up without being copied,
+    see `merge_move_ups`.
+    """
+
+    __slots__ = ("node", "move_ups")
+    EMPTY: "MoveUpMsg"
+    """
+    Shared message replacing nothing and moving nothing up, never modified.
+    """
+
     def __init__(
         self,
         node: Optional[ast.AstNode] = None,
-        move_up_nodes: List[ast.AstNode] = [],
-        var_idents: Set[str] = set(), # these are variable identifers that are compile-time variable
+        move_ups: Sequence[ast.AstNode] = (),
     ) -> None:
         self.node = node
+        self.move_ups = move_ups
+
+    def with_node(self, node: Optional[ast.AstNode]) -> "MoveUpMsg":
+        """
+        This message, replacing with `node` instead.
+        """
+        if self is MoveUpMsg.EMPTY:
+            return self if node is None else MoveUpMsg(node)
+        self.node = node
+        return self
+
+    def move_up(self, node: ast.AstNode) -> "MoveUpMsg":
+        """
+        This message, moving `node` up too.
+        """
+        if self is MoveUpMsg.EMPTY:
+            return MoveUpMsg(None, [node])
+        self.move_ups = merge_move_ups(self.move_ups, [node])
+        return self
+
+
+MoveUpMsg.EMPTY = MoveUpMsg()
+
 
-        self.move_ups: List[ast.AstNode] = []
-        self.move_ups.extend(move_up_nodes)
-        # if I do self.var_idents = var_idents instead, then the var_idents will be shared between all instances (we don't want that)
-        # same for move_ups
-        self.var_idents: Set[str] = set()
-        self.var_idents.update(var_idents)
+def merge_move_ups(
+    into: Sequence[ast.AstNode], move_ups: Sequence[ast.AstNode]
+) -> Sequence[ast.AstNode]:
+    """
+    `into` followed by `move_ups`: `into` extended in place, or `move_ups` itself if `into`
+    is empty, since both belong to messages that are done with them.
+    """
+    if len(move_ups) == 0:
+        return into
+    if len(into) == 0:
+        return move_ups
+    into.extend(move_ups)
+    return into
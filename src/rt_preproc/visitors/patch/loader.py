@@ -0,0 +1,82 @@
+"""
+Generates the C code that loads the runtime configuration of the macros.
+
+The environment is walked once and every `NAME=VALUE` entry is looked up in a sorted
+table of the macro names, rather than calling `getenv()` (which scans the whole
+environment) once per macro. If the `RT_PREPROC_CONFIG` environment variable is set,
+the `NAME=VALUE` lines of that file are read instead of the environment.
+"""
+
+CONFIG_ENV_VAR = "RT_PREPROC_CONFIG"
+
+value_parsers = {
+    "int": "(int)strtol({value}, NULL, 10)",
+    "long": "strtol({value}, NULL, 10)",
+    "double": "strtod({value}, NULL)",
+}
+"""
+Macro type -> C expression parsing the string `{value}` into that type.
+Integers are read in base 10, so `FOO=010` is 10 rather than octal 8.
+"""
+
+
+def build_config_loader(macros: dict[str, str]) -> str:
+    """
+    Builds `rt_load_env()` and `rt_load_config(path)` setting the given macros
+    (name -> type) from the environment or a config file.
+    Both return 0 on success.
+    """
+    names = sorted(macros)
+    buf = ""
+    buf += "#include <string.h>     /* strchr, strcspn, strlen, strncmp */\n"
+    buf += "extern char **environ;\n\n"
+
+    buf += "static const char* const rt_macro_names[] = {\n"
+    for name in names:
+        buf += f'  "{name}",\n'
+    buf += "};\n\n"
+
+    # binary search over the sorted names, comparing only the first `len` chars of `name`
+    buf += "static int rt_find_macro(const char* name, size_t len) {\n"
+    buf += f"  int lo = 0, hi = {len(names)};\n"
+    buf += "  while (lo < hi) {\n"
+    buf += "    int mid = (lo + hi) / 2;\n"
+    buf += "    int c = strncmp(name, rt_macro_names[mid], len);\n"
+    buf += "    if (c == 0 && rt_macro_names[mid][len] != '\\0') c = -1;\n"
+    buf += "    if (c == 0) return mid;\n"
+    buf += "    if (c < 0) hi = mid; else lo = mid + 1;\n"
+    buf += "  }\n"
+    buf += "  return -1;\n"
+    buf += "}\n\n"
+
+    buf += "static void rt_set_macro(const char* entry) {\n"
+    buf += "  const char* eq = strchr(entry, '=');\n"
+    buf += "  if (!eq) return;\n"
+    buf += "  const char* value = eq + 1;\n"
+    buf += "  switch (rt_find_macro(entry, eq - entry)) {\n"
+    for i, name in enumerate(names):
+        parse = value_parsers[macros[name]].format(value="value")
+        buf += f"    case {i}: {name} = {parse}; break;\n"
+    buf += "  }\n"
+    buf += "}\n\n"
+
+    buf += "static int rt_load_env() {\n"
+    buf += "  for (char** entry = environ; *entry; entry++) rt_set_macro(*entry);\n"
+    buf += "  return 0;\n"
+    buf += "}\n\n"
+
+    buf += "static int rt_load_config(const char* path) {\n"
+    buf += '  FILE* f = fopen(path, "r");\n'
+    buf += "  if (!f) return 1;\n"
+    buf += "  char line[4096];\n"
+    buf += "  while (fgets(line, sizeof(line), f)) {\n"
+    buf += "    line[strcspn(line, \"\\r\\n\")] = '\\0';\n"
+    # the line ending (also `\r\n`) and trailing blanks aren't part of the value
+    buf += "    size_t len = strlen(line);\n"
+    buf += "    while (len > 0 && (line[len - 1] == ' ' || line[len - 1] == '\\t')) line[--len] = '\\0';\n"
+    buf += "    if (line[0] != '#') rt_set_macro(line);\n"
+    buf += "  }\n"
+    buf += "  fclose(f);\n"
+    buf += "  return 0;\n"
+    buf += "}\n"
+    return buf
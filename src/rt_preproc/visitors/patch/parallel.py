@@ -0,0 +1,88 @@
+"""
+Patching the bodies of independent functions in worker processes.
+
+The visit of a file is serial, since each declaration can rename what comes after it.
+But the body of a top-level function without preprocessor directives only reads what was
+declared before it, so the visit can defer it (see `PatchVisitor.defer_body`) and carry on.
+The deferred bodies are then patched in forked worker processes, which inherit the tree
+and the visitor's state, and only the patched bodies are sent back.
+"""
+
+from typing import TYPE_CHECKING, List, Optional
+import io
+import multiprocessing
+import pickle
+from tree_sitter import Node as BaseTsNode
+from rt_preproc.visitors.patch.data import DeferredResult
+
+if TYPE_CHECKING:
+    from rt_preproc.visitors.patch.patch import PatchVisitor
+
+_visitor: Optional["PatchVisitor"] = None
+"""The visitor whose deferred bodies are being patched, inherited by the forked workers."""
+
+
+class _ResultPickler(pickle.Pickler):
+    """
+    Pickles a patched body without the source its nodes point into,
+    nor the tree-sitter nodes they were reified from (which can't be pickled).
+    """
+
+    def __init__(self, file: io.BytesIO, source: Optional[bytes]) -> None:
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.source = source
+
+    def persistent_id(self, obj: object) -> Optional[str]:
+        if self.source is not None and obj is self.source:
+            return "source"
+        if isinstance(obj, BaseTsNode):
+            # the merged body has no `base_node`, like a tree loaded from the cache,
+            # the nodes keep their `start_row` for `source_line`
+            return "base_node"
+        return None
+
+
+class _ResultUnpickler(pickle.Unpickler):
+    """
+    Points the nodes of a patched body back into the source, without their tree-sitter nodes,
+    like a tree loaded from the cache.
+    """
+
+    def __init__(self, file: io.BytesIO, source: Optional[bytes]) -> None:
+        super().__init__(file)
+        self.source = source
+
+    def persistent_load(self, pid: str) -> Optional[bytes]:
+        return self.source if pid == "source" else None
+
+
+def _patch_body(i: int) -> bytes:
+    deferred = _visitor.deferred[i]
+    result = _visitor.patch_deferred_body(deferred)
+    # send the body back without the rest of the tree
+    result.body.parent = None
+    buf = io.BytesIO()
+    _ResultPickler(buf, deferred.function.source).dump(result)
+    return buf.getvalue()
+
+
+def patch_deferred(visitor: "PatchVisitor") -> List[DeferredResult]:
+    """
+    Patch the deferred bodies of `visitor` in `visitor.jobs` worker processes,
+    returning the results in the order the bodies were deferred.
+    """
+    global _visitor
+    deferred = visitor.deferred
+    if visitor.jobs <= 1 or len(deferred) <= 1:
+        return [visitor.patch_deferred_body(body) for body in deferred]
+    _visitor = visitor
+    try:
+        with multiprocessing.get_context("fork").Pool(visitor.jobs) as pool:
+            chunksize = max(1, len(deferred) // (visitor.jobs * 4))
+            data = pool.map(_patch_body, range(len(deferred)), chunksize)
+    finally:
+        _visitor = None
+    return [
+        _ResultUnpickler(io.BytesIO(d), body.function.source).load()
+        for d, body in zip(data, deferred)
+    ]
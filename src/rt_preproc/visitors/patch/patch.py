@@ -1,20 +1,41 @@
 import rt_preproc.parser.ast as ast
-from typing import Optional, List, Any, Self, Set, Union
+from typing import Optional, List, Any, Self, Sequence, Set, Union, Iterable
 from multimethod import multimethod
 from rt_preproc.visitors.base import IVisitor, IVisitorCtx
 from collections import defaultdict
 import copy
+import logging
 from rt_preproc.visitors.patch.data import (
     Macro,
+    CondFlag,
     FuncDecl,
     VarDecl,
     DefDecl,
     DefFnDecl,
     VarIdent,
     MoveUpMsg,
+    merge_move_ups,
+    SymbolIndex,
+    DegradedSite,
+    DeferredBody,
+    DeferredResult,
+    macro_set_to_c,
+    contradicts,
 )
 import rt_preproc.visitors.patch.ast_ext as ast_ext
+from rt_preproc.visitors.patch.loader import CONFIG_ENV_VAR, build_config_loader
+from rt_preproc.visitors.patch.predicate import (
+    Defined,
+    Unary,
+    UnsupportedCondition,
+    compile_condition,
+)
+from rt_preproc.visitors.patch.specialize import branch_bounds
+from rt_preproc.visitors.patch.parallel import patch_deferred
 import itertools
+import math
+
+logger = logging.getLogger(__name__)
 
 setup_env_vars_run_str = r"""
   if (setup_env_vars() != 0) {
@@ -31,13 +52,13 @@ class PatchCtx(IVisitorCtx):
         parent: Optional[ast.AstNode] = None,
         in_ifdef: bool = False,
         ifdef_cond: Optional[Macro] = None,
-        var_decls: dict[str, List[VarDecl]] = defaultdict(list),
+        var_decls: Optional[dict[str, List[VarDecl]]] = None,
     ) -> None:
         self.parent_ctx = parent_ctx
         self.parent = parent
         self.in_ifdef = in_ifdef or (parent_ctx is not None and parent_ctx.in_ifdef)
         self.ifdef_cond = ifdef_cond
-        self.var_decls = var_decls
+        self.var_decls = var_decls if var_decls is not None else defaultdict(list)
 
     def get_ifdef_cond_stack(self) -> List[Macro]:
         """
@@ -61,6 +82,43 @@ class PatchCtx(IVisitorCtx):
         )
 
 
+def source_line(node: ast.AstNode) -> Optional[int]:
+    """
+    The 1-based source line of the first node in this subtree that came from the source.
+    """
+    stack = [node]
+    while stack:
+        cur = stack.pop()
+        if cur.start_row is not None:
+            return cur.start_row + 1
+        stack.extend(reversed(cur.children))
+    return None
+
+
+def conditional_branches(
+    node: ast.AstNode,
+) -> List[tuple[ast.AstNode, tuple[List[ast.AstNode], List[Optional[int]]]]]:
+    """
+    The branches of a conditional chain, in order: each `#if`/`#ifdef`/`#elif`/`#elifdef`/`#else` node
+    with the children (and their named child indexes) making up its body.
+    """
+    branches = []
+    branch = node
+    while branch is not None:
+        start_idx, end_idx = branch_bounds(branch)
+        body_children = branch.children[start_idx:end_idx]
+        body_named_idxs = branch.children_named_idxs[start_idx:end_idx]
+        if end_idx < len(branch.children):
+            # the whitespace at the end of the body is the trivia of the alternative or `#endif`
+            trailing = branch.children[end_idx].leading_trivia()
+            if trailing != "":
+                body_children.append(ast.Whitespace(trailing))
+                body_named_idxs.append(None)
+        branches.append((branch, (body_children, body_named_idxs)))
+        branch = branch.get_child_by_name("alternative")
+    return branches
+
+
 def update_if_marker(
     node: ast.AstNode,
     ctx: PatchCtx,
@@ -84,54 +142,210 @@ def update_if_marker(
 class PatchVisitor(IVisitor):
     """Visitor for performing variability transformations on AST nodes."""
 
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        max_site_combinations: Optional[int] = None,
+        max_file_combinations: Optional[int] = None,
+        fn_tables: bool = False,
+        macro_types: Optional[dict[str, str]] = None,
+        jobs: int = 1,
+    ) -> None:
+        self.max_site_combinations = max_site_combinations
+        """
+        Sites that would be duplicated more than this many times
+        use variant selection instead (see `select_variants`).
+        """
+        self.max_file_combinations = max_file_combinations
+        """
+        Once this many duplicates have been emitted for the file,
+        further sites that would go over it use variant selection instead.
+        """
+        self.fn_tables = fn_tables
+        """
+        Call conditionally defined functions through a function pointer that
+        `setup_env_vars` points at the right variant once, instead of duplicating call sites.
+        """
+        self.fn_table_types: dict[str, str] = {}
+        """Function name -> pointer type, for every function called through a table."""
+        self.macro_types = macro_types if macro_types is not None else {}
+        """Macro name -> C type of its runtime value, for macros that are not `int`."""
+        self.cond_flags: dict[str, str] = {}
+        """C expression -> name of the flag it's computed into once at startup."""
+        self.combinations_emitted = 0
+        self.degraded_sites: List[DegradedSite] = []
         self.macros: dict[str, str] = {}
         self.structs: dict[str, ast.StructSpecifier] = {}
-        self.fn_decls: dict[str, List[FuncDecl]] = defaultdict(list)
         self.move_to_mains: List[ast.AstNode] = []
-        self.defines: dict[str, List[Union[DefDecl, DefFnDecl]]] = defaultdict(list)
+        self.symbols = SymbolIndex()
+        self.jobs = jobs
+        """
+        Number of worker processes to patch function bodies in. With more than one, the bodies
+        that can be patched on their own are deferred during the visit (see `defer_body`)
+        and patched in parallel before the setup prelude is built.
+        """
+        self.deferred: List[DeferredBody] = []
 
     def build_setup_prelude(self) -> str:
         buf = ""
         buf += "#include <stdio.h>      /* printf */\n"
-        buf += "#include <stdlib.h>     /* strtol */\n"
+        buf += "#include <stdlib.h>     /* strtol, strtod */\n"
         buf += "#include <assert.h>     /* assert */\n\n"
         types = set(self.macros[m_name] for m_name in self.macros)
+        if len(types) > 0:
+            # undefined variables are always int
+            types.add("int")
 
-        # TODO: handle non-int data types
-        for t in types:
+        for t in sorted(types):
             buf += f"#define UNDEFINED_{t.capitalize()} 0xdeadbeef\n"
         for m_name in self.macros:
             t = self.macros[m_name]
             buf += f"{t} {m_name} = UNDEFINED_{t.capitalize()};\n"
 
-        buf += "\nint setup_env_vars() {\n"
-        for m_name in self.macros:
-            buf += f'  char* {m_name}_env_str = getenv("{m_name}");\n'
-            buf += f"  if ({m_name}_env_str)"
-            # TODO: handle non-int data types
-            buf += f" {m_name} = strtol({m_name}_env_str, NULL, 10);\n"
+        for flag in self.cond_flags.values():
+            buf += f"int {flag} = 0;\n"
+
+        if len(self.fn_table_types) > 0:
+            buf += "\nstatic void rt_fn_missing(void) { assert(0); }\n"
+            for fn_name in self.fn_table_types:
+                buf += f"static void (*rt_fn_{fn_name})(void) = rt_fn_missing;\n"
+            buf += "static void rt_setup_fn_tables(void);\n"
 
+        if len(self.macros) > 0:
+            buf += "\n" + build_config_loader(self.macros)
+
+        buf += "\nint setup_env_vars() {\n"
+        if len(self.macros) > 0:
+            buf += f'  const char* rt_config = getenv("{CONFIG_ENV_VAR}");\n'
+            buf += "  int rt_err = rt_config ? rt_load_config(rt_config) : rt_load_env();\n"
+            buf += "  if (rt_err != 0) return rt_err;\n"
+        for expr, flag in self.cond_flags.items():
+            buf += f"  {flag} = {expr};\n"
+        if len(self.fn_table_types) > 0:
+            buf += "  rt_setup_fn_tables();\n"
         buf += "  return 0;\n"
         buf += "}\n\n"
 
         return buf
 
+    def macro_type(self, name: str) -> str:
+        return self.macro_types.get(name, "int")
+
+    def cond_flag(self, expr: str) -> CondFlag:
+        """
+        The flag computing the condition `expr`, shared by every branch with the same condition.
+        """
+        if expr not in self.cond_flags:
+            self.cond_flags[expr] = f"rt_cond_{len(self.cond_flags) + 1}"
+        return CondFlag(self.cond_flags[expr])
+
+    def branch_conds(self, branches: List[ast.AstNode]) -> List[Macro]:
+        """
+        The condition of each branch of a conditional chain (see `conditional_branches`).
+        A plain `#ifdef`/`#ifndef` with an optional `#else` tests the macro directly,
+        other chains get one precomputed flag per branch.
+        Raises UnsupportedCondition if a condition can't be compiled.
+        """
+        if all(isinstance(b, (ast.PreprocIfdef, ast.PreprocElse)) for b in branches):
+            name = branches[0].get_named_child(0).text
+            self.macros[name] = self.macro_type(name)
+            negated = branches[0].children[0].text == "#ifndef"
+            return [
+                Macro(name, self.macros[name], def_cond=negated),
+                Macro(name, self.macros[name], def_cond=not negated),
+            ][: len(branches)]
+
+        preds = []
+        for branch in branches:
+            if isinstance(branch, ast.PreprocElse):
+                break
+            if isinstance(branch, (ast.PreprocIfdef, ast.PreprocElifdef)):
+                pred = Defined(branch.get_named_child(0).text)
+                if branch.children[0].text in ("#ifndef", "#elifndef"):
+                    pred = Unary("!", pred)
+            else:
+                pred = compile_condition(branch.get_named_child(0))
+            preds.append(pred)
+        for pred in preds:
+            for name in sorted(pred.macros()):
+                self.macros[name] = self.macro_type(name)
+
+        # a branch is taken if its condition holds and none of the earlier ones did
+        conds: List[Macro] = []
+        prior: List[str] = []
+        for pred in preds:
+            cond = pred.to_c(self.macros)
+            conds.append(self.cond_flag(" && ".join(prior + [cond])))
+            prior.append(f"!{cond}")
+        if len(conds) < len(branches):
+            conds.append(self.cond_flag(" && ".join(prior)))
+        chain = tuple(cond.name for cond in conds)
+        exhaustive = isinstance(branches[-1], ast.PreprocElse)
+        return [CondFlag(cond.name, chain=chain, exhaustive=exhaustive) for cond in conds]
+
+    def build_fn_table_setup(self) -> str:
+        """
+        Builds the function that points each function table entry at the variant
+        selected by the configuration. It goes at the end of the file, after all the variants.
+        Variants with a different signature than the call sites were cast to are never selected.
+        """
+        buf = "\nstatic void rt_setup_fn_tables(void) {\n"
+        for fn_name, pointer_type in self.fn_table_types.items():
+            keyword = "if"
+            for i, fn_decl in enumerate(self.symbols.fn_decls[fn_name]):
+                if fn_decl.pointer_type() != pointer_type:
+                    continue
+                variant = fn_name + "_" + str(i + 1) if i > 0 else fn_name
+                buf += f"  {keyword} ({macro_set_to_c(fn_decl.macro_set)})"
+                buf += f" rt_fn_{fn_name} = (void (*)(void)){variant};\n"
+                keyword = "else if"
+        buf += "}\n"
+        return buf
+
+    def use_fn_tables(
+        self, node: ast.AstNode, rename_dict: dict[str, List[VarIdent]]
+    ) -> tuple[ast.AstNode, dict[str, List[VarIdent]]]:
+        """
+        Replaces references to conditionally defined functions whose variants all share a signature
+        with a call through that function's table entry.
+        Returns the rewritten node and the rename dict of the identifiers left to duplicate over.
+        """
+        calls: dict[str, str] = {}
+        remaining: dict[str, List[VarIdent]] = {}
+        for ident, var_idents in rename_dict.items():
+            decls = [var_ident.decl for var_ident in var_idents]
+            if (
+                all(isinstance(decl, FuncDecl) for decl in decls)
+                and any(len(var_ident.macro_set) > 0 for var_ident in var_idents)
+                and len(set(decl.signature() for decl in decls)) == 1
+            ):
+                pointer_type = decls[0].pointer_type()
+                self.fn_table_types.setdefault(ident, pointer_type)
+                if self.fn_table_types[ident] == pointer_type:
+                    calls[ident] = f"(({pointer_type})rt_fn_{ident})"
+                    continue
+            remaining[ident] = var_idents
+        return node.rename_idents(calls), remaining
+
     def visit_children(
         self,
         node: ast.AstNode,
         ctx: PatchCtx,
+        skip: Optional[ast.AstNode] = None,
     ) -> MoveUpMsg:
-        move_up_all = MoveUpMsg()
-        i = 0
-
-        while i < len(node.children):
-            up_msg: MoveUpMsg = node.children[i].accept(self, ctx.clone(node))
-            move_up_all.var_idents.update(up_msg.var_idents)
+        move_up_all: Sequence[ast.AstNode] = ()
+        ctx_macro_set = set(ctx.get_ifdef_cond_stack())
+        # the edits are applied once all the children are visited,
+        # so the positions below are the ones from before the visit
+        edits = node.edit_children()
+
+        for i, child in enumerate(node.children):
+            if child is skip or not self.needs_patch(child, ctx, ctx_macro_set):
+                continue
+            up_msg: MoveUpMsg = child.accept(self, ctx.clone(node))
             move_ups = up_msg.move_ups
             new_node = up_msg.node
             if ctx.in_ifdef:
-                move_up_all.move_ups.extend(move_ups)
+                move_up_all = merge_move_ups(move_up_all, move_ups)
             elif len(move_ups) > 0:
                 # for variable declarations, we need to add them to the ctx's var_decls dict
                 for move_node in move_ups:
@@ -143,31 +357,47 @@ class PatchVisitor(IVisitor):
                         # Now this is done in the PreprocDef visitor itself to handle the parent-child relationship
                         # of the preproc ifdef + else
                         # This would be run after the ifdef AND else, but we need it to run after the ifdef (so else would catch it)
-                        # self.defines[move_node.def_decl.name].append(move_node.def_decl)
+                        # self.symbols.add_define(move_node.def_decl.name, move_node.def_decl)
                         pass
 
                 # since we are now out of the ifdef block, we need to convert the move_up nodes to
                 # real AST nodes (in the case of VariableDeclarationMarker) and put them in the children list
-                move_ups = [update_if_marker(node, ctx) for node in move_ups]
-                node.children = node.children[:i] + move_ups + node.children[i:]
-                i += len(move_ups)
+                edits.insert(i, [update_if_marker(node, ctx) for node in move_ups])
             # a bit hacky, delete the semicolon after a call expression is converted to an if chain
             if (
-                isinstance(node.children[i], ast.CallExpression)
+                isinstance(child, ast.CallExpression)
                 and new_node != None
                 and not isinstance(new_node, ast.CallExpression)
             ):
                 for j in range(i + 1, len(node.children)):
                     if node.children[j].text == ";":
-                        node.children[j] = ast.Whitespace(" ")
+                        edits.replace(j, ast.Whitespace(" "))
                         break
             if new_node is not None:
-                node.children[i] = new_node
-            i += 1
-        return move_up_all
+                edits.replace(i, new_node)
+        edits.apply()
+        return MoveUpMsg(None, move_up_all) if len(move_up_all) > 0 else MoveUpMsg.EMPTY
+
+    def needs_patch(
+        self, node: ast.AstNode, ctx: PatchCtx, ctx_macro_set: Set[Macro]
+    ) -> bool:
+        """
+        Whether visiting this node could rewrite it or produce move ups.
+        Subtrees without preprocessor conditionals, definitions to register or hoist,
+        or references to identifiers with variability can be skipped entirely.
+        """
+        summary = node.variability()
+        if summary.has_preproc or summary.has_function:
+            return True
+        if ctx.in_ifdef and summary.has_declaration:
+            return True
+        return any(
+            self.symbols.has_variability(ident, ctx.var_decls, ctx_macro_set)
+            for ident in summary.idents
+        )
 
     def build_rename_dict(
-        self, ctx: PatchCtx, var_idents: Set[str]
+        self, ctx: PatchCtx, var_idents: Iterable[str]
     ) -> dict[str, List[VarIdent]]:
         """
         Builds a rename dictionary for the given variable identifiers.
@@ -175,54 +405,20 @@ class PatchVisitor(IVisitor):
         Multiple renames are possible in the case of multiple ifdef conditions that refer to the same variable identifier.
         We also restrict the possibilities to the set of ifdef conditions that are not already in the current ifdef cond stack.
         """
-        rename_dict: dict[str, List[VarIdent]] = defaultdict(list)
+        rename_dict: dict[str, List[VarIdent]] = {}
         ctx_macro_set = set(ctx.get_ifdef_cond_stack())
+        # only the identifiers the node actually references are looked up,
+        # and a variable, function, or macro definition can all share one name
         for ident in var_idents:
-            # if the identifier is in the macro set, we'll need to duplicate and rename
-            # let's gather up all the variable decls that match this identifier
-            if ident in ctx.var_decls:
-                for i, var_decl in enumerate(ctx.var_decls[ident]):
-                    # we only need to rename in the case where a macro
-                    # is in both the current ifdef cond stack and the variable decl's macro set
-                    remainder_macro_set = var_decl.macro_set - ctx_macro_set
-
-                    # TODO: move this renaming functionality into data.py
-                    renamed_var_ident = VarIdent(
-                        ident + "_" + str(i + 1) if i > 0 else ident,
-                        remainder_macro_set,
-                        orig_name=ident,
-                    )
-                    rename_dict[ident].append(renamed_var_ident)
-            # if there are none (in the case of left hand init declarators), we don't need to rename
-            # so no need for an else case here
-
-        # handle function identifiers here too
-        for ident in var_idents:
-            for i, fn_decl in enumerate(self.fn_decls[ident]):
-                remainder_macro_set = fn_decl.macro_set - ctx_macro_set
-                renamed_var_ident = VarIdent(
-                    ident + "_" + str(i + 1) if i > 0 else ident,
-                    remainder_macro_set,
-                    orig_name=ident,
-                )
-                rename_dict[ident].append(renamed_var_ident)
-
-        for ident in self.defines:
-            for i, def_decl in enumerate(self.defines[ident]):
-                remainder_macro_set = def_decl.macro_set - ctx_macro_set
-                renamed_var_ident = VarIdent(
-                    ident + "_" + str(i + 1) if i > 0 else ident,
-                    remainder_macro_set,
-                    orig_name=ident,
-                )
-                rename_dict[ident].append(renamed_var_ident)
+            renames = self.symbols.renames(ident, ctx.var_decls, ctx_macro_set)
+            if len(renames) > 0:
+                rename_dict[ident] = renames
         return rename_dict
 
     def multiversal_duplication(
         self,
         node: ast.AstNode,
         ctx: PatchCtx,
-        up_msg: MoveUpMsg,
         rename_dict: dict[str, List[VarIdent]] = None,
     ) -> ast.AstNode:
         """
@@ -234,7 +430,7 @@ class PatchVisitor(IVisitor):
         If there are no variable identifiers that need to be renamed, this function returns None.
         """
         if rename_dict is None:
-            rename_dict = self.build_rename_dict(ctx, up_msg.var_idents)
+            rename_dict = self.build_rename_dict(ctx, node.ident_index().keys())
         # if the macro set is empty for all the variables, we don't need to do anything
         # without this, the code still works but emits extra if (1) {...} statements unnecessarily
         if all(
@@ -243,67 +439,231 @@ class PatchVisitor(IVisitor):
         ):
             return None
 
-        # now for each of the combinations of renames, we need to duplicate the node and replace the identifiers
-        out_node = ast.CompoundStatement()
-        for i, combination in enumerate(itertools.product(*rename_dict.values())):
-            new_node = node.deepcopy()
-            if not all(
-                var_ident.orig_name == var_ident.name for var_ident in combination
+        if self.fn_tables:
+            node, rename_dict = self.use_fn_tables(node, rename_dict)
+            if all(
+                all(len(var_ident.macro_set) == 0 for var_ident in var_idents)
+                for var_idents in rename_dict.values()
             ):
-                for var_ident in combination:
-                    new_node.replace_ident(var_ident.orig_name, var_ident.name)
-
-            # now add an if statement around it using the macros in combination
-            if_statement = ast.IfStatement()
-            if_statement.children = [
-                ast.Unnamed("if" if i == 0 else "else if"),
-                ast.Whitespace(" "),
-                ast.Unnamed("("),
+                return node
+
+        combinations = math.prod(len(var_idents) for var_idents in rename_dict.values())
+        reason = self.over_budget(combinations)
+        if reason is not None:
+            orig_node = node
+            node, rename_dict = self.select_variants(node, rename_dict)
+            emitted = math.prod(len(var_idents) for var_idents in rename_dict.values())
+            self.degraded_sites.append(
+                DegradedSite(
+                    source_line(orig_node),
+                    " ".join(str(orig_node).split())[:60],
+                    combinations,
+                    emitted,
+                    reason,
+                )
+            )
+            combinations = emitted
+            if all(
+                all(len(var_ident.macro_set) == 0 for var_ident in var_idents)
+                for var_idents in rename_dict.values()
+            ):
+                self.combinations_emitted += 1
+                return node
+        self.combinations_emitted += combinations
+
+        # now for each of the combinations of renames, we need to duplicate the node and replace the identifiers
+        cases = []
+        ctx_conds = ctx.get_ifdef_cond_stack()
+        for combination in itertools.product(*rename_dict.values()):
+            # unchanged subtrees are shared between all the duplicates
+            renames = {
+                var_ident.orig_name: var_ident.name
+                for var_ident in combination
+                if var_ident.orig_name != var_ident.name
+            }
+            new_node = node.rename_idents(renames) if renames else node
+            # guarded by the macros in the combination
+            conds = [
+                cond_macro
+                for var_ident in combination
+                for cond_macro in sorted(var_ident.macro_set, key=Macro.sort_key)
             ]
-            # TODO: filter out incompatible macros
-            for var_ident in combination:
-                for cond_macro in var_ident.macro_set:
-                    if_statement.children.extend(
-                        [
-                            ast.Whitespace(" "),
-                            ast.Identifier(cond_macro.name),
-                            ast.Whitespace(" "),
-                            ast.Unnamed("==" if cond_macro.def_cond else "!="),
-                            ast.Whitespace(" "),
-                            # TODO: handle other data types
-                            ast.Custom("UNDEFINED_Int"),
-                            ast.Whitespace(" "),
-                            ast.Unnamed("&&"),
-                            ast.Whitespace(" "),
-                        ]
+            if contradicts(conds + ctx_conds):
+                # this site is only reached when the context's conditions hold
+                continue
+            cases.append(
+                (conds, [ast.Whitespace("\n"), new_node, ast.Whitespace("\n")])
+            )
+        return ast_ext.DispatchBlock(cases, assert_unmatched=True)
+
+    def over_budget(self, combinations: int) -> Optional[str]:
+        """
+        Returns why a site with this many combinations is over budget, or None if it isn't.
+        """
+        if (
+            self.max_site_combinations is not None
+            and combinations > self.max_site_combinations
+        ):
+            return f"over the site budget of {self.max_site_combinations}"
+        if (
+            self.max_file_combinations is not None
+            and self.combinations_emitted + combinations > self.max_file_combinations
+        ):
+            return f"over the file budget of {self.max_file_combinations}"
+        return None
+
+    def variant_selector(self, var_idents: List[VarIdent]) -> Optional[str]:
+        """
+        Builds a C expression that picks the right variant of an identifier at runtime,
+        ie: `(*(FOO != UNDEFINED_Int ? &x : &x_2))` for a variable.
+        This only works if all the variants are variables of the same type,
+        or functions with the same signature; otherwise returns None.
+        """
+        decls = [var_ident.decl for var_ident in var_idents]
+        if all(isinstance(decl, VarDecl) for decl in decls):
+            if len(set(decl.type for decl in decls)) != 1:
+                return None
+            ref = "&"
+        elif all(isinstance(decl, FuncDecl) for decl in decls):
+            if len(set(decl.signature() for decl in decls)) != 1:
+                return None
+            ref = ""
+        else:
+            # macro definitions can't be selected between at runtime
+            return None
+        expr = ""
+        for var_ident in var_idents:
+            if len(var_ident.macro_set) == 0:
+                expr += f"{ref}{var_ident.name}"
+                break
+            expr += f"{macro_set_to_c(var_ident.macro_set)} ? {ref}{var_ident.name} : "
+        else:
+            expr += f"(assert(0), {ref}{var_idents[0].name})"
+        return f"(*({expr}))" if ref else f"({expr})"
+
+    def select_variants(
+        self, node: ast.AstNode, rename_dict: dict[str, List[VarIdent]]
+    ) -> tuple[ast.AstNode, dict[str, List[VarIdent]]]:
+        """
+        The cheaper encoding for sites over the combination budget:
+        identifiers that can be selected at runtime (see `variant_selector`)
+        are replaced in place by their selector, so they no longer multiply the number of duplicates.
+        Returns the rewritten node and the rename dict of the identifiers left to duplicate over.
+        """
+        selectors: dict[str, str] = {}
+        remaining: dict[str, List[VarIdent]] = {}
+        for ident, var_idents in rename_dict.items():
+            selector = None
+            if any(len(var_ident.macro_set) > 0 for var_ident in var_idents):
+                selector = self.variant_selector(var_idents)
+            if selector is None:
+                remaining[ident] = var_idents
+            else:
+                selectors[ident] = selector
+        return node.rename_idents(selectors), remaining
+
+    def defer_body(self, node: ast.FunctionDefinition, ctx: PatchCtx) -> bool:
+        """
+        Defers the body of a function to `deferred` if it can be patched in a worker process,
+        returning whether it did. That is the body of a top-level function other than main
+        without preprocessor directives, which can't register anything the rest of the file sees.
+        The file combination budget is spent in file order, so nothing is deferred with one.
+        """
+        if self.jobs <= 1 or self.max_file_combinations is not None:
+            return False
+        if ctx.in_ifdef or not isinstance(ctx.parent, ast.TranslationUnit):
+            return False
+        func_decl = node.get_child_by_name("declarator")
+        body = node.get_child_by_name("body")
+        if body is None or func_decl.get_child_by_name("declarator").text == "main":
+            return False
+        summary = body.variability()
+        if summary.has_preproc or summary.has_function:
+            return False
+        if not self.needs_patch(body, ctx, set()):
+            return False
+        # the body only ever looks up its own identifiers
+        self.deferred.append(
+            DeferredBody(
+                node,
+                node.children.index(body),
+                {
+                    ident: ctx.var_decls[ident]
+                    for ident in summary.idents
+                    if ident in ctx.var_decls
+                },
+                {
+                    ident: (
+                        len(self.symbols.fn_decls.get(ident, ())),
+                        self.symbols.define_count(ident),
                     )
-            if_statement.children.append(ast.TrueBool("1"))
-            if_statement.children.extend(
-                [
-                    ast.Unnamed(")"),
-                    ast.Unnamed("{"),
-                    ast.Whitespace("\n"),
-                    new_node,
-                    ast.Whitespace("\n"),
-                    ast.Unnamed("}"),
-                    ast.Whitespace("\n"),
-                ]
+                    for ident in summary.idents
+                },
+                len(self.fn_table_types),
+                len(self.degraded_sites),
             )
-            out_node.children.append(if_statement)
-
-        else_clause = ast.ElseClause()
-        else_clause.children = [
-            ast.Unnamed("else"),
-            ast.Whitespace(" "),
-            ast.Unnamed("{"),
-            ast.Whitespace("\n"),
-            ast.Custom("assert(0);\n"),
-            ast.Unnamed("}"),
-            ast.Whitespace("\n"),
-        ]
-        out_node.children.append(else_clause)
-
-        return out_node
+        )
+        return True
+
+    def patch_deferred_body(self, deferred: DeferredBody) -> DeferredResult:
+        """
+        Patch a deferred body in place, as the serial visit would have at its function.
+        """
+        visitor = copy.copy(self)
+        visitor.symbols = SymbolIndex()
+        for ident, (fn_count, define_count) in deferred.decl_counts.items():
+            if fn_count > 0:
+                visitor.symbols.fn_decls[ident] = self.symbols.fn_decls[ident][:fn_count]
+            if define_count > 0:
+                visitor.symbols.defines[ident] = self.symbols.defines[ident][:define_count]
+        visitor.fn_table_types = {}
+        visitor.degraded_sites = []
+        visitor.combinations_emitted = 0
+        visitor.deferred = []
+
+        body = deferred.function.children[deferred.body_pos]
+        up_msg = body.accept(
+            visitor,
+            PatchCtx(
+                parent=deferred.function,
+                var_decls=defaultdict(list, copy.deepcopy(deferred.var_decls)),
+            ),
+        )
+        assert up_msg.node is None and len(up_msg.move_ups) == 0
+        return DeferredResult(
+            body,
+            visitor.fn_table_types,
+            visitor.degraded_sites,
+            visitor.combinations_emitted,
+        )
+
+    def merge_deferred(self, results: List[DeferredResult]) -> None:
+        """
+        Put the patched bodies back in their functions, and interleave what patching them added
+        to the visitor's state with the rest, in the order the serial visit would have added it.
+        """
+        fn_table_types = list(self.fn_table_types.items())
+        degraded_sites = self.degraded_sites
+        self.fn_table_types = {}
+        self.degraded_sites = []
+        fn_table_pos = 0
+        degraded_pos = 0
+        for deferred, result in zip(self.deferred, results):
+            for ident, pointer_type in fn_table_types[fn_table_pos : deferred.fn_table_mark]:
+                self.fn_table_types.setdefault(ident, pointer_type)
+            for ident, pointer_type in result.fn_table_types.items():
+                self.fn_table_types.setdefault(ident, pointer_type)
+            fn_table_pos = deferred.fn_table_mark
+            self.degraded_sites.extend(degraded_sites[degraded_pos : deferred.degraded_mark])
+            self.degraded_sites.extend(result.degraded_sites)
+            degraded_pos = deferred.degraded_mark
+            self.combinations_emitted += result.combinations_emitted
+            if not result.body.is_original():
+                deferred.function.replace_child(deferred.body_pos, result.body)
+        for ident, pointer_type in fn_table_types[fn_table_pos:]:
+            self.fn_table_types.setdefault(ident, pointer_type)
+        self.degraded_sites.extend(degraded_sites[degraded_pos:])
+        self.deferred = []
 
     """Visitor functions below"""
 
@@ -311,12 +671,18 @@ class PatchVisitor(IVisitor):
     def visit(self, node: ast.TranslationUnit, ctx: PatchCtx) -> MoveUpMsg:
         up_msg = self.visit_children(node, ctx)
         assert len(up_msg.move_ups) == 0
-        node.children.insert(0, ast.Custom(self.build_setup_prelude()))
-        return MoveUpMsg(node, up_msg.move_ups)
+        if len(self.deferred) > 0:
+            self.merge_deferred(patch_deferred(self))
+        node.insert_children(0, [ast.Custom(self.build_setup_prelude())])
+        if len(self.fn_table_types) > 0:
+            node.insert_children(
+                len(node.children), [ast.Custom(self.build_fn_table_setup())]
+            )
+        return up_msg
 
     @visit.register
     def _(self, node: ast.Identifier, ctx: PatchCtx) -> MoveUpMsg:
-        return MoveUpMsg(node, var_idents=[node.text])
+        return MoveUpMsg.EMPTY
 
     @visit.register
     def _(self, node: ast.PreprocDef, ctx: PatchCtx) -> MoveUpMsg:
@@ -324,20 +690,21 @@ class PatchVisitor(IVisitor):
         if ctx.in_ifdef:
             orig_name = node.get_named_child(0).text
             name = orig_name
-            if name in self.defines:
+            if self.symbols.define_count(name) > 0:
                 # if there is already a definition for this macro, we need to rename it
-                name = name + "_" + str(len(self.defines[name]) + 1)
+                name = name + "_" + str(self.symbols.define_count(name) + 1)
             def_decl = DefDecl(
                 name,
                 node.get_named_child(1).text,
                 set(ctx.get_ifdef_cond_stack()),
                 orig_name=orig_name,
             )
-            self.defines[orig_name].append(def_decl)
+            self.symbols.add_define(orig_name, def_decl)
 
-            up_msg.move_ups.append(ast_ext.PreprocDefinitionMarker(def_decl))
-            return MoveUpMsg(ast.Whitespace("\n"), up_msg.move_ups)
-        return MoveUpMsg(node, up_msg.move_ups)
+            return up_msg.move_up(ast_ext.PreprocDefinitionMarker(def_decl)).with_node(
+                ast.Whitespace("\n")
+            )
+        return up_msg
 
     @visit.register
     def _(self, node: ast.PreprocFunctionDef, ctx: PatchCtx) -> MoveUpMsg:
@@ -345,9 +712,9 @@ class PatchVisitor(IVisitor):
         if ctx.in_ifdef:
             orig_name = node.get_named_child(0).text
             name = orig_name
-            if name in self.defines:
+            if self.symbols.define_count(name) > 0:
                 # if there is already a definition for this macro, we need to rename it
-                name = name + "_" + str(len(self.defines[name]) + 1)
+                name = name + "_" + str(self.symbols.define_count(name) + 1)
 
             def_fn_decl = DefFnDecl(
                 name,
@@ -356,106 +723,61 @@ class PatchVisitor(IVisitor):
                 set(ctx.get_ifdef_cond_stack()),
                 orig_name=orig_name,
             )
-            self.defines[orig_name].append(def_fn_decl)
+            self.symbols.add_define(orig_name, def_fn_decl)
 
-            up_msg.move_ups.append(ast_ext.PreprocDefinitionMarker(def_fn_decl))
-            return MoveUpMsg(ast.Whitespace("\n"), up_msg.move_ups)
-        return MoveUpMsg(node, up_msg.move_ups)
+            return up_msg.move_up(ast_ext.PreprocDefinitionMarker(def_fn_decl)).with_node(
+                ast.Whitespace("\n")
+            )
+        return up_msg
 
     @visit.register
-    def _(self, node: ast.PreprocElse, ctx: PatchCtx) -> MoveUpMsg:
-        up_msg = self.visit_children(
-            node,
-            PatchCtx(
-                parent=node,
-                in_ifdef=True,
-                parent_ctx=ctx.parent_ctx,  # we skip the ctx of the ifdef to act like preproc else is on the same syntax level as the ifdef
-                ifdef_cond=Macro(
-                    ctx.ifdef_cond.name,
-                    ctx.ifdef_cond.type,
-                    def_cond=True,
+    def _(self, node: Union[ast.PreprocIfdef, ast.PreprocIf], ctx: PatchCtx) -> MoveUpMsg:
+        branches = conditional_branches(node)
+        try:
+            conds = self.branch_conds([branch for branch, _ in branches])
+        except UnsupportedCondition as e:
+            # leave it to the compiler
+            logger.warning(f"line {source_line(node)}: {e}, leaving it compile-time")
+            return MoveUpMsg.EMPTY
+
+        move_ups: Sequence[ast.AstNode] = ()
+        blocks: List[tuple[ast.AstNode, ast.CompoundStatement]] = []
+        for (branch, (body_children, body_named_idxs)), cond in zip(branches, conds):
+            # conditionals don't put the body in a compound statement, it's directly in the node children
+            body_block = ast.CompoundStatement()
+            body_block.children = body_children
+            body_block.children_named_idxs = body_named_idxs
+            up_msg = self.visit_children(
+                body_block,
+                PatchCtx(
+                    parent=branch,
+                    in_ifdef=True,
+                    parent_ctx=ctx,
+                    ifdef_cond=cond,
+                    var_decls=ctx.var_decls,
                 ),
-            ),
-        )
-        return MoveUpMsg(node, up_msg.move_ups)
+            )
+            move_ups = merge_move_ups(move_ups, up_msg.move_ups)
+            blocks.append((branch, body_block))
 
-    @visit.register
-    def _(self, node: ast.PreprocIfdef, ctx: PatchCtx) -> MoveUpMsg:
-        up_msg = self.visit_children(
-            node,
-            PatchCtx(
-                parent=node,
-                in_ifdef=True,
-                parent_ctx=ctx,
-                ifdef_cond=Macro(node.get_named_child(0).text, "int"),
-            ),
-        )
+        # if the bodies are empty or all children are whitespace, then we can omit the conditional
+        if all(
+            isinstance(c, ast.Whitespace) or (isinstance(c, ast.Unnamed) and c.text.strip() == "")
+            for _, body_block in blocks
+            for c in body_block.children
+        ):
+            return MoveUpMsg(ast.Whitespace("\n"), move_ups)
 
-        identifier = node.get_named_child(0)
-        self.macros[identifier.text] = "int"
-
-        # ifdefs don't put all the body in a compound statement, they are just directly in the node children
-        # so body children starts after the identifier, and ends before the #else or #endif
-        start_idx = node.children_named_idxs.index(0) + 1
-        end_idx = next(
-            i
-            for i, child in enumerate(node.children)
-            if isinstance(child, ast.PreprocElse)
-            or isinstance(child, ast.PreprocElifdef)
-            or isinstance(child, ast.PreprocElif)
-            or (isinstance(child, ast.Unnamed) and child.text == "#endif")
+        new_node = ast_ext.DispatchBlock(
+            [([cond], [body_block]) for (_, body_block), cond in zip(blocks, conds)],
+            # the #else of a chain is taken whenever none of the branches before it are
+            exhaustive=isinstance(blocks[-1][0], ast.PreprocElse),
         )
-        body_children = node.children[start_idx:end_idx]
-
-        # if the body is empty or all children are whitespace, then we can omit the ifdef
-        if len(body_children) == 0 or all(
-            isinstance(c, ast.Whitespace) for c in body_children
-        ):
-            return MoveUpMsg(ast.Whitespace("\n"), up_msg.move_ups)
-
-        body_block = ast.CompoundStatement()
-        body_block.children = body_children
-
-        new_node = ast.IfStatement()
-        new_node.children = [
-            ast.Unnamed("if"),
-            ast.Whitespace(" "),
-            ast.Unnamed("("),
-            node.get_named_child(0),
-            ast.Unnamed("==" if ctx.ifdef_cond and ctx.ifdef_cond.def_cond else "!="),
-            ast.Identifier("UNDEFINED_Int"),  # TODO: handle types other than int
-            ast.Unnamed(")"),
-            ast.Whitespace(" "),
-            ast.Unnamed("{"),
-            body_block,
-            ast.Unnamed("}"),
-            ast.Whitespace("\n"),
-        ]
-        # TODO: this will not work if we don't handle the named children modification correctly
-        if node.get_child_by_name("alternative") is not None:
-            # TODO handle else if
-            alt = node.get_child_by_name("alternative")
-            if isinstance(alt, ast.PreprocElse):
-                new_node.children.extend(
-                    [
-                        ast.Unnamed("else"),
-                        ast.Whitespace(" "),
-                        ast.Unnamed("{"),
-                        ast.Whitespace("\n"),
-                        alt.get_named_child(
-                            0
-                        ),  # FIXME: do something similar to the body children above
-                        ast.Whitespace("\n"),
-                        ast.Unnamed("}"),
-                        ast.Whitespace("\n"),
-                    ]
-                )
         if isinstance(ctx.parent, ast.TranslationUnit):
-            # if this is a top level ifdef, we need to move what this would become to the main function
+            # if this is a top level conditional, we need to move what this would become to the main function
             self.move_to_mains.append(new_node)
-            return MoveUpMsg(ast.Whitespace("\n"), up_msg.move_ups)
-        # TODO: update children_named_idxs
-        return MoveUpMsg(new_node, up_msg.move_ups)
+            return MoveUpMsg(ast.Whitespace("\n"), move_ups)
+        return MoveUpMsg(new_node, move_ups)
 
     @visit.register
     def _(self, node: ast.Declaration, ctx: PatchCtx) -> MoveUpMsg:
@@ -468,7 +790,8 @@ class PatchVisitor(IVisitor):
         else:
             name_node = init_decl.get_named_child(0)
         type_node = node.get_named_child(0)
-        type_str = type_node.text
+        # not a leaf for sized types, ie: `long` or `unsigned int`
+        type_str = str(type_node)
         if ctx.in_ifdef:
             # move this declaration up to the parent,
             # but with UndefinedInt as the initializer
@@ -483,7 +806,7 @@ class PatchVisitor(IVisitor):
                     macro_set,
                 )
             )
-            up_msg.move_ups.append(move_up_node)
+            up_msg = up_msg.move_up(move_up_node)
             new_node = None
 
             # if it wasn't an identifier, then the declaration was an init declarator
@@ -498,11 +821,11 @@ class PatchVisitor(IVisitor):
                     ast.Unnamed(";"),
                     ast.Whitespace("\n"),
                 ]
-                dup_node = self.multiversal_duplication(new_node, ctx, up_msg)
+                dup_node = self.multiversal_duplication(new_node, ctx)
                 if dup_node is not None:
                     new_node = dup_node
 
-            return MoveUpMsg(new_node, up_msg.move_ups)
+            return up_msg.with_node(new_node)
         elif isinstance(init_decl, ast.InitDeclarator):
             # if this is an init declarator, ie: int x = 5;
             # we need to check if there is variability in the initializer
@@ -511,7 +834,7 @@ class PatchVisitor(IVisitor):
             # and then add the assignments for each combination of ifdef conditions
             init_rhs = init_decl.get_named_child(1)
 
-            rename_dict = self.build_rename_dict(ctx, up_msg.var_idents)
+            rename_dict = self.build_rename_dict(ctx, node.ident_index().keys())
             has_variability = not all(
                 all(len(var_ident.macro_set) == 0 for var_ident in var_idents)
                 for var_idents in rename_dict.values()
@@ -539,77 +862,75 @@ class PatchVisitor(IVisitor):
                     ast.Whitespace("\n"),
                 ]
                 dup_assigns = self.multiversal_duplication(
-                    assign_node, ctx, up_msg, rename_dict=rename_dict
+                    assign_node, ctx, rename_dict=rename_dict
                 )
                 if dup_assigns is not None:
                     compound_stmt.children.append(dup_assigns)
                 else:
                     compound_stmt.children.append(assign_node)
-                return MoveUpMsg(compound_stmt, up_msg.move_ups)
-            return MoveUpMsg(None, up_msg.move_ups)
+                return up_msg.with_node(compound_stmt)
+        return up_msg
 
     @visit.register
     def _(self, node: ast.FunctionDefinition, ctx: PatchCtx) -> MoveUpMsg:
-        up_msg = self.visit_children(node, ctx)
-
-        func_decl = node.get_named_child(1)
-        func_name = func_decl.get_named_child(0).text
-        self.fn_decls[func_name].append(
-            FuncDecl(func_decl, set(ctx.get_ifdef_cond_stack()))
+        if self.defer_body(node, ctx):
+            up_msg = self.visit_children(node, ctx, skip=node.get_child_by_name("body"))
+        else:
+            up_msg = self.visit_children(node, ctx)
+
+        func_decl = node.get_child_by_name("declarator")
+        func_name = func_decl.get_child_by_name("declarator").text
+        fn_count = self.symbols.add_fn_decl(
+            func_name,
+            FuncDecl(
+                func_decl,
+                set(ctx.get_ifdef_cond_stack()),
+                ret_type=str(node.get_child_by_name("type")),
+            ),
         )
-        if len(self.fn_decls[func_name]) > 1:
+        if fn_count > 1:
             # if there are multiple function decls for this name, we need to give it a different name
-            func_decl.set_named_child(
-                0, ast.Custom(f"{func_name}_{len(self.fn_decls[func_name])}")
-            )
-            node.set_named_child(1, func_decl)
+            func_decl.set_named_child(0, ast.Custom(f"{func_name}_{fn_count}"))
         if func_name == "main":
-            body = node.get_named_child(2)
-            for i in range(len(body.children)):
-                if body.children[i].text == "{":
-                    body.children.insert(i + 1, ast.Custom(setup_env_vars_run_str))
-                    for j, move_node in enumerate(self.move_to_mains):
-                        body.children.insert(i + 2 + j, move_node)
-                    break
-            else:
+            body = node.get_child_by_name("body")
+            # the compound statement starts with its `{`
+            if len(body.children) == 0 or body.children[0].text != "{":
                 raise Exception("No opening brace found in main function body")
-            node.set_named_child(2, body)
-            return MoveUpMsg(node, up_msg.move_ups)
+            body.insert_children(
+                1, [ast.Custom(setup_env_vars_run_str), *self.move_to_mains]
+            )
+            return up_msg
         else:
             # if in ifdef block, move this function definition up to the parent
             if ctx.in_ifdef:
-                body = node.get_named_child(2)
-                for i in range(len(body.children)):
-                    if body.children[i].text == "{":
-                        for cond_macro in ctx.get_ifdef_cond_stack():
-                            body.children.insert(
-                                i + 1,
-                                ast.Custom(
-                                    f"\nassert({cond_macro.name} {'==' if cond_macro.def_cond else '!='} UNDEFINED_{cond_macro.type.capitalize()});\n"
-                                ),
-                            )
-                        break
-                else:
+                body = node.get_child_by_name("body")
+                if len(body.children) == 0 or body.children[0].text != "{":
                     raise Exception("No opening brace found for function body")
-                body.children.append(ast.Whitespace("\n"))
-                node.set_named_child(2, body)
-                up_msg.move_ups.append(node)
-                return MoveUpMsg(ast.Whitespace("\n"), up_msg.move_ups)
+                # innermost condition first
+                body.insert_children(
+                    1,
+                    [
+                        ast.Custom(f"\nassert({cond_macro.to_c()});\n")
+                        for cond_macro in reversed(
+                            list(dict.fromkeys(ctx.get_ifdef_cond_stack()))
+                        )
+                    ],
+                )
+                body.insert_children(len(body.children), [ast.Whitespace("\n")])
+                return up_msg.move_up(node).with_node(ast.Whitespace("\n"))
 
-        return MoveUpMsg(None, up_msg.move_ups)
+        return up_msg
 
     @visit.register
     def _(self, node: ast.ExpressionStatement, ctx: PatchCtx) -> MoveUpMsg:
         up_msg = self.visit_children(node, ctx)
         # Here is where we handle the magic of renaming variables based on their macro set
 
-        out_node = self.multiversal_duplication(node, ctx, up_msg)
+        out_node = self.multiversal_duplication(node, ctx)
 
-        # we consumed the var_idents here so they don't get moved up
-        return MoveUpMsg(out_node, up_msg.move_ups)
+        return up_msg.with_node(out_node)
 
     # General expressions...
     @visit.register
     def _(self, node: ast.AstNode, ctx: PatchCtx) -> MoveUpMsg:
-        up_msg = self.visit_children(node, ctx)
-        return MoveUpMsg(None, up_msg.move_ups, up_msg.var_idents)
+        return self.visit_children(node, ctx)
@@ -0,0 +1,234 @@
+"""
+A small predicate IR for `#if`/`#elif` conditions.
+
+Conditions are compiled from the reified condition expression once,
+then either evaluated at patch time (when every macro they use is fixed)
+or turned into the C expression that computes the condition flag at startup.
+"""
+
+from abc import ABC, abstractmethod
+from typing import Callable, Optional, Set
+import rt_preproc.parser.ast as ast
+
+
+class UnsupportedCondition(Exception):
+    """
+    The condition uses something the IR can't represent, ie: a function-like macro call.
+    """
+
+
+def _c_div(a: int, b: int) -> int:
+    if b == 0:
+        raise UnsupportedCondition("division by zero in condition")
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+
+def _c_mod(a: int, b: int) -> int:
+    return a - b * _c_div(a, b)
+
+
+binary_ops: dict[str, Callable[[int, int], int]] = {
+    "+": lambda a, b: a + b,
+    "-": lambda a, b: a - b,
+    "*": lambda a, b: a * b,
+    "/": _c_div,
+    "%": _c_mod,
+    "<<": lambda a, b: a << b,
+    ">>": lambda a, b: a >> b,
+    "<": lambda a, b: int(a < b),
+    "<=": lambda a, b: int(a <= b),
+    ">": lambda a, b: int(a > b),
+    ">=": lambda a, b: int(a >= b),
+    "==": lambda a, b: int(a == b),
+    "!=": lambda a, b: int(a != b),
+    "&": lambda a, b: a & b,
+    "|": lambda a, b: a | b,
+    "^": lambda a, b: a ^ b,
+}
+"""The operators `&&` and `||` short circuit, so they are handled separately."""
+
+unary_ops: dict[str, Callable[[int], int]] = {
+    "!": lambda a: int(not a),
+    "-": lambda a: -a,
+    "+": lambda a: a,
+    "~": lambda a: ~a,
+}
+
+
+class Pred(ABC):
+    @abstractmethod
+    def macros(self) -> Set[str]:
+        """
+        Names of the macros this condition depends on.
+        """
+
+    def value_macros(self) -> Set[str]:
+        """
+        The macros whose value the condition uses, not only whether they are defined.
+        """
+        return set()
+
+    @abstractmethod
+    def evaluate(self, values: dict[str, Optional[int]]) -> int:
+        """
+        Value of the condition, `values` maps each macro to its value, or None if undefined.
+        """
+
+    @abstractmethod
+    def to_c(self, macro_types: dict[str, str]) -> str:
+        """
+        C expression computing the condition from the runtime macro globals.
+        """
+
+
+class Const(Pred):
+    def __init__(self, value: int) -> None:
+        self.value = value
+
+    def macros(self) -> Set[str]:
+        return set()
+
+    def evaluate(self, values: dict[str, Optional[int]]) -> int:
+        return self.value
+
+    def to_c(self, macro_types: dict[str, str]) -> str:
+        return str(self.value)
+
+
+class Defined(Pred):
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def macros(self) -> Set[str]:
+        return {self.name}
+
+    def evaluate(self, values: dict[str, Optional[int]]) -> int:
+        return int(values[self.name] is not None)
+
+    def to_c(self, macro_types: dict[str, str]) -> str:
+        undefined = f"UNDEFINED_{macro_types[self.name].capitalize()}"
+        return f"({self.name} != {undefined})"
+
+
+class MacroValue(Pred):
+    """
+    The value of a macro, undefined macros are 0 like in the preprocessor.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def macros(self) -> Set[str]:
+        return {self.name}
+
+    def value_macros(self) -> Set[str]:
+        return {self.name}
+
+    def evaluate(self, values: dict[str, Optional[int]]) -> int:
+        value = values[self.name]
+        return value if value is not None else 0
+
+    def to_c(self, macro_types: dict[str, str]) -> str:
+        undefined = f"UNDEFINED_{macro_types[self.name].capitalize()}"
+        return f"({self.name} != {undefined} ? {self.name} : 0)"
+
+
+class Unary(Pred):
+    def __init__(self, op: str, operand: Pred) -> None:
+        self.op = op
+        self.operand = operand
+
+    def macros(self) -> Set[str]:
+        return self.operand.macros()
+
+    def value_macros(self) -> Set[str]:
+        return self.operand.value_macros()
+
+    def evaluate(self, values: dict[str, Optional[int]]) -> int:
+        return unary_ops[self.op](self.operand.evaluate(values))
+
+    def to_c(self, macro_types: dict[str, str]) -> str:
+        return f"({self.op}{self.operand.to_c(macro_types)})"
+
+
+class Binary(Pred):
+    def __init__(self, op: str, left: Pred, right: Pred) -> None:
+        self.op = op
+        self.left = left
+        self.right = right
+
+    def macros(self) -> Set[str]:
+        return self.left.macros() | self.right.macros()
+
+    def value_macros(self) -> Set[str]:
+        return self.left.value_macros() | self.right.value_macros()
+
+    def evaluate(self, values: dict[str, Optional[int]]) -> int:
+        left = self.left.evaluate(values)
+        if self.op == "&&":
+            return int(bool(left) and bool(self.right.evaluate(values)))
+        if self.op == "||":
+            return int(bool(left) or bool(self.right.evaluate(values)))
+        return binary_ops[self.op](left, self.right.evaluate(values))
+
+    def to_c(self, macro_types: dict[str, str]) -> str:
+        left = self.left.to_c(macro_types)
+        right = self.right.to_c(macro_types)
+        return f"({left} {self.op} {right})"
+
+
+def parse_int(text: str) -> int:
+    digits = text.rstrip("uUlL")
+    sign = 1
+    if digits.startswith(("-", "+")):
+        sign = -1 if digits[0] == "-" else 1
+        digits = digits[1:]
+    try:
+        if digits[:2] in ("0x", "0X"):
+            return sign * int(digits[2:], 16)
+        if digits[:2] in ("0b", "0B"):
+            return sign * int(digits[2:], 2)
+        if len(digits) > 1 and digits[0] == "0":
+            return sign * int(digits[1:], 8)
+        return sign * int(digits)
+    except ValueError:
+        raise UnsupportedCondition(f"not an integer: {text}")
+
+
+def compile_condition(node: ast.AstNode) -> Pred:
+    """
+    Compile the condition expression of a `#if`/`#elif` into the predicate IR.
+    Raises UnsupportedCondition for expressions the IR can't represent.
+    """
+    if isinstance(node, ast.PreprocDefined):
+        return Defined(node.get_named_child(0).text)
+    if isinstance(node, ast.Identifier):
+        return MacroValue(node.text)
+    if isinstance(node, ast.NumberLiteral):
+        return Const(parse_int(node.text))
+    if isinstance(node, ast.CharLiteral):
+        text = str(node)[1:-1]
+        char = text.encode().decode("unicode_escape") if text.startswith("\\") else text
+        if len(char) != 1:
+            raise UnsupportedCondition(f"unsupported char literal: {node}")
+        return Const(ord(char))
+    if isinstance(node, (ast.TrueBool, ast.FalseBool)):
+        return Const(1 if isinstance(node, ast.TrueBool) else 0)
+    if isinstance(node, ast.ParenthesizedExpression):
+        return compile_condition(node.get_named_child(0))
+    if isinstance(node, ast.UnaryExpression):
+        op = node.get_child_by_name("operator").text
+        if op not in unary_ops:
+            raise UnsupportedCondition(f"unsupported operator {op}")
+        return Unary(op, compile_condition(node.get_named_child(0)))
+    if isinstance(node, ast.BinaryExpression):
+        op = node.get_child_by_name("operator").text
+        if op not in binary_ops and op not in ("&&", "||"):
+            raise UnsupportedCondition(f"unsupported operator {op}")
+        return Binary(
+            op,
+            compile_condition(node.get_named_child(0)),
+            compile_condition(node.get_named_child(1)),
+        )
+    raise UnsupportedCondition(f"unsupported condition: {str(node).strip()}")
@@ -0,0 +1,320 @@
+"""
+Partial specialization of a file before patching.
+
+Conditionals on macros whose value is fixed at patch time are resolved statically,
+keeping only the branch that the compiler would have kept, so that only the
+macros chosen to be runtime get runtime dispatch and duplication.
+"""
+
+from typing import Iterable, List, Optional, Set, Tuple
+import copy
+import rt_preproc.parser.ast as ast
+from rt_preproc.visitors.patch.predicate import (
+    UnsupportedCondition,
+    compile_condition,
+    parse_int,
+)
+
+Child = Tuple[ast.AstNode, Optional[int]]
+"""A child node and its named child index (None if not named)."""
+
+alternative_types = (ast.PreprocElse, ast.PreprocElif, ast.PreprocElifdef)
+
+
+class SpecializationError(Exception):
+    """
+    A fixed macro can't be resolved the way the compiler would, ie: a `-D` value used in
+    a `#if` that isn't an integer.
+    """
+
+
+def defined_macros(root: ast.AstNode) -> Set[str]:
+    """
+    Names of the macros `#define`d under `root`.
+    """
+    names = set()
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, (ast.PreprocDef, ast.PreprocFunctionDef)):
+            names.add(node.get_named_child(0).text)
+        stack.extend(node.children)
+    return names
+
+
+def branch_bounds(node: ast.AstNode) -> Tuple[int, int]:
+    """
+    Start and end indexes of the body of a conditional branch in its children,
+    the end is the index of its alternative or `#endif` if it has one.
+    Both close the branch, so they are found from the end, past the trailing whitespace.
+    """
+    children = node.children
+    # the body starts after the macro name/condition
+    start_idx = 1 if isinstance(node, ast.PreprocElse) else node.named_position(0) + 1
+
+    def skip_whitespace(i: int) -> int:
+        while i >= start_idx and isinstance(children[i], ast.Whitespace):
+            i -= 1
+        return i
+
+    end_idx = len(children)
+    i = skip_whitespace(len(children) - 1)
+    if i >= start_idx and isinstance(children[i], ast.Unnamed) and children[i].text == "#endif":
+        end_idx = i
+        i = skip_whitespace(i - 1)
+    alternative = node.get_child_by_name("alternative")
+    if alternative is not None and i >= start_idx and children[i] is alternative:
+        end_idx = i
+    return start_idx, end_idx
+
+
+class Specialization:
+    """
+    Which macros are fixed at patch time, like `-D`/`-U` compiler flags.
+    """
+
+    def __init__(
+        self,
+        defined: Optional[dict[str, str]] = None,
+        undefined: Iterable[str] = (),
+        runtime: Optional[Iterable[str]] = None,
+    ) -> None:
+        self.defined = defined if defined is not None else {}
+        """Macro name -> value, for macros defined at patch time."""
+        self.undefined = set(undefined)
+        self.runtime = set(runtime) if runtime is not None else None
+        """
+        If set, only these macros are runtime,
+        and every other macro that isn't defined is undefined at patch time.
+        """
+        self.local: frozenset[str] = frozenset()
+        """
+        Macros the file defines itself, `runtime` leaves them to the patcher
+        rather than making them undefined.
+        """
+
+    def is_empty(self) -> bool:
+        return len(self.defined) == 0 and len(self.undefined) == 0 and self.runtime is None
+
+    def is_static(self, name: str) -> bool:
+        if name in self.defined or name in self.undefined:
+            return True
+        return self.runtime is not None and name not in self.runtime and name not in self.local
+
+    def for_file(self, local: Iterable[str]) -> "Specialization":
+        """
+        This specialization for a file defining the macros `local` itself.
+        """
+        spec = copy.copy(self)
+        spec.local = frozenset(local)
+        return spec
+
+    def value(self, name: str) -> Optional[int]:
+        """
+        Value of a fixed macro in a `#if`, None if it's undefined.
+        """
+        if name not in self.defined:
+            return None
+        try:
+            return parse_int(self.defined[name])
+        except UnsupportedCondition:
+            raise SpecializationError(
+                f"-D {name}={self.defined[name]} is used in a #if,"
+                " where its value must be an integer"
+            )
+
+    def defines_to_c(self) -> str:
+        """
+        Definitions of the fixed macros, for the code that still uses them outside of `#ifdef`.
+        """
+        buf = ""
+        for name, value in self.defined.items():
+            buf += f"#define {name} {value}\n"
+        for name in sorted(self.undefined):
+            buf += f"#undef {name}\n"
+        return buf
+
+    def apply(self, root: ast.AstNode) -> ast.AstNode:
+        """
+        Resolve the static conditionals under `root` in place.
+        """
+        spec = self.for_file(defined_macros(root)) if self.runtime is not None else self
+        root = spec.specialize_node(root)
+        if isinstance(root, ast.TranslationUnit) and len(self.defines_to_c()) > 0:
+            root.insert_children(0, [ast.Custom(self.defines_to_c())])
+        return root
+
+    def specialize_node(self, node: ast.AstNode) -> ast.AstNode:
+        """
+        Resolve the static conditionals under `node` in place, or in a copy put in its place
+        if it's shared with another tree (see `AstNode.writable`). Returns the node to use.
+        """
+        if len(node.children) == 0:
+            return node
+        # before the children, so their copies go under this one rather than replacing it
+        node = node.writable()
+        children = self.specialize_children(
+            list(zip(node.children, node.children_named_idxs))
+        )
+        if len(children) != len(node.children) or any(
+            child is not old for (child, _), old in zip(children, node.children)
+        ):
+            node.mark_modified()
+        named_idx = 0
+        node.children = []
+        node.children_named_idxs = []
+        for child, idx in children:
+            child.parent = node
+            node.children.append(child)
+            node.children_named_idxs.append(None if idx is None else named_idx)
+            if idx is not None:
+                named_idx += 1
+        # drop the fields of the children resolved away, a resolved `#elif` is the new alternative
+        kept = {id(child) for child, _ in children}
+        node._fields = {
+            name: child for name, child in node._fields.items() if id(child) in kept
+        }
+        for child, _ in children:
+            if isinstance(child, alternative_types):
+                node._fields["alternative"] = child
+        return node
+
+    def specialize_children(self, children: List[Child]) -> List[Child]:
+        out: List[Child] = []
+        for child, idx in children:
+            if isinstance(child, (ast.PreprocElif, ast.PreprocElifdef)):
+                # alternatives stay links of their chain
+                alternative = self.resolve_alternative(child)
+                if alternative is not None:
+                    alternative = self.specialize_node(alternative)
+                    self.substitute_condition(alternative)
+                    out.append((alternative, idx))
+                continue
+            taken = self.resolve(child)
+            if taken is None:
+                child = self.specialize_node(child)
+                self.substitute_condition(child)
+                out.append((child, idx))
+            else:
+                out.extend(self.specialize_children(taken))
+        return out
+
+    def substitute_condition(self, node: ast.AstNode) -> None:
+        """
+        Replace the fixed macros in the condition of a `#if`/`#elif` that isn't static
+        by their value, so that only the runtime macros are left in it.
+        """
+        if isinstance(node, (ast.PreprocIf, ast.PreprocElif)):
+            node.set_named_child(0, self.substitute(node.get_named_child(0)))
+
+    def substitute(self, node: ast.AstNode) -> ast.AstNode:
+        if isinstance(node, ast.PreprocDefined):
+            name = node.get_named_child(0).text
+            if self.is_static(name):
+                return ast.NumberLiteral("1" if name in self.defined else "0")
+            return node
+        if isinstance(node, ast.Identifier):
+            if not self.is_static(node.text):
+                return node
+            value = self.value(node.text)
+            return ast.NumberLiteral(str(value) if value is not None else "0")
+        for i, child in enumerate(node.children):
+            new_child = self.substitute(child)
+            if new_child is not child:
+                node = node.writable()
+                node.replace_child(i, new_child)
+        return node
+
+    def static_condition(self, node: ast.AstNode) -> Optional[bool]:
+        """
+        Whether the condition of `node` holds, if it is a conditional that only depends on fixed macros.
+        """
+        if isinstance(node, (ast.PreprocIfdef, ast.PreprocElifdef)):
+            name = node.get_named_child(0).text
+            if not self.is_static(name):
+                return None
+            negated = node.children[0].text in ("#ifndef", "#elifndef")
+            return (name in self.defined) != negated
+        if isinstance(node, (ast.PreprocIf, ast.PreprocElif)):
+            try:
+                pred = compile_condition(node.get_named_child(0))
+            except UnsupportedCondition:
+                return None
+            if not all(self.is_static(name) for name in pred.macros()):
+                return None
+            # only whether the macros that are just tested with `defined` are defined matters
+            value_macros = pred.value_macros()
+            values = {
+                name: self.value(name)
+                if name in value_macros
+                else (1 if name in self.defined else None)
+                for name in pred.macros()
+            }
+            try:
+                return pred.evaluate(values) != 0
+            except UnsupportedCondition:
+                return None
+        return None
+
+    def resolve(self, node: ast.AstNode) -> Optional[List[Child]]:
+        """
+        The children that replace `node` if it is a static conditional, otherwise None.
+        """
+        if not isinstance(node, (ast.PreprocIfdef, ast.PreprocIf)):
+            return None
+        holds = self.static_condition(node)
+        if holds is None:
+            return None
+
+        start_idx, end_idx = branch_bounds(node)
+        children = list(zip(node.children, node.children_named_idxs))
+        if holds:
+            return children[start_idx:end_idx]
+
+        alternative = node.children[end_idx] if end_idx < len(node.children) else None
+        if isinstance(alternative, (ast.PreprocElif, ast.PreprocElifdef)):
+            alternative = self.resolve_alternative(alternative)
+        if not isinstance(alternative, alternative_types):
+            return []
+        if isinstance(alternative, ast.PreprocElse):
+            return list(zip(alternative.children, alternative.children_named_idxs))[1:]
+        # the #elif(def) chain that's left becomes a conditional of its own
+        if isinstance(alternative, ast.PreprocElifdef):
+            cond = ast.PreprocIfdef()
+            directive = alternative.children[0].text.replace("#elif", "#if")
+        else:
+            cond = ast.PreprocIf()
+            directive = "#if"
+        cond.children = [
+            ast.Unnamed(directive),
+            *alternative.children[1:],
+            ast.Whitespace("\n"),
+            ast.Unnamed("#endif"),
+        ]
+        cond.children_named_idxs = [None, *alternative.children_named_idxs[1:], None, None]
+        cond._fields = dict(alternative._fields)
+        for child in cond.children:
+            child.parent = cond
+        return [(cond, 0)]
+
+    def resolve_alternative(self, node: ast.AstNode) -> Optional[ast.AstNode]:
+        """
+        What a `#elif`/`#elifdef` link of a chain becomes: itself if it isn't static,
+        an `#else` if it holds, or the rest of the chain (None if there is none) if it doesn't.
+        """
+        holds = self.static_condition(node)
+        if holds is None:
+            return node
+        start_idx, end_idx = branch_bounds(node)
+        if holds:
+            else_node = ast.PreprocElse()
+            else_node.children = [ast.Unnamed("#else"), *node.children[start_idx:end_idx]]
+            else_node.children_named_idxs = [
+                None,
+                *node.children_named_idxs[start_idx:end_idx],
+            ]
+            return else_node
+        alternative = node.children[end_idx] if end_idx < len(node.children) else None
+        if isinstance(alternative, (ast.PreprocElif, ast.PreprocElifdef)):
+            return self.resolve_alternative(alternative)
+        return alternative if isinstance(alternative, ast.PreprocElse) else None
@@ -0,0 +1,190 @@
+"""
+Post-patch loop unswitching.
+
+The conditions of dispatch blocks only depend on the macro globals and condition flags,
+which don't change after `setup_env_vars()`. So a loop whose body dispatches on them can
+instead dispatch once, outside the loop, between copies of the loop specialized for each
+configuration of those conditions.
+"""
+
+from typing import Callable, List, Optional, Tuple
+import copy
+import rt_preproc.parser.ast as ast
+from rt_preproc.visitors.patch.ast_ext import DispatchBlock
+from rt_preproc.visitors.patch.data import CondFlag, Macro
+
+loop_types = (ast.ForStatement, ast.WhileStatement, ast.DoStatement)
+
+CondKey = tuple
+"""Identifies a condition regardless of its polarity, see `cond_key`."""
+
+
+def cond_key(cond: Macro) -> CondKey:
+    return (type(cond), cond.name, cond.type)
+
+
+def dispatch_blocks(node: ast.AstNode) -> Optional[List[DispatchBlock]]:
+    """
+    The dispatch blocks under `node`, or None if the subtree can't be duplicated:
+    labels would be defined twice, and static locals would be split between the copies.
+    """
+    blocks: List[DispatchBlock] = []
+    stack = [node]
+    while stack:
+        cur = stack.pop()
+        if isinstance(cur, ast.LabeledStatement):
+            return None
+        if isinstance(cur, ast.StorageClassSpecifier) and cur.text == "static":
+            return None
+        if isinstance(cur, DispatchBlock):
+            blocks.append(cur)
+            for _, body in cur.cases:
+                stack.extend(body)
+            continue
+        stack.extend(cur.children)
+    return blocks
+
+
+def specialize(node: ast.AstNode, values: dict[CondKey, bool]) -> ast.AstNode:
+    """
+    Copy of `node` where each dispatch block is replaced by the body of its case that holds
+    for the given condition values (which map each condition to the `def_cond` that holds).
+    Subtrees without dispatch blocks are shared with the original.
+    """
+    if isinstance(node, DispatchBlock):
+        block = ast.CompoundStatement()
+        for conds, body in node.cases:
+            if all(values[cond_key(cond)] == cond.def_cond for cond in conds):
+                block.children = [
+                    ast.Unnamed("{"),
+                    *(specialize(child, values) for child in body),
+                    ast.Unnamed("}"),
+                ]
+                break
+        else:
+            unmatched = "assert(0);" if node.assert_unmatched else ""
+            block.children = [ast.Custom(unmatched)]
+        block.children_named_idxs = [None] * len(block.children)
+        return block
+    if len(node.children) == 0:
+        return node
+    children = [specialize(child, values) for child in node.children]
+    if all(new is old for new, old in zip(children, node.children)):
+        return node
+    new_node = node.shallow_copy()
+    new_node.children = children
+    for new, old in zip(children, node.children):
+        if new is not old:
+            new.parent = new_node
+    new_node.mark_modified()
+    return new_node
+
+
+def unswitch(node: ast.AstNode, max_versions: int) -> int:
+    """
+    Unswitch the outermost loops under `node` that need at most `max_versions` copies, in place.
+    Returns the number of loops unswitched.
+    """
+    if isinstance(node, DispatchBlock):
+        # the children are rendered from the cases
+        unswitched = 0
+        for _, body in node.cases:
+            unswitched += unswitch_children(body, max_versions, body.__setitem__)
+        if unswitched > 0:
+            node.render()
+        return unswitched
+    edits = node.edit_children()
+    unswitched = unswitch_children(node.children, max_versions, edits.replace)
+    edits.apply()
+    return unswitched
+
+
+def unswitch_children(
+    children: List[ast.AstNode],
+    max_versions: int,
+    replace: Callable[[int, ast.AstNode], None],
+) -> int:
+    unswitched = 0
+    for i, child in enumerate(children):
+        if isinstance(child, loop_types):
+            versions = unswitch_loop(child, max_versions)
+            if versions is not None:
+                replace(i, versions)
+                unswitched += 1
+                continue
+        unswitched += unswitch(child, max_versions)
+    return unswitched
+
+
+def feasible_assignments(
+    conds: dict[CondKey, Macro], limit: int
+) -> Optional[List[dict[CondKey, bool]]]:
+    """
+    The values of `conds` that can hold together (see `unswitch`), in the order of
+    `itertools.product`, or None if there are more than `limit` of them.
+    The condition flags of a chain are exclusive, and one of them holds if the chain
+    is exhaustive. Macros are independent.
+    """
+    keys = list(conds.keys())
+    chains: dict[Tuple[str, ...], bool] = {}
+    for cond in conds.values():
+        if isinstance(cond, CondFlag) and len(cond.chain) > 1:
+            chains[cond.chain] = chains.get(cond.chain, False) or cond.exhaustive
+    flag_keys = {cond.name: key for key, cond in conds.items() if isinstance(cond, CondFlag)}
+
+    def feasible(values: dict[CondKey, bool]) -> bool:
+        for chain, exhaustive in chains.items():
+            # a flag holds when its `def_cond` is False, see `CondFlag.to_c`
+            holding = [not values[flag_keys[f]] for f in chain if flag_keys.get(f) in values]
+            if sum(holding) > 1:
+                return False
+            if exhaustive and len(holding) == len(chain) and not any(holding):
+                return False
+        return True
+
+    found: List[dict[CondKey, bool]] = []
+
+    def assign(values: dict[CondKey, bool]) -> bool:
+        if len(values) == len(keys):
+            found.append(dict(values))
+            return len(found) <= limit
+        key = keys[len(values)]
+        for value in (False, True):
+            values[key] = value
+            if feasible(values) and not assign(values):
+                return False
+            del values[key]
+        return True
+
+    return found if assign({}) else None
+
+
+def unswitch_loop(loop: ast.AstNode, max_versions: int) -> Optional[DispatchBlock]:
+    """
+    A dispatch between specialized copies of `loop`, one per feasible configuration of the
+    conditions its dispatch blocks test, or None if it has none or would need more than
+    `max_versions` copies.
+    """
+    blocks = dispatch_blocks(loop)
+    if not blocks:
+        return None
+    conds: dict[CondKey, Macro] = {}
+    for block in blocks:
+        for case_conds, _ in block.cases:
+            for cond in case_conds:
+                conds.setdefault(cond_key(cond), cond)
+    if len(conds) == 0:
+        return None
+    assignments = feasible_assignments(conds, max_versions)
+    if assignments is None:
+        return None
+
+    cases = []
+    for values in assignments:
+        case_conds = []
+        for key, cond in conds.items():
+            case_cond = copy.copy(cond)
+            case_cond.def_cond = values[key]
+            case_conds.append(case_cond)
+        cases.append((case_conds, [specialize(loop, values)]))
+    return DispatchBlock(cases, exhaustive=True)
@@ -1,9 +1,23 @@
-from typing import Any
+from typing import Any, Optional
 import rt_preproc.parser.ast as ast
 from multimethod import multimethod
 from rt_preproc.visitors.base import IVisitor, IVisitorCtx
 from astyle_py import Astyle
 
+_formatter: Optional[Astyle] = None
+
+
+def astyle_formatter() -> Astyle:
+    """
+    The astyle formatter of this process, it is created on first use and then reused.
+    """
+    global _formatter
+    if _formatter is None:
+        _formatter = Astyle()
+        _formatter.set_options("--style=mozilla --mode=c")
+    return _formatter
+
+
 class PrintCtx(IVisitorCtx):
     pass
 
@@ -17,28 +31,31 @@ class PrintVisitor(IVisitor):
         self.buffer = ""
         self.use_astyle = use_astyle
 
+    def write(self, text: str) -> None:
+        if self.use_astyle:
+            self.buffer += text
+        elif self.output_file is not None:
+            self.output_file.write(text)
+        else:
+            print(text, end="")
+
     @multimethod
     def visit(self, node: ast.AstNode, ctx: PrintCtx) -> Any:
         if len(node.children) > 0:
             for child in node.children:
+                self.write(child.leading_trivia())
                 child.accept(self, ctx)  # ctx is not used in this visitor
+            self.write(node.trailing_trivia())
         else:  # leaf node
-            if self.use_astyle:
-                self.buffer += node.text
-            elif self.output_file is not None:
-                self.output_file.write(node.text)
-            else:
-                print(node.text, end="")
+            self.write(node.text)
         # if root node, close file and run astyle
         if isinstance(node, ast.TranslationUnit):
             if self.use_astyle:
-                formatter = Astyle()
-                formatter.set_options('--style=mozilla --mode=c')
-                self.buffer = formatter.format(self.buffer)
+                self.buffer = astyle_formatter().format(self.buffer)
                 if self.output_file is not None:
-                    with open(self.output_file, "w") as f:
-                        f.write(self.buffer)
-                print(self.buffer)
+                    self.output_file.write(self.buffer)
+                else:
+                    print(self.buffer)
                 self.buffer = ""
             if self.output_file is not None:
                 self.output_file.close()
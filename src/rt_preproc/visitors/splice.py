@@ -0,0 +1,152 @@
+"""
+Output of a patched tree as edits to the source it was reified from.
+
+Subtrees that are still their original source (see `AstNode.is_original`) are kept as
+the original bytes, and only the regions the patcher rewrote are rendered from the tree.
+So untouched code is preserved byte for byte, and the cost of the output scales
+with the size of the change rather than the size of the file.
+"""
+
+from typing import List
+import difflib
+from astyle_py import Astyle
+import rt_preproc.parser.ast as ast
+
+
+class Edit:
+    """
+    Replace the source bytes from `start` to `end` with `text`.
+    """
+
+    def __init__(self, start: int, end: int, text: str) -> None:
+        self.start = start
+        self.end = end
+        self.text = text
+
+    def __repr__(self) -> str:
+        return f"Edit({self.start}, {self.end}, {self.text!r})"
+
+
+def render(node: ast.AstNode, source: bytes) -> str:
+    """
+    Text of `node`, taken from the source where the subtree is still original.
+    That is the source the node was reified from if it has one, like for its trivia.
+    """
+    if node.is_original():
+        if node.source is not None:
+            source = node.source
+        return source[node.start_byte : node.end_byte].decode()
+    if len(node.children) == 0:
+        return node.text
+    parts = []
+    for child in node.children:
+        parts.append(child.leading_trivia())
+        parts.append(render(child, source))
+    parts.append(node.trailing_trivia())
+    return "".join(parts)
+
+
+def collect_edits(root: ast.AstNode, source: bytes) -> List[Edit]:
+    """
+    The edits turning `source` into the text of the patched tree under `root`,
+    in order and not overlapping.
+    """
+    if root.start_byte is None:
+        return [Edit(0, len(source), render(root, source))]
+    edits: List[Edit] = []
+    _collect_edits(root, source, edits)
+    return edits
+
+
+def _collect_edits(node: ast.AstNode, source: bytes, edits: List[Edit]) -> None:
+    if node.is_original():
+        return
+    if len(node.children) == 0:
+        _replace(source, node.start_byte, node.end_byte, [node.text], edits)
+        return
+    # children that are still in their original place (with their trivia), in source order,
+    # anchor the edits, the generated or moved children in between them replace the source
+    # between the anchors
+    pos = node.start_byte
+    pending: List[str] = []
+    for child in node.children:
+        if (
+            child.start_byte is not None
+            and child.trivia_end == child.start_byte
+            and pos <= child.trivia_start
+            and child.end_byte <= node.end_byte
+        ):
+            _replace(source, pos, child.trivia_start, pending, edits)
+            pending = []
+            _collect_edits(child, source, edits)
+            pos = child.end_byte
+        else:
+            pending.append(child.leading_trivia())
+            pending.append(render(child, source))
+    pending.append(node.trailing_trivia())
+    _replace(source, pos, node.end_byte, pending, edits)
+
+
+def _replace(
+    source: bytes, start: int, end: int, parts: List[str], edits: List[Edit]
+) -> None:
+    if len(parts) == 0 and start == end:
+        return
+    text = "".join(parts)
+    if text.encode() != source[start:end]:
+        edits.append(Edit(start, end, text))
+
+
+def format_edits(edits: List[Edit], source: bytes, formatter: Astyle) -> None:
+    """
+    Format the text of each edit in place, so only the code the patcher generated is
+    reformatted. The formatted lines are indented like the line the edit starts on.
+    """
+    for edit in edits:
+        body = edit.text.strip()
+        if body == "":
+            continue
+        lead = edit.text[: len(edit.text) - len(edit.text.lstrip())]
+        trail = edit.text[len(edit.text.rstrip()) :]
+        if "\n" in lead:
+            indent = lead[lead.rfind("\n") + 1 :]
+        else:
+            line_start = source.rfind(b"\n", 0, edit.start) + 1
+            line = source[line_start : edit.start].decode()
+            indent = line[: len(line) - len(line.lstrip())]
+        lines = formatter.format(body).split("\n")
+        edit.text = (
+            lead
+            + "\n".join(
+                [lines[0], *(indent + line if line != "" else line for line in lines[1:])]
+            )
+            + trail
+        )
+
+
+def apply_edits(source: bytes, edits: List[Edit]) -> bytes:
+    """
+    Splice the edits returned by `collect_edits` into `source`.
+    """
+    out: List[bytes] = []
+    pos = 0
+    for edit in edits:
+        out.append(source[pos : edit.start])
+        out.append(edit.text.encode())
+        pos = edit.end
+    out.append(source[pos:])
+    return b"".join(out)
+
+
+def unified_diff(path: str, source: bytes, patched: bytes) -> str:
+    """
+    Unified diff from `source` to `patched`, both named `path`.
+    """
+    return "".join(
+        difflib.unified_diff(
+            source.decode().splitlines(keepends=True),
+            patched.decode().splitlines(keepends=True),
+            fromfile=f"a/{path}",
+            tofile=f"b/{path}",
+        )
+    )
@@ -0,0 +1,163 @@
+from rt_preproc.parser import ast
+from rt_preproc.parser.serialize import reify_source
+
+
+def reify(source: bytes) -> ast.AstNode:
+    return reify_source(source, None)[0]
+
+
+def test_ident_index_follows_edits():
+    root = reify(b"int f(int a, int b) { a = b; return a; }\n")
+    body = root.children[0].get_child_by_name("body")
+    assert len(root.ident_index()["a"]) == 3
+    assert len(body.ident_index()["b"]) == 1
+
+    # a rewrite method, a batch of edits and an insert, each seen by the cached ancestors
+    stmt = body.children[1]
+    stmt.get_named_child(0).set_named_child(0, ast.Identifier("c"))
+    assert len(root.ident_index()["a"]) == 2 and len(root.ident_index()["c"]) == 1
+    edits = body.edit_children()
+    edits.delete(2)
+    edits.apply()
+    assert len(root.ident_index()["a"]) == 1 and "a" not in body.ident_index()
+    body.insert_children(1, [ast.Identifier("d")])
+    assert root.ident_index()["d"] == [(0, 2, 1)]
+
+
+def test_variability_follows_edits():
+    root = reify(b"int f(int a) { return a; }\n")
+    body = root.children[0].get_child_by_name("body")
+    assert not root.variability().has_preproc
+    assert root.variability().idents == {"f", "a"}
+
+    body.insert_children(1, reify(b"#ifdef FOO\nint b;\n#endif\n").children)
+    assert root.variability().has_preproc and body.variability().has_declaration
+    assert root.variability().idents == {"f", "a", "FOO", "b"}
+
+
+def test_edits_copy_the_subtrees_a_copy_shares():
+    root = reify(b"int f(int a, int b) {\n  a = b + 1;\n}\n")
+    stmt = root.children[0].get_child_by_name("body").children[1]
+    assign = stmt.get_named_child(0)
+    shared = assign.get_named_child(1)  # b + 1
+    renamed = stmt.rename_idents({"a": "a_1"})
+    renamed_assign = renamed.get_named_child(0)
+    assert renamed_assign is not assign and renamed_assign.get_named_child(1) is shared
+
+    # an insert before the shared child moves its trivia, and the batch gives it a new parent
+    edits = renamed_assign.edit_children()
+    edits.insert(2, [ast.Identifier("c")])
+    edits.apply()
+    assert shared.parent is assign and assign.get_named_child(1) is shared
+    assert str(root) == "int f(int a, int b) {\n  a = b + 1;\n}\n"
+    assert str(renamed) == "a_1 = cb + 1;"
+    copy = renamed_assign.get_named_child(1)
+    assert copy is not shared and copy.parent is renamed_assign
+    assert renamed_assign.get_child_by_name("right") is copy
+
+    # a rewrite of the copy marks its own ancestors, not the original's
+    copy.replace_child(0, ast.Identifier("d"))
+    assert str(renamed) == "a_1 = cd + 1;"
+    assert stmt.is_original() and str(stmt) == "a = b + 1;"
+
+
+def assert_fields_match(node: ast.AstNode):
+    for name, child in node._fields.items():
+        base_child = node.base_node.child_by_field_name(name)
+        assert child.base_node == base_child, (type(node).__name__, name)
+    for child in node.children:
+        assert_fields_match(child)
+
+
+def test_fields_match_tree_sitter():
+    # children without a field before the first one with a field shifted the table
+    root = reify(
+        b"static int f(int a) { return a; }\n"
+        b"const char *g(void) { return 0; }\n"
+        b"static inline int h(int a) {\n"
+        b"  for (int i = 0; i < a; i++) a--;\n"
+        b"  for (;;) break;\n"
+        b"  return a;\n"
+        b"}\n"
+    )
+    assert_fields_match(root)
+    static_fn = root.children[0]
+    assert isinstance(static_fn.get_child_by_name("type"), ast.PrimitiveType)
+    assert isinstance(static_fn.get_child_by_name("declarator"), ast.FunctionDeclarator)
+    assert isinstance(static_fn.get_child_by_name("body"), ast.CompoundStatement)
+
+
+def test_edits_of_a_shared_node_copy_it():
+    root = reify(b"int f(int a, int b) {\n  a = (b + 1) * 2;\n}\n")
+    stmt = root.children[0].get_child_by_name("body").children[1]
+    shared = stmt.get_named_child(0).get_named_child(1)  # (b + 1) * 2
+    renamed = stmt.rename_idents({"a": "a_1"})
+    assert renamed.get_named_child(0).get_named_child(1) is shared
+
+    # editing it through the tree its parent links to puts a copy there,
+    # copying the ancestors the copy of `stmt` shares as well
+    shared.replace_child(2, ast.Identifier("c"))
+    assign = stmt.get_named_child(0)
+    copy = assign.get_named_child(1)
+    assert copy is not shared and copy.parent is assign and assign.parent is stmt
+    assert all(child.parent is copy for child in copy.children)
+    assert copy.get_child_by_name("right") is copy.children[2]
+    assert str(stmt) == "a = (b + 1) * c;" and not stmt.is_original()
+    assert str(renamed) == "a_1 = (b + 1) * 2;" and str(shared) == "(b + 1) * 2"
+
+    # the children of the copy are shared with the original, a batch on one of them
+    # copies it under the copy
+    parens = shared.children[0]
+    edits = parens.edit_children()
+    edits.replace(1, ast.Identifier("d"))
+    edits.apply()
+    assert edits.node is not parens and edits.node.parent is copy
+    assert copy.children[0] is edits.node
+    assert str(stmt) == "a = (d) * c;" and str(renamed) == "a_1 = (b + 1) * 2;"
+    edits.node.insert_children(1, [ast.Identifier("e")])
+    assert str(stmt) == "a = (ed) * c;" and str(parens) == "(b + 1)"
+
+
+def test_child_edits_apply_in_one_batch():
+    root = reify(b"int f(int a) {\n  a = 1;\n  // two\n  a = 2;\n  a = 3;\n}\n")
+    body = root.children[0].get_child_by_name("body")
+    last = body.children[4]
+
+    # positions are the ones from before the batch, whatever was recorded earlier
+    edits = body.edit_children()
+    edits.delete(1)
+    edits.insert(4, [ast.Custom("c = 5;"), ast.Whitespace("\n  ")])
+    edits.replace(3, ast.Custom("b = 4;"))
+    assert len(body.children) == 6
+    edits.apply()
+    assert edits.is_empty()
+    assert str(root) == "int f(int a) {\n  // two\n  b = 4;\n  c = 5;\n  a = 3;\n}\n"
+    # the named children after the deleted one are renumbered, the inserted ones aren't named
+    assert body.children_named_idxs == [None, 0, 1, None, None, 2, None]
+    assert str(body.get_named_child(1)) == "b = 4;"
+    assert body.get_named_child(2) is last
+    assert all(child.parent is body for child in body.children)
+
+
+def test_trivia_round_trip():
+    source = b"/* head */\n\nint f(int a) {\r\n\t// note\n\n\ta = 1;  /* tail */\n\n}\n"
+    root = reify(source)
+    assert str(root).encode() == source
+    assert [type(child) for child in root.children] == [ast.Comment, ast.FunctionDefinition]
+    assert root.children[1].leading_trivia() == "\n\n" and root.trailing_trivia() == "\n"
+    body = root.children[1].get_child_by_name("body")
+    # the comments are nodes, the whitespace around them is kept byte for byte
+    assert [(child.leading_trivia(), str(child)) for child in body.children] == [
+        ("", "{"),
+        ("\r\n\t", "// note"),
+        ("\n\n\t", "a = 1;"),
+        ("  ", "/* tail */"),
+        ("\n\n", "}"),
+    ]
+
+    # a replacement keeps the blank line before it, a delete drops the whitespace before it
+    edits = body.edit_children()
+    edits.replace(2, ast.Custom("b = 2;"))
+    edits.delete(3)
+    edits.apply()
+    assert str(root).encode() == source.replace(b"a = 1;  /* tail */", b"b = 2;")
@@ -0,0 +1,28 @@
+#include <stdio.h>
+
+#ifdef FOO
+int fx(void) { return 1; }
+#else
+int fx(void) { return 2; }
+#endif
+
+#ifdef BAR
+int fy(void) { return 10; }
+#else
+int fy(void) { return 20; }
+#endif
+
+#ifdef BAZ
+int scale(int v) { return v * 3; }
+#else
+double scale(double v) { return v / 2; }
+#endif
+
+int main() {
+  int r = 0;
+  r = fx() + fy();
+  printf("%d\n", r);
+  r = scale(fx()) + fy();
+  printf("%d\n", r);
+  return 0;
+}
@@ -0,0 +1,73 @@
+import subprocess
+import pytest
+from cleo.application import Application
+from cleo.exceptions import CleoRuntimeError
+from cleo.testers.command_tester import CommandTester
+from rt_preproc.cli.patch_cmd import PatchCmd, PatchOptions, patch_tree
+from rt_preproc.parser.serialize import reify_source
+
+path = "tests/budget/site/orig.c"
+selector = "(FOO != UNDEFINED_Int ? fx : FOO == UNDEFINED_Int ? fx_2 : (assert(0), fx))"
+
+
+def patch(options: PatchOptions, cache_dir=None):
+    with open(path, "rb") as f:
+        source = f.read()
+    root_node, _ = reify_source(source, cache_dir)
+    output, degraded_sites = patch_tree(root_node, source, options)
+    return output.decode(), degraded_sites
+
+
+def test_over_the_site_budget():
+    output, degraded_sites = patch(PatchOptions(max_site_combinations=2))
+    assert [
+        (site.line, site.combinations, site.emitted, site.reason) for site in degraded_sites
+    ] == [
+        (23, 4, 1, "over the site budget of 2"),
+        (25, 8, 2, "over the site budget of 2"),
+    ]
+    # the functions of the same signature are selected in place,
+    # the ones that differ are still duplicated over
+    assert f"r = {selector}() + " in output
+    assert f"r = scale({selector}()) + " in output
+    assert f"r = scale_2({selector}()) + " in output
+
+
+def test_over_the_site_budget_cached(tmp_path):
+    # the trees loaded from the cache have no tree-sitter nodes, the lines are still known
+    expected = patch(PatchOptions(max_site_combinations=2))
+    patch(PatchOptions(max_site_combinations=2), str(tmp_path))
+    output, degraded_sites = patch(PatchOptions(max_site_combinations=2), str(tmp_path))
+    assert output == expected[0]
+    assert [site.line for site in degraded_sites] == [23, 25]
+
+
+def test_over_the_file_budget():
+    output, degraded_sites = patch(PatchOptions(max_file_combinations=5))
+    # the first site fits, the second doesn't fit in what's left
+    assert [(site.line, site.emitted, site.reason) for site in degraded_sites] == [
+        (25, 2, "over the file budget of 5"),
+    ]
+    assert "r = fx_2() + fy_2();" in output
+    assert f"r = scale({selector}()) + " in output
+
+
+def test_degraded_sites_report():
+    result = subprocess.run(
+        ["poetry", "run", "rt_preproc", "patch", "-j", "--max-site-combinations", "2", path],
+        capture_output=True,
+    )
+    assert result.returncode == 0
+    assert result.stderr.decode().splitlines() == [
+        f"{path}: 2 site(s) over the combination budget:",
+        "  line 23: `r = fx() + fy();` 4 -> 1 combinations (over the site budget of 2)",
+        "  line 25: `r = scale(fx()) + fy();` 8 -> 2 combinations (over the site budget of 2)",
+    ]
+
+
+def test_budget_must_be_an_integer():
+    application = Application()
+    application.add(PatchCmd())
+    tester = CommandTester(application.find("patch"))
+    with pytest.raises(CleoRuntimeError, match='"--max-site-combinations" option requires'):
+        tester.execute(f"--max-site-combinations two {path}")
@@ -0,0 +1,66 @@
+import json
+from rt_preproc.cli.compdb import (
+    CompdbState,
+    dedupe,
+    fingerprint,
+    load_compdb,
+    output_paths,
+    parse_flags,
+)
+
+
+def test_parse_flags_in_order():
+    defined, undefined = parse_flags(
+        ["-c", "-DFOO", "-D", "BAR=2", "-I", "inc", "-UFOO", "-U", "BAZ", "-DBAZ=x=y"]
+    )
+    assert defined == {"BAR": "2", "BAZ": "x=y"}
+    assert undefined == {"FOO"}
+
+
+def test_dedupe_and_output_paths(tmp_path):
+    (tmp_path / "src").mkdir()
+    compdb = tmp_path / "compile_commands.json"
+    compdb.write_text(
+        json.dumps(
+            [
+                {"directory": str(tmp_path), "file": "src/a.c", "arguments": ["cc", "-DFOO", "src/a.c"]},
+                {"directory": str(tmp_path / "src"), "file": "a.c", "command": "cc -D FOO -Iinc a.c"},
+                {"directory": str(tmp_path), "file": "src/a.c", "command": "cc -UFOO src/a.c"},
+                {"directory": str(tmp_path), "file": "src/b.c", "command": "cc src/b.c"},
+            ]
+        )
+    )
+    entries = dedupe(load_compdb(str(compdb)))
+    assert [(e.file, e.defined, e.undefined) for e in entries] == [
+        (str(tmp_path / "src/a.c"), {"FOO": "1"}, set()),
+        (str(tmp_path / "src/a.c"), {}, {"FOO"}),
+        (str(tmp_path / "src/b.c"), {}, set()),
+    ]
+    paths = output_paths(entries, str(tmp_path), "out")
+    # the two flag sets of a.c get an output each
+    assert paths[0] != paths[1]
+    assert all(p.startswith("out/src/a.") and p.endswith(".c") for p in paths[:2])
+    assert paths[2] == "out/src/b.c"
+
+
+def test_state_skips_unchanged(tmp_path):
+    entry = load_compdb_from(tmp_path, [{"file": "a.c", "command": "cc -DFOO a.c"}])[0]
+    output = tmp_path / "out" / "a.c"
+    output.parent.mkdir()
+    output.write_text("patched")
+    state = CompdbState(str(tmp_path / "out"))
+    state.update(str(output), fingerprint(entry, b"int x;", "{}"))
+    state.save()
+
+    state = CompdbState(str(tmp_path / "out"))
+    assert state.is_unchanged(str(output), fingerprint(entry, b"int x;", "{}"))
+    assert not state.is_unchanged(str(output), fingerprint(entry, b"int y;", "{}"))
+    assert not state.is_unchanged(str(output), fingerprint(entry, b"int x;", '{"fmt": true}'))
+    output.unlink()
+    assert not state.is_unchanged(str(output), fingerprint(entry, b"int x;", "{}"))
+
+
+def load_compdb_from(dir, commands):
+    compdb = dir / "compile_commands.json"
+    compdb.write_text(json.dumps([{"directory": str(dir), **c} for c in commands]))
+    return load_compdb(str(compdb))
@@ -0,0 +1,20 @@
+#include <stdio.h>      /* printf */
+
+#ifdef FOO
+  int func() { return 1; }
+#else
+  int func() { return 2; }
+#endif
+
+int main(){
+  int y = 0;
+  #ifdef FOO
+    y += 1;
+  #endif
+  #ifdef FOO
+    y += 2;
+  #endif
+  y += func();
+  y += func();
+  printf("%d", y);
+}
@@ -0,0 +1,14 @@
+#include <stdio.h>      /* printf */
+
+int main(){
+  #if defined(FOO) && FOO > 1
+    printf("FOO > 1");
+  #elif defined BAR || FOO == 1
+    printf("BAR or FOO == 1");
+  #else
+    printf("neither");
+  #endif
+  #if (BAR + 1) * 2 == 4 && !defined(FOO)
+    printf(" BAR == 1 only");
+  #endif
+}
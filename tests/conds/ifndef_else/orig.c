@@ -0,0 +1,9 @@
+#include <stdio.h>      /* printf */
+
+int main(){
+  #ifndef FOO
+    printf("FOO not defined");
+  #else
+    printf("FOO defined");
+  #endif
+}
@@ -0,0 +1,23 @@
+#include <stdio.h>
+
+#ifdef FOO
+int step(int v) { return v + 1; }
+#else
+int step(int v) { return v * 2; }
+#endif
+
+#ifdef BAR
+double half(double v) { return v / 2; }
+#else
+int half(int v) { return v / 2; }
+#endif
+
+int main() {
+  int r = 3;
+  r = step(r);
+  printf("%d\n", r);
+  r = step(step(r));
+  printf("%d\n", r);
+  printf("%.2f\n", (double)half(r));
+  return 0;
+}
@@ -0,0 +1,7 @@
+#include <stdio.h>
+#ifdef FOO
+int g = 1;
+#endif
+static int f(int a) { return a + 1; }
+static inline const int h(int a) { for (int i = 0; i < 2; i++) a++; return a; }
+int main() { printf("%d\n", f(1) + h(2)); return 0; }
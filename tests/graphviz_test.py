@@ -0,0 +1,126 @@
+import re
+from cleo.application import Application
+from cleo.testers.command_tester import CommandTester
+from rt_preproc.cli.graphviz_cmd import GraphvizCmd
+from rt_preproc.parser.serialize import reify_source
+from rt_preproc.visitors.graphviz import GraphVizCtx, GraphVizVisitor
+
+source = b"""int f(int a) {
+  return a;
+}
+
+int main() {
+  int y = 0;
+#ifdef FOO
+  y += f(1);
+#endif
+  return y;
+}
+"""
+
+
+def run_graphviz(tmp_path, args: str) -> CommandTester:
+    path = tmp_path / "graph.c"
+    path.write_bytes(source)
+    application = Application()
+    application.add(GraphvizCmd())
+    tester = CommandTester(application.find("graphviz"))
+    tester.execute(f"{args} -o {tmp_path / 'graph.dot'} {path}")
+    return tester
+
+
+def graph(tmp_path, args: str = "") -> str:
+    assert run_graphviz(tmp_path, args).status_code == 0
+    return (tmp_path / "graph.dot").read_text()
+
+
+def parse_dot(dot: str):
+    """The labels of the nodes and the edges of a graph, checking that it's complete."""
+    assert dot.startswith("digraph Program {\n") and dot.endswith("}\n")
+    labels = {}
+    for node_id, label in re.findall(r'^"(n\d+)" \[.*label=(.*)\];$', dot, re.M):
+        name = re.match(r'"(\w+)"|<<TABLE><TR><TD>(\w+)', label)
+        labels[node_id] = name[1] or name[2]
+    edges = re.findall(r'^\t"(n\d+)" -> "(n\d+)";$', dot, re.M)
+    # a tree over the nodes, each one linked to an earlier parent
+    assert len(edges) == len(labels) - 1
+    assert all(int(a[1:]) < int(b[1:]) for a, b in edges)
+    assert {b for _, b in edges} == set(labels) - {"n0"}
+    return labels, edges
+
+
+def depth(edges) -> int:
+    depths = {"n0": 0}
+    for parent, child in edges:
+        depths[child] = depths[parent] + 1
+    return max(depths.values())
+
+
+def test_full_graph(tmp_path):
+    labels, edges = parse_dot(graph(tmp_path))
+    assert len(labels) == 34 and depth(edges) == 8
+    assert labels["n0"] == "TranslationUnit"
+    assert list(labels.values()).count("FunctionDefinition") == 2
+
+
+def test_only_preproc(tmp_path):
+    dot = graph(tmp_path, "--only-preproc")
+    labels, edges = parse_dot(dot)
+    # the conditional, its ancestors and its macro name
+    assert list(labels.values()) == [
+        "TranslationUnit",
+        "FunctionDefinition",
+        "CompoundStatement",
+        "PreprocIfdef",
+        "Identifier",
+    ]
+    assert "<TD>FOO</TD>" in dot and "style=filled color=2" in dot
+
+
+def test_max_depth(tmp_path):
+    labels, edges = parse_dot(graph(tmp_path, "--max-depth 2"))
+    assert len(labels) == 9 and depth(edges) == 2
+
+
+def test_max_nodes(tmp_path):
+    dot = graph(tmp_path, "--max-nodes 5")
+    labels, _ = parse_dot(dot)
+    assert list(labels) == ["n0", "n1", "n2", "n3", "n4"]
+    assert "// truncated at 5 nodes\n" in dot
+    assert "truncated" not in graph(tmp_path, "--max-nodes 34")
+
+
+def test_function(tmp_path):
+    labels, edges = parse_dot(graph(tmp_path, "--function f"))
+    assert len(labels) == 11
+    assert labels["n0"] == "FunctionDefinition" and "PreprocIfdef" not in labels.values()
+    labels, edges = parse_dot(graph(tmp_path, "--function main --max-depth 1"))
+    assert len(labels) == 4 and depth(edges) == 1
+
+
+def test_unknown_function(tmp_path):
+    tester = run_graphviz(tmp_path, "--function g")
+    assert tester.status_code == 1
+    assert "No definition found for function g" in tester.io.fetch_error()
+
+
+class RecordingOut:
+    """Records how many nodes were visited when each line was written."""
+
+    def __init__(self) -> None:
+        self.visitor = None
+        self.writes = []
+
+    def write(self, text: str) -> None:
+        self.writes.append((self.visitor.node_count, text))
+
+
+def test_streams_the_graph():
+    root, _ = reify_source(source, None)
+    out = RecordingOut()
+    out.visitor = visitor = GraphVizVisitor(out, max_nodes=20)
+    root.accept(visitor, GraphVizCtx())
+    # each node is written as soon as it's visited, not once the graph is built
+    node_writes = [(count, text) for count, text in out.writes if "label=" in text]
+    assert [count for count, _ in node_writes] == list(range(1, 21))
+    assert out.writes[-1] == (20, "}\n") and visitor.truncated
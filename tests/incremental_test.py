@@ -0,0 +1,76 @@
+import pytest
+from rt_preproc.cli.incremental import IncrementalPatcher
+from rt_preproc.cli.patch_cmd import PatchOptions, patch_tree
+from rt_preproc.parser.serialize import reify_source
+from patch_test import scan_tree_for_test_folder
+
+source = b"""#include <stdio.h>
+
+#ifdef FOO
+int x = 1;
+#else
+double x = 2;
+#endif
+
+#ifdef BAR
+int add(int a, int b) { return a + b; }
+#else
+int add(int a, int b) { return a - b; }
+#endif
+
+int twice(int v) { return add(v, v); }
+
+int main() {
+  int r = twice(3);
+#ifdef BAR
+  r += 10;
+#endif
+  printf("%d %d\\n", r, (int)x);
+  return 0;
+}
+"""
+
+
+def full_patch(source: bytes, options: PatchOptions) -> str:
+    root_node, _ = reify_source(source, None)
+    return patch_tree(root_node, source, options)[0].decode()
+
+
+@pytest.mark.parametrize(
+    "dir",
+    [
+        pytest.param(it, id=it.path[6:])  # remove "tests/" from path
+        for it in scan_tree_for_test_folder("tests/")
+    ],
+)
+def test_edits_match_full_patch(dir):
+    with open(f"{dir.path}/orig.c", "rb") as f:
+        orig = f.read()
+    patcher = IncrementalPatcher(PatchOptions())
+    lines = orig.split(b"\n")
+    # a line duplicated, then removed again
+    for version in [orig, b"\n".join(lines[:2] + lines[1:]), orig]:
+        assert patcher.update(version) == full_patch(version, PatchOptions())
+
+
+@pytest.mark.parametrize("fn_tables", [False, True])
+def test_only_affected_declarations_repatched(fn_tables):
+    options = PatchOptions(fn_tables=fn_tables)
+    patcher = IncrementalPatcher(options)
+    patcher.update(source)
+    assert patcher.repatched == len(patcher.items)
+
+    edits = [
+        # a body, nothing else depends on it
+        (b"r += 10;", b"r += 11;", 1),
+        # the type of a global, the functions using it are patched again
+        (b"double x = 2;", b"float x = 2;", 2),
+        # the body of a conditional function, its callers only depend on its signature
+        (b"return a - b;", b"return b - a;", 1),
+        (b"int add(int a, int b) { return b", b"double add(int a, int b) { return b", 2),
+    ]
+    edited = source
+    for old, new, repatched in edits:
+        edited = edited.replace(old, new)
+        assert patcher.update(edited) == full_patch(edited, options)
+        assert patcher.repatched == repatched
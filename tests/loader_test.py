@@ -0,0 +1,48 @@
+import os
+import subprocess
+from rt_preproc.cli.patch_cmd import PatchOptions, patch_tree
+from rt_preproc.parser.serialize import reify_source
+
+source = b"""#include <stdio.h>
+
+int main() {
+#ifdef FOO
+  printf("foo %d\\n", FOO);
+#endif
+#ifdef RATIO
+  printf("ratio %.2f\\n", RATIO);
+#endif
+  return 0;
+}
+"""
+
+
+def build(tmp_path) -> str:
+    root_node, _ = reify_source(source, None)
+    output, _ = patch_tree(root_node, source, PatchOptions(macro_types={"RATIO": "double"}))
+    (tmp_path / "post.c").write_bytes(output)
+    binary = str(tmp_path / "post")
+    c_compiler = os.getenv("CC", "clang")
+    subprocess.run([c_compiler, str(tmp_path / "post.c"), "-o", binary]).check_returncode()
+    return binary
+
+
+def test_config_file_and_environment(tmp_path):
+    binary = build(tmp_path)
+    expected = b"foo 10\nratio 2.50\n"
+    # integers are decimal
+    env = subprocess.run([binary], capture_output=True, env={"FOO": "010", "RATIO": "2.5"})
+    assert env.stdout == expected
+
+    # a config file replaces the environment, with its comments, CRLFs and trailing blanks
+    config = tmp_path / "rt.conf"
+    config.write_bytes(b"# runtime macros\r\nFOO=010 \r\nRATIO=2.5\t\r\nOTHER=1\r\n")
+    run = subprocess.run(
+        [binary], capture_output=True, env={"RT_PREPROC_CONFIG": str(config), "FOO": "3"}
+    )
+    assert run.stdout == expected
+
+    missing = subprocess.run(
+        [binary], capture_output=True, env={"RT_PREPROC_CONFIG": str(tmp_path / "none")}
+    )
+    assert missing.returncode != 0
@@ -0,0 +1,12 @@
+#include <stdio.h>
+
+int main() {
+#ifdef BIG
+  long b = BIG;
+  printf("%ld\n", b + 1);
+#endif
+#ifdef RATIO
+  printf("%.2f\n", RATIO * 2);
+#endif
+  return 0;
+}
@@ -0,0 +1,30 @@
+import io
+import json
+from rt_preproc.cli.memprofile import MemProfile
+from rt_preproc.cli.patch_cmd import PatchOptions, patch_tree
+from rt_preproc.parser.serialize import reify_source
+
+
+def test_phases_and_counts():
+    source = b"#ifdef FOO\nint x = 1;\n#else\ndouble x = 2;\n#endif\nint main() { return (int)x; }\n"
+    out = io.StringIO()
+    memprofile = MemProfile(out, top=3)
+    try:
+        memprofile.start("a.c")
+        root_node, _ = reify_source(source, None)
+        memprofile.phase("reify")
+        patch_tree(root_node, source, PatchOptions(), memprofile=memprofile)
+    finally:
+        memprofile.stop()
+
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [r["phase"] for r in records] == ["reify", "patch", "print"]
+    reify, patch, _ = records
+    assert reify["growth_bytes"] > 0
+    assert reify["peak_bytes"] >= reify["retained_bytes"]
+    assert len(reify["top_sites"]) <= 3
+    assert reify["objects"]["AstNode"] > 0 and reify["objects"]["str"] > 0
+    # the patch generates nodes, and its messages and contexts are gone by its end
+    assert patch["objects"]["AstNode"] > reify["objects"]["AstNode"]
+    assert patch["objects"]["MoveUpMsg"] == 1  # MoveUpMsg.EMPTY
+    assert patch["objects"]["PatchCtx"] == 0
@@ -0,0 +1,39 @@
+from rt_preproc.cli.patch_cmd import PatchOptions, patch_tree
+from rt_preproc.parser import ast
+from rt_preproc.parser.serialize import reify_source
+from rt_preproc.visitors.patch.data import MoveUpMsg, merge_move_ups
+
+
+def assert_empty_untouched():
+    assert MoveUpMsg.EMPTY.node is None and MoveUpMsg.EMPTY.move_ups == ()
+
+
+def test_empty_is_never_mutated():
+    empty = MoveUpMsg.EMPTY
+    a, b = ast.Identifier("a"), ast.Identifier("b")
+
+    assert empty.with_node(None) is empty
+    replaced = empty.with_node(a)
+    assert replaced is not empty and replaced.node is a
+    assert_empty_untouched()
+
+    moved = empty.move_up(a)
+    assert moved is not empty and moved.move_ups == [a]
+    assert moved.move_up(b) is moved and moved.move_ups == [a, b]
+    assert_empty_untouched()
+
+    # merging into the empty tuple hands over the other list, rather than extending it
+    move_ups = [a]
+    assert merge_move_ups(empty.move_ups, move_ups) is move_ups
+    assert merge_move_ups(move_ups, empty.move_ups) is move_ups
+    assert move_ups == [a]
+    assert_empty_untouched()
+
+
+def test_empty_after_patching():
+    # the declarations in its `#ifdef` blocks are moved up
+    with open("tests/vars/global/in_ifdef_fn/orig.c", "rb") as f:
+        source = f.read()
+    root, _ = reify_source(source, None)
+    patch_tree(root, source, PatchOptions())
+    assert_empty_untouched()
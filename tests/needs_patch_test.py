@@ -0,0 +1,25 @@
+import pytest
+from rt_preproc.cli.patch_cmd import PatchOptions, patch_tree
+from rt_preproc.parser.serialize import reify_source
+from rt_preproc.visitors.patch.patch import PatchVisitor
+from patch_test import scan_tree_for_test_folder
+
+
+def full_patch(source: bytes) -> str:
+    root_node, _ = reify_source(source, None)
+    return patch_tree(root_node, source, PatchOptions())[0].decode()
+
+
+@pytest.mark.parametrize(
+    "dir",
+    [
+        pytest.param(it, id=it.path[6:])  # remove "tests/" from path
+        for it in scan_tree_for_test_folder("tests/")
+    ],
+)
+def test_skipping_subtrees_keeps_the_output(dir, monkeypatch):
+    with open(f"{dir.path}/orig.c", "rb") as f:
+        source = f.read()
+    skipping = full_patch(source)
+    monkeypatch.setattr(PatchVisitor, "needs_patch", lambda self, node, ctx, macros: True)
+    assert full_patch(source) == skipping
@@ -0,0 +1,47 @@
+from typing import List, Tuple
+import pytest
+from rt_preproc.cli.patch_cmd import PatchOptions, patch_tree
+from rt_preproc.parser.serialize import reify_source
+from patch_test import scan_tree_for_test_folder
+
+header = b"""#include <stdio.h>
+
+#ifdef FOO
+int g(int v) { return v + 1; }
+#else
+double g(double v) { return v - 1; }
+#endif
+"""
+
+# enough independent function bodies to be spread over the workers
+functions = b"".join(
+    b"int f%d(int v) {\n  int r = v + %d;\n  r = g(r);\n  return r;\n}\n" % (i, i)
+    for i in range(12)
+)
+
+main = b"""int main() {
+  printf("%d\\n", f0(1) + f11(2));
+  return 0;
+}
+"""
+
+
+def patch(source: bytes, options: PatchOptions) -> Tuple[str, List[dict]]:
+    root_node, _ = reify_source(source, None)
+    output, degraded_sites = patch_tree(root_node, source, options)
+    return output.decode(), [vars(site) for site in degraded_sites]
+
+
+def sources():
+    yield pytest.param(header + functions + main, id="functions")
+    for it in scan_tree_for_test_folder("tests/"):
+        with open(f"{it.path}/orig.c", "rb") as f:
+            yield pytest.param(f.read(), id=it.path[6:])  # remove "tests/" from path
+
+
+@pytest.mark.parametrize("jobs", [2, 4])
+@pytest.mark.parametrize("source", list(sources()))
+def test_jobs_keep_the_output(source, jobs):
+    # with a budget, so the workers report degraded sites too
+    serial = patch(source, PatchOptions(jobs=1, max_site_combinations=2))
+    assert patch(source, PatchOptions(jobs=jobs, max_site_combinations=2)) == serial
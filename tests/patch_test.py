@@ -10,8 +10,20 @@ from dotenv import load_dotenv
 LOGGER = logging.getLogger(__name__)
 load_dotenv()
 
+def load_args(dir: os.DirEntry[str]) -> dict:
+    """
+    The extra arguments of a test folder's args.json, if it has one:
+    "patch" for rt_preproc patch and "cc" for compiling orig.c (ie: the -D the patch fixes).
+    """
+    args_path = os.path.join(dir.path, "args.json")
+    if not os.path.exists(args_path):
+        return {"patch": [], "cc": []}
+    args = json.load(open(args_path))
+    return {"patch": args.get("patch", []), "cc": args.get("cc", [])}
+
 def check_patch_equiv(dir: os.DirEntry[str], post_file: str = None):
     c_compiler = os.getenv("CC", "clang")
+    cc_args = load_args(dir)["cc"]
     orig_path = os.path.join(dir.path, "orig.c")
     post_path = os.path.join(dir.path, "post.c") if post_file is None else post_file
     conf_path = os.path.join(dir.path, "conf.json")
@@ -36,6 +48,7 @@ def check_patch_equiv(dir: os.DirEntry[str], post_file: str = None):
         comp_args = [
             c_compiler,
             orig_path,
+            *cc_args,
             *[f"-D{macro}={conf[macro]}" for macro in env_conf],
             "-o",
             "tmp/orig",
@@ -92,7 +105,7 @@ def test_c_func_equivalence_patch(dir: os.DirEntry[str]):
     if not os.path.exists("tmp"):
         os.mkdir("tmp")
     subprocess.run(
-        ["poetry", "run", "rt_preproc", "patch", "-o", "./tmp/out.c", os.path.join(dir.path, "orig.c")],
+        ["poetry", "run", "rt_preproc", "patch", "-o", "./tmp/out.c", *load_args(dir)["patch"], os.path.join(dir.path, "orig.c")],
     ).check_returncode()
     check_patch_equiv(dir, post_file="./tmp/out.c")
 
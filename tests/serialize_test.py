@@ -0,0 +1,58 @@
+import pytest
+from rt_preproc.parser.ast import AstNode
+from rt_preproc.parser.parser import Parser
+from rt_preproc.parser import serialize
+from patch_test import scan_tree_for_test_folder
+
+
+def assert_same_tree(a: AstNode, b: AstNode):
+    assert type(a) is type(b)
+    assert a.text == b.text
+    assert (a.start_byte, a.end_byte) == (b.start_byte, b.end_byte)
+    assert a.start_row == b.start_row
+    if a.base_node is not None:
+        assert a.start_row == a.base_node.start_point[0]
+    assert a.leading_trivia() == b.leading_trivia()
+    assert a.trailing_trivia() == b.trailing_trivia()
+    assert a.children_named_idxs == b.children_named_idxs
+    assert len(a.children) == len(b.children)
+    field_positions = lambda node: {
+        name: next(i for i, c in enumerate(node.children) if c is child)
+        for name, child in node._fields.items()
+    }
+    assert field_positions(a) == field_positions(b)
+    for child_a, child_b in zip(a.children, b.children):
+        assert child_a.parent is a and child_b.parent is b
+        assert_same_tree(child_a, child_b)
+
+
+@pytest.mark.parametrize(
+    "dir",
+    [
+        pytest.param(it, id=it.path[6:])  # remove "tests/" from path
+        for it in scan_tree_for_test_folder("tests/")
+    ],
+)
+def test_serialize_roundtrip(dir):
+    with open(f"{dir.path}/orig.c", "rb") as f:
+        source = f.read()
+    root = AstNode.reify(Parser().parse(source).root_node, source=source)
+    loaded = serialize.loads(serialize.dumps(root), source)
+    assert_same_tree(root, loaded)
+    assert str(loaded) == str(root)
+
+
+def test_reify_cache(tmp_path):
+    source = b"int main() {\n  return 0;\n}\n"
+    root, hit = serialize.reify_source(source, str(tmp_path))
+    assert not hit
+    cached, hit = serialize.reify_source(source, str(tmp_path))
+    assert hit
+    assert_same_tree(root, cached)
+
+
+def test_rejects_other_format():
+    data = bytearray(serialize.dumps(AstNode.reify(Parser().parse(b"int x;").root_node)))
+    data[4] += 1  # format version
+    with pytest.raises(serialize.FormatError):
+        serialize.loads(bytes(data))
@@ -0,0 +1,19 @@
+#include <stdio.h>
+
+int main() {
+#if LEVEL > 1
+  printf("level > 1\n");
+#else
+  printf("level <= 1\n");
+#endif
+#ifdef FAST
+  printf("fast\n");
+#endif
+#if defined(BAR) && LEVEL == 2
+  printf("bar at level 2\n");
+#elif defined(BAR)
+  printf("bar\n");
+#endif
+  printf("%d\n", LEVEL);
+  return 0;
+}
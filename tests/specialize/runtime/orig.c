@@ -0,0 +1,21 @@
+#include <stdio.h>
+
+#define LOCAL 1
+
+int main() {
+#ifdef LOCAL
+  printf("local\n");
+#endif
+#ifdef OTHER
+  printf("other\n");
+#endif
+#if LEVEL >= 3 && defined(BAR)
+  printf("bar at level 3\n");
+#endif
+#ifdef BAR
+  printf("bar\n");
+#else
+  printf("no bar\n");
+#endif
+  return 0;
+}
@@ -0,0 +1,45 @@
+import pytest
+from rt_preproc.cli.incremental import IncrementalPatcher
+from rt_preproc.cli.patch_cmd import PatchOptions, patch_tree
+from rt_preproc.parser.serialize import reify_source
+from rt_preproc.visitors.patch.specialize import Specialization, SpecializationError
+
+source = b"""#include <stdio.h>
+
+int main() {
+#if defined(MODE)
+  printf("%s\\n", MODE);
+#endif
+#if MODE == 1
+  printf("one\\n");
+#endif
+  return 0;
+}
+"""
+
+
+def patch(source: bytes, spec: Specialization) -> str:
+    root_node, _ = reify_source(source, None)
+    return patch_tree(root_node, source, PatchOptions(specialization=spec))[0].decode()
+
+
+def test_non_integer_define_in_if_is_rejected():
+    with pytest.raises(SpecializationError, match="MODE"):
+        patch(source, Specialization({"MODE": '"fast"'}))
+    # only tested with `defined`, its value doesn't matter
+    out = patch(source.replace(b"#if MODE == 1", b"#if 0"), Specialization({"MODE": '"fast"'}))
+    assert '#define MODE "fast"' in out
+    assert "MODE != UNDEFINED" not in out
+
+
+def test_runtime_keeps_the_macros_the_file_defines():
+    spec = Specialization(runtime=["BAR"])
+    local = b"#define LOCAL 1\nint main() {\n#ifdef LOCAL\n  return 1;\n#endif\n#ifdef OTHER\n  return 2;\n#endif\n}\n"
+    out = patch(local, spec)
+    assert "if (LOCAL != UNDEFINED_Int)" in out
+    assert "OTHER" not in out
+
+    # and incrementally, when the file stops defining it
+    patcher = IncrementalPatcher(PatchOptions(specialization=spec))
+    for version in [local, local.replace(b"#define LOCAL 1\n", b""), local]:
+        assert patcher.update(version) == patch(version, spec)
@@ -0,0 +1,57 @@
+from rt_preproc.cli.patch_cmd import PatchOptions, patch_tree
+from rt_preproc.parser.serialize import reify_source
+from rt_preproc.visitors.print import astyle_formatter
+from rt_preproc.visitors.splice import apply_edits, collect_edits, format_edits
+
+# the original lines are deliberately not in the astyle style
+source = b"""#include <stdio.h>
+
+int   helper( int v ){return v+1 ;}
+
+int main() {
+    int   y=0 ;
+\ty = helper( y );
+#ifdef FOO
+  y+=1;   y+=2;
+#endif
+  printf( "%d\\n",y );
+  return 0;
+}
+"""
+
+
+def untouched_lines(source: bytes, edits) -> list:
+    """
+    The lines of `source` that no edit starts, ends or is inside of.
+    """
+    lines = []
+    start = 0
+    for line in source.splitlines(keepends=True):
+        end = start + len(line)
+        if not any(edit.start <= end and edit.end >= start for edit in edits):
+            lines.append(line)
+        start = end
+    return lines
+
+
+def test_format_edits_only_formats_generated_code():
+    root_node, _ = reify_source(source, None)
+    patch_tree(root_node, source, PatchOptions())
+    edits = collect_edits(root_node, source)
+    unformatted = [edit.text for edit in edits]
+    format_edits(edits, source, astyle_formatter())
+    assert [edit.text for edit in edits] != unformatted
+
+    patched = apply_edits(source, edits)
+    untouched = untouched_lines(source, edits)
+    assert b"int   helper( int v ){return v+1 ;}\n" in untouched
+    assert b"    int   y=0 ;\n" in untouched and b"  printf( \"%d\\n\",y );\n" in untouched
+    # byte-identical and in order
+    pos = 0
+    for line in untouched:
+        pos = patched.index(line, pos) + len(line)
+
+    # and the same through the patch options
+    root_node, _ = reify_source(source, None)
+    assert patch_tree(root_node, source, PatchOptions(fmt=True))[0] == patched
+    assert b"{\n    y+=1;\n    y+=2;\n}" in patched
@@ -0,0 +1,46 @@
+import json
+from cleo.application import Application
+from cleo.testers.command_tester import CommandTester
+from rt_preproc.cli.stats_cmd import StatsCmd
+
+if_elif = "tests/conds/if_elif/orig.c"
+adjacent = "tests/conds/adjacent/orig.c"
+
+
+def run_stats(args: str) -> str:
+    application = Application()
+    application.add(StatsCmd())
+    tester = CommandTester(application.find("stats"))
+    assert tester.execute(args) == 0
+    return tester.io.fetch_output()
+
+
+def test_json():
+    if_stats, adjacent_stats = json.loads(run_stats(f"--json {if_elif} {adjacent}"))
+    # `#if` is counted apart from `#ifdef`
+    counts = [if_stats[key] for key in ("ifdefs", "ifs", "elifs", "elses")]
+    assert counts == [0, 2, 1, 1]
+    assert if_stats["macros"] == ["BAR", "FOO"]
+    assert if_stats["duplicated_sites"] == 0
+    [main] = if_stats["functions"]
+    assert (main["name"], main["line"], main["ifs"]) == ("main", 3, 2)
+
+    assert (adjacent_stats["ifdefs"], adjacent_stats["ifs"]) == (3, 0)
+    assert adjacent_stats["conditional"]["functions"] == ["func"]
+    # both calls of func are duplicated over its two definitions
+    assert [(site["line"], site["branches"]) for site in adjacent_stats["sites"]] == [
+        (17, 2),
+        (18, 2),
+    ]
+    assert (adjacent_stats["max_branches"], adjacent_stats["total_branches"]) == (2, 4)
+
+
+def test_table():
+    lines = run_stats(f"--functions {if_elif} {adjacent}").splitlines()
+    header = [cell.strip() for cell in lines[1].split("|")[1:-1]]
+    assert header[:5] == ["file / function", "#ifdef", "#if", "#elif", "#else"]
+    rows = [[cell.strip() for cell in line.split("|")[1:-1]] for line in lines[3:-1]]
+    assert [row[0] for row in rows] == [if_elif, "main()", adjacent, "func()", "func()", "main()"]
+    assert rows[0][1:5] == ["0", "2", "1", "1"]
+    assert rows[1][1:5] == ["0", "2", "1", "1"]
+    assert rows[2][1:3] == ["3", "0"]
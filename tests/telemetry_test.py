@@ -0,0 +1,39 @@
+import io
+import json
+import time
+from rt_preproc.cli.patch_cmd import PatchOptions, patch_tree
+from rt_preproc.cli.telemetry import Telemetry, finish_record, new_record, percentile
+from rt_preproc.parser.serialize import reify_source
+
+
+def test_percentile_nearest_rank():
+    assert percentile([], 0.5) is None
+    assert percentile([3.0, 1.0, 2.0], 0.5) == 2.0
+    assert percentile([float(i) for i in range(1, 101)], 0.95) == 95.0
+    assert percentile([1.0, 2.0], 0.99) == 2.0
+
+
+def test_records_and_aggregate():
+    source = b"#ifdef FOO\nint x = 1;\n#else\ndouble x = 2;\n#endif\nint main() { return (int)x; }\n"
+    out = io.StringIO()
+    telemetry = Telemetry(out)
+    start = time.perf_counter()
+    record = new_record("a.c", source)
+    root_node, _ = reify_source(source, None, record)
+    patch_tree(root_node, source, PatchOptions(), record)
+    finish_record(record, start, None)
+    telemetry.add(record)
+    failed = new_record("b.c", b"")
+    finish_record(failed, start, "OSError: missing")
+    telemetry.add(failed)
+    telemetry.finish(unchanged=2)
+
+    lines = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [line["type"] for line in lines] == ["file", "file", "aggregate"]
+    assert lines[0]["bytes"] == len(source)
+    assert lines[0]["patch_s"] > 0 and lines[0]["error"] is None
+    aggregate = lines[2]
+    assert (aggregate["files"], aggregate["failed"], aggregate["unchanged"]) == (1, 1, 2)
+    assert aggregate["bytes"] == len(source)
+    assert aggregate["latency_s"]["p50"] == lines[0]["total_s"]
+    assert aggregate["phase_s"]["patch"] == lines[0]["patch_s"]
@@ -0,0 +1,18 @@
+#include <stdio.h>
+
+int main() {
+  int sum = 0;
+  int i = 0;
+  while (i < 10) {
+#if LEVEL > 1
+    sum += 2 * i;
+#elif LEVEL == 1
+    sum += i;
+#else
+    sum -= i;
+#endif
+    i++;
+  }
+  printf("%d\n", sum);
+  return 0;
+}
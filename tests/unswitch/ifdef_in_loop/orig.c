@@ -0,0 +1,17 @@
+#include <stdio.h>
+
+int main() {
+  int sum = 0;
+  for (int i = 0; i < 10; i++) {
+#ifdef FOO
+    sum += i;
+#else
+    sum -= i;
+#endif
+#ifdef BAR
+    sum *= 2;
+#endif
+  }
+  printf("%d\n", sum);
+  return 0;
+}
@@ -0,0 +1,24 @@
+from rt_preproc.cli.patch_cmd import PatchOptions, patch_tree
+from rt_preproc.parser.serialize import reify_source
+
+
+def patch(path: str, unswitch_loops: int) -> str:
+    with open(path, "rb") as f:
+        source = f.read()
+    root_node, _ = reify_source(source, None)
+    return patch_tree(root_node, source, PatchOptions(unswitch_loops=unswitch_loops))[0].decode()
+
+
+def test_only_feasible_configurations_are_copied():
+    # the 3 flags of the chain are exclusive and one of them holds: 3 copies, not 2^3
+    out = patch("tests/unswitch/elif_chain/orig.c", 3)
+    assert out.count("while (i < 10)") == 3
+    out = patch("tests/unswitch/elif_chain/orig.c", 2)
+    assert out.count("while (i < 10)") == 1
+
+
+def test_independent_macros_are_all_copied():
+    out = patch("tests/unswitch/ifdef_in_loop/orig.c", 4)
+    assert out.count("for (int i = 0; i < 10; i++)") == 4
+    out = patch("tests/unswitch/ifdef_in_loop/orig.c", 3)
+    assert out.count("for (int i = 0; i < 10; i++)") == 1